@@ -0,0 +1,65 @@
+import time
+
+import numpy as np
+
+from etl_separated import BATCH_SIZE
+from preprocessing_staging_ChinookDW4 import CLEANSING_RULES, transform_columns, transform_rows
+
+# Raw values the fixture draws from: untrimmed, mixed case, empty and NULL
+# text, and addresses that fail the email check
+NAMES = ['  luís ', 'LEONIE', "o'reilly", 'françois', 'bjørn  ', 'mark', '', None, 'jean-luc', 'van der berg']
+PLACES = ['são josé dos campos', 'STUTTGART ', ' montréal', 'new york', '', None, 'rio de janeiro', 'oslo']
+COMPANIES = ['embraer - empresa brasileira', None, 'JetBrains s.r.o.', '', 'apple inc.', 'microsoft corporation']
+EMAILS = ['luisg@embraer.com.br', ' LEONEKOHLER@surfeu.de ', 'ftremblay@gmail', 'no-at-sign.com', '',
+          None, 'a@b.c', '@example.com', 'x@.com', 'bjorn.hansen@yahoo.no']
+
+# Roughly how many different values each text column holds at scale;
+# the vectorized engine's gain depends on this
+CARDINALITY = {'FirstName': 3000, 'LastName': 5000, 'Company': 500, 'Address': 200000, 'City': 500,
+               'State': 40, 'Country': 25, 'Email': 200000, 'BillingAddress': 200000, 'BillingCity': 500,
+               'BillingState': 40, 'BillingCountry': 25}
+
+def fixture(table, rows, seed=0):
+    # rows source tuples shaped like the table's CLEANSING_RULES columns
+    rng = np.random.default_rng(seed)
+    _, rules = CLEANSING_RULES[table]
+    pools = {'FirstName': NAMES, 'LastName': NAMES, 'Company': COMPANIES, 'Email': EMAILS}
+    columns = []
+    for column, rule in rules:
+        if rule is None:
+            columns.append(rng.integers(1, 100000, rows).tolist())
+            continue
+        base = pools.get(column, PLACES)
+        pool = [value if not value or i == 0 else
+                (value.replace('@', f"{i}@") if column == 'Email' else f"{value} {i}")
+                for i in range(CARDINALITY[column] // len(base) + 1) for value in base]
+        columns.append([pool[i] for i in rng.integers(0, len(pool), rows)])
+    return list(zip(*columns))
+
+def benchmark(rows=1000000, batch_size=BATCH_SIZE, tables=('stg_Customer', 'stg_Invoice')):
+    # Time the per-row and vectorized engines batch by batch on the same
+    # fixture and check that every batch comes out the same. Each batch is
+    # dropped after the comparison, as it would be after its INSERT.
+    results = {}
+    for table in tables:
+        source = fixture(table, rows)
+        rules = CLEANSING_RULES[table][1]
+        row_time = column_time = 0.0
+        for offset in range(0, len(source), batch_size):
+            batch = source[offset:offset + batch_size]
+            start = time.perf_counter()
+            expected = transform_rows(batch, rules)
+            row_time += time.perf_counter() - start
+            start = time.perf_counter()
+            actual = transform_columns(batch, rules)
+            column_time += time.perf_counter() - start
+            if actual != expected:
+                raise AssertionError(f"Vectorized output differs from per-row output for {table} at row {offset}")
+        results[table] = {'rows': rows, 'per_row_s': round(row_time, 3), 'vectorized_s': round(column_time, 3),
+                          'speedup': round(row_time / column_time, 2)}
+        print(f"{table}: {rows} rows, per-row {row_time:.2f}s, vectorized {column_time:.2f}s, "
+              f"{row_time / column_time:.2f}x")
+    return results
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,423 @@
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import date, datetime
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pyodbc
+
+from etl_separated import BATCH_SIZE, LOADERS, build_mappings, create_watermark_table, truncate_tables
+from etl_shadow import PRIMARY_KEYS, STAR_TABLES, TARGET_SCHEMA
+from inserting_data_ChinookDW4 import END_DATE, SCALE_FACTORS, TABLE_COLUMNS, DatabaseSink, generate
+from olap_query_builder import SAMPLE_QUERIES, OLAPQuery, build_cube_sql
+from preprocessing_staging_ChinookDW4 import CLEANSING_RULES, create_staging_tables, preprocess_table, truncate_staging_tables
+
+# The local stand-in for SQL Server needs duckdb
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Peak RSS comes from getrusage(), which Windows does not have
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# End-to-end benchmark: seed a source at a fixed scale factor, then time the
+# staging cleansing, every loader and a fixed OLAP query workload, write the
+# numbers to JSON and compare them with a stored baseline. Runs against a
+# local DuckDB file by default; the sqlserver backend expects empty copies of
+# Chinook and ChinookDW4 created from the two creation scripts.
+BACKENDS = ('duckdb', 'sqlserver')
+SERVER = 'DPC2023'
+SOURCE_DATABASE = 'ChinookBench'
+TARGET_DATABASE = 'ChinookDW4Bench'
+
+# preprocess_table() engines timed per staging table. pushdown is left out:
+# it needs the dbo.stg_TitleCase UDF and a source on the same server.
+PREPROCESS_ENGINES = ('python', 'vectorized')
+
+# Each workload query runs once untimed, then QUERY_REPEATS times
+QUERY_REPEATS = 20
+ANALYTICAL_QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analytical_queries.sql')
+
+# A stage slower than its baseline rows/sec, or a query slower than its
+# baseline p95, by more than this fraction counts as a regression
+REGRESSION_TOLERANCE = 0.2
+BASELINE_DIRECTORY = 'benchmarks'
+
+# Star schema in the stand-in: key column from etl_shadow.PRIMARY_KEYS,
+# filled from a sequence as IDENTITY would, followed by these columns
+STAND_IN_COLUMNS = {
+    'DimArtist': "ArtistId INTEGER, Name VARCHAR",
+    'DimAlbum': "AlbumId INTEGER, Title VARCHAR, ArtistKey INTEGER",
+    'DimGenre': "GenreId INTEGER, Name VARCHAR",
+    'DimMediaType': "MediaTypeId INTEGER, Name VARCHAR",
+    'DimTrack': ("TrackId INTEGER, Name VARCHAR, AlbumKey INTEGER, MediaTypeKey INTEGER, GenreKey INTEGER, "
+                 "Composer VARCHAR, Milliseconds INTEGER, Bytes INTEGER"),
+    'DimEmployee': ("EmployeeId INTEGER, FirstName VARCHAR, LastName VARCHAR, Title VARCHAR, ReportsTo INTEGER, "
+                    "HireDate TIMESTAMP"),
+    'DimCustomer': ("CustomerId INTEGER, FirstName VARCHAR, LastName VARCHAR, Company VARCHAR, Address VARCHAR, "
+                    "City VARCHAR, State VARCHAR, Country VARCHAR, PostalCode VARCHAR"),
+    'DimDate': "Date DATE, Day INTEGER, Month INTEGER, Year INTEGER, Quarter INTEGER",
+    'FactSales': ("InvoiceLineId INTEGER, DateKey INTEGER, CustomerKey INTEGER, TrackKey INTEGER, AlbumKey INTEGER, "
+                  "GenreKey INTEGER, MediaTypeKey INTEGER, EmployeeKey INTEGER, Quantity INTEGER, "
+                  "UnitPrice DECIMAL(10,2), TotalAmount DECIMAL(10,2)"),
+}
+
+# Statements the stand-in cursor treats specially
+INSERT_VALUES = re.compile(r"^\s*INSERT INTO\s+([\w.]+)\s*\(([^)]*)\)\s*VALUES\s*\([\s?,]*\)\s*$", re.IGNORECASE)
+DML = re.compile(r"^\s*(INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+BRACKETED = re.compile(r"\[(\w+)\]")
+
+class StandInCursor:
+    # The part of the pyodbc cursor API the ETL and query code uses, over a
+    # DuckDB connection: ? parameters passed positionally or as one sequence,
+    # rows with attribute access, rowcount after DML and [name] quoting. With
+    # fast_executemany set, a parameter-array INSERT goes in as one DataFrame
+    # append, as pyodbc sends it as one parameter array.
+
+    def __init__(self, db):
+        self.db = db
+        self.db.execute(f"SET search_path = 'main,{TARGET_SCHEMA}'")
+        self.fast_executemany = False
+        self.rowcount = -1
+        self.description = None
+        self.row_type = None
+
+    def execute(self, sql, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        self.db.execute(BRACKETED.sub(r'"\1"', sql), list(params))
+        if DML.match(sql):
+            self.rowcount = self.db.fetchone()[0]
+            self.description = None
+        else:
+            self.rowcount = -1
+            self.description = self.db.description
+            names = [column[0] for column in self.description or []]
+            self.row_type = namedtuple('Row', names, rename=True) if names else None
+        return self
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        match = INSERT_VALUES.match(sql)
+        if self.fast_executemany and match and rows:
+            table, columns = match.groups()
+            batch = pd.DataFrame(rows, columns=[column.strip() for column in columns.split(',')], dtype=object)
+            self.db.register('executemany_batch', batch)
+            try:
+                self.db.execute(f"INSERT INTO {table} ({columns}) SELECT * FROM executemany_batch")
+            finally:
+                self.db.unregister('executemany_batch')
+        elif rows:
+            self.db.executemany(BRACKETED.sub(r'"\1"', sql), rows)
+        self.rowcount = -1
+
+    def fetchone(self):
+        row = self.db.fetchone()
+        return None if row is None else self.row_type._make(row)
+
+    def fetchmany(self, size):
+        return [self.row_type._make(row) for row in self.db.fetchmany(size)]
+
+    def fetchall(self):
+        return [self.row_type._make(row) for row in self.db.fetchall()]
+
+    def close(self):
+        self.db.close()
+
+class StandInConnection:
+    # One DuckDB file holds the seeded source tables and the staging tables
+    # (main schema) and the star schema (dbo). Statements autocommit, so
+    # commit() and rollback() have nothing to do.
+
+    def __init__(self, path):
+        self.db = duckdb.connect(path)
+        self.db.execute(f"CREATE SCHEMA IF NOT EXISTS {TARGET_SCHEMA}")
+
+    def cursor(self):
+        return StandInCursor(self.db.cursor())
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+class StandInSink(DatabaseSink):
+    # DatabaseSink that first creates each source table from the types of
+    # its first generated frame
+
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        super().__init__(conn, batch_size)
+        self.created = set()
+
+    def write(self, table, df):
+        if table not in self.created:
+            self.cursor.db.register('first_frame', df[TABLE_COLUMNS[table]])
+            self.cursor.db.execute(f"CREATE TABLE {table} AS SELECT * FROM first_frame LIMIT 0")
+            self.cursor.db.unregister('first_frame')
+            self.created.add(table)
+        super().write(table, df)
+
+def create_stand_in_warehouse(conn):
+    cursor = conn.cursor()
+    for table in STAR_TABLES:
+        key = PRIMARY_KEYS[table]
+        cursor.execute(f"CREATE SEQUENCE {TARGET_SCHEMA}.{table}_{key}")
+        cursor.execute(f"""
+            CREATE TABLE {TARGET_SCHEMA}.{table} (
+                {key} INTEGER PRIMARY KEY DEFAULT nextval('{TARGET_SCHEMA}.{table}_{key}'),
+                {STAND_IN_COLUMNS[table]}
+            )
+        """)
+    cursor.execute(f"""
+        CREATE TABLE {TARGET_SCHEMA}.EtlWatermark (
+            SourceTable VARCHAR PRIMARY KEY, WatermarkColumn VARCHAR, WatermarkValue BIGINT, UpdatedAt TIMESTAMP
+        )
+    """)
+    # Staging tables take the source tables' column types
+    for staging_table, (source_table, rules) in CLEANSING_RULES.items():
+        columns = ", ".join(column for column, _ in rules)
+        cursor.execute(f"CREATE TABLE {staging_table} AS SELECT {columns} FROM {source_table} LIMIT 0")
+    cursor.close()
+
+def seed(backend, scale_factor, seed_value, path=None, end=END_DATE):
+    # Generate the source, with dates up to end, and prepare empty staging
+    # and star tables. Returns (connect_source, connect_target, rows generated).
+    if backend == 'duckdb':
+        if duckdb is None:
+            raise ValueError("The duckdb backend requires the duckdb package")
+        connect_source = connect_target = partial(StandInConnection, path)
+        conn = connect_source()
+        sink = StandInSink(conn)
+        try:
+            written = generate(sink, scale_factor, seed_value, end=end)
+            create_stand_in_warehouse(conn)
+        finally:
+            sink.close()
+            conn.close()
+        return connect_source, connect_target, sum(written.values())
+
+    connect_source = partial(pyodbc.connect, f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={SERVER};"
+                                             f"DATABASE={SOURCE_DATABASE};Trusted_Connection=yes;")
+    connect_target = partial(pyodbc.connect, f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={SERVER};"
+                                             f"DATABASE={TARGET_DATABASE};Trusted_Connection=yes;")
+    source_conn = connect_source()
+    sink = DatabaseSink(source_conn)
+    try:
+        written = generate(sink, scale_factor, seed_value, source_conn.cursor(), end)
+    finally:
+        sink.close()
+        source_conn.close()
+    target_conn = connect_target()
+    try:
+        target_cursor = target_conn.cursor()
+        create_staging_tables(target_cursor, target_conn)
+        create_watermark_table(target_cursor, target_conn)
+        truncate_tables(target_cursor, target_conn)
+    finally:
+        target_conn.close()
+    return connect_source, connect_target, sum(written.values())
+
+def peak_rss_mb():
+    # High-water mark of the whole process so far: ru_maxrss is in KiB on
+    # Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def stage_result(rows, elapsed):
+    return {'rows': rows, 'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / elapsed) if elapsed > 0 else None, 'peak_rss_mb': peak_rss_mb()}
+
+def clear_staging(backend, target_cursor, target_conn):
+    if backend == 'duckdb':
+        for staging_table in CLEANSING_RULES:
+            target_cursor.execute(f"DELETE FROM {staging_table}")
+    else:
+        truncate_staging_tables(target_cursor, target_conn)
+
+def time_staging(backend, connect_source, connect_target, batch_size):
+    # preprocess_table() per engine and staging table, staging cleared
+    # before each engine so both write into empty tables
+    stages = {}
+    source_conn = connect_source()
+    target_conn = connect_target()
+    try:
+        source_cursor = source_conn.cursor()
+        target_cursor = target_conn.cursor()
+        target_cursor.fast_executemany = True
+        for engine in PREPROCESS_ENGINES:
+            clear_staging(backend, target_cursor, target_conn)
+            for staging_table in CLEANSING_RULES:
+                start = time.perf_counter()
+                rows = preprocess_table(source_cursor, target_cursor, staging_table, batch_size, engine)
+                target_conn.commit()
+                stages[f"preprocess.{engine}.{staging_table}"] = stage_result(rows, time.perf_counter() - start)
+    finally:
+        source_conn.close()
+        target_conn.close()
+    return stages
+
+def time_loads(connect_source, connect_target, batch_size):
+    # Every loader in dependency order into the empty star schema
+    stages = {}
+    source_conn = connect_source()
+    target_conn = connect_target()
+    try:
+        source_cursor = source_conn.cursor()
+        target_cursor = target_conn.cursor()
+        mappings = build_mappings(target_cursor)
+        for loader in LOADERS.values():
+            start = time.perf_counter()
+            rows = loader(source_cursor, target_cursor, target_conn, mappings, batch_size)
+            stages[loader.__name__] = stage_result(rows, time.perf_counter() - start)
+    finally:
+        source_conn.close()
+        target_conn.close()
+    return stages
+
+def sample_queries():
+    # The OLAPQuery payloads /sample_queries/ serves, built into SQL as
+    # /execute_query/ builds them
+    queries = []
+    for sample in SAMPLE_QUERIES:
+        sql, params = build_cube_sql(OLAPQuery(**sample['query']))
+        queries.append((f"sample: {sample['description']}", sql, params))
+    return queries
+
+def analytical_queries(path=ANALYTICAL_QUERIES):
+    with open(path, encoding='utf-8') as f:
+        text = re.sub(r"--[^\n]*", "", f.read())
+    statements = [statement.strip() for statement in text.split(';') if statement.strip()]
+    return [(f"analytical_queries.sql #{number}", statement, [])
+            for number, statement in enumerate(statements, 1)]
+
+def time_queries(connect_target, workload, repeats=QUERY_REPEATS):
+    # Latency of execute + fetch + DataFrame build, per query
+    queries = {}
+    conn = connect_target()
+    try:
+        cursor = conn.cursor()
+        for name, sql, params in workload:
+            latencies = []
+            for run in range(repeats + 1):
+                start = time.perf_counter()
+                cursor.execute(sql, params)
+                columns = [column[0] for column in cursor.description]
+                df = pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+                if run:
+                    latencies.append((time.perf_counter() - start) * 1000)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            queries[name] = {'rows': len(df), 'runs': repeats, 'p50_ms': round(p50, 2), 'p95_ms': round(p95, 2),
+                             'p99_ms': round(p99, 2), 'peak_rss_mb': peak_rss_mb()}
+            print(f"{name}: {len(df)} rows, p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms")
+    finally:
+        conn.close()
+    return queries
+
+def benchmark(scale_factor=1, backend='duckdb', batch_size=BATCH_SIZE, repeats=QUERY_REPEATS, seed_value=42,
+              end=END_DATE):
+    if scale_factor not in SCALE_FACTORS:
+        raise ValueError(f"Unknown scale factor {scale_factor}, expected one of {SCALE_FACTORS}")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    results = {'scale_factor': scale_factor, 'backend': backend, 'batch_size': batch_size, 'seed': seed_value,
+               'end_date': end.isoformat(), 'started_at': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+               'machine': platform.machine(), 'stages': {}, 'queries': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        connect_source, connect_target, rows = seed(backend, scale_factor, seed_value,
+                                                    os.path.join(directory, 'chinook.duckdb'), end)
+        results['stages']['seed'] = stage_result(rows, time.perf_counter() - start)
+        results['stages'].update(time_staging(backend, connect_source, connect_target, batch_size))
+        results['stages'].update(time_loads(connect_source, connect_target, batch_size))
+        workload = sample_queries() + analytical_queries()
+        results['queries'] = time_queries(connect_target, workload, repeats)
+    return results
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    # Regressions of results against baseline, one message each
+    if (results['scale_factor'], results['backend']) != (baseline['scale_factor'], baseline['backend']):
+        raise ValueError(f"Baseline is SF{baseline['scale_factor']} on {baseline['backend']}, "
+                         f"results are SF{results['scale_factor']} on {results['backend']}")
+    # Same data only for the same seed and end date
+    if (results['seed'], results['end_date']) != (baseline.get('seed'), baseline.get('end_date')):
+        raise ValueError(f"Baseline was generated with seed {baseline.get('seed')} up to {baseline.get('end_date')}, "
+                         f"results with seed {results['seed']} up to {results['end_date']}")
+    regressions = []
+    for name, stage in results['stages'].items():
+        before = baseline['stages'].get(name)
+        if before and before['rows_per_sec'] and stage['rows_per_sec'] is not None \
+                and stage['rows_per_sec'] < before['rows_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {stage['rows_per_sec']} rows/sec, baseline {before['rows_per_sec']}")
+    for name, query in results['queries'].items():
+        before = baseline['queries'].get(name)
+        if before and query['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {query['p95_ms']}ms, baseline {before['p95_ms']}ms")
+    return regressions
+
+def baseline_path(scale_factor, backend):
+    return os.path.join(BASELINE_DIRECTORY, f"baseline_sf{scale_factor}_{backend}.json")
+
+def write_json(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the staging, load and OLAP query paths.")
+    parser.add_argument('--scale-factor', type=int, default=1, choices=SCALE_FACTORS)
+    parser.add_argument('--backend', default='duckdb', choices=BACKENDS)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--repeats', type=int, default=QUERY_REPEATS)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--end-date', type=date.fromisoformat, default=END_DATE,
+                        help=f"last generated invoice date, YYYY-MM-DD (default {END_DATE})")
+    parser.add_argument('--output', help="results file (default benchmarks/results_sf<N>_<backend>.json)")
+    parser.add_argument('--baseline', help="baseline to compare with (default benchmarks/baseline_sf<N>_<backend>.json)")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    results = benchmark(args.scale_factor, args.backend, args.batch_size, args.repeats, args.seed, args.end_date)
+    baseline_file = args.baseline or baseline_path(args.scale_factor, args.backend)
+    regressions = []
+    if os.path.exists(baseline_file):
+        with open(baseline_file, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results['comparison'] = {'baseline': baseline_file, 'tolerance': args.tolerance, 'regressions': regressions}
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressions against {baseline_file}.")
+    else:
+        print(f"No baseline at {baseline_file}.")
+
+    output = args.output or os.path.join(BASELINE_DIRECTORY, f"results_sf{args.scale_factor}_{args.backend}.json")
+    write_json(output, results)
+    print(f"Results written to {output}.")
+    if args.save_baseline:
+        write_json(baseline_file, results)
+        print(f"Baseline saved to {baseline_file}.")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import pyodbc
+
+# Default pool sizing; the OLAP API overrides these from its own settings
+POOL_SIZE = 10
+POOL_TIMEOUT = 30
+
+class PoolTimeoutError(Exception):
+    pass
+
+class ConnectionPool:
+    # Bounded pool of pyodbc connections. Idle connections are health-checked
+    # before reuse; callers wait up to `timeout` seconds when all are in use.
+
+    def __init__(self, connection_string, max_size=POOL_SIZE, timeout=POOL_TIMEOUT, health_check_query="SELECT 1"):
+        self.connection_string = connection_string
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_query = health_check_query
+        self._idle = []
+        self._in_use = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._health_check_failures = 0
+        self._created = 0
+
+    def acquire(self):
+        start = time.perf_counter()
+        waited = False
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    conn = None
+                    break
+                remaining = self.timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(f"No connection available within {self.timeout}s ({self.max_size} in use)")
+                waited = True
+                self._condition.wait(remaining)
+            # Reserve the slot before connecting outside the lock
+            self._in_use += 1
+            self._acquired += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += time.perf_counter() - start
+
+        try:
+            if conn is not None and not self._is_healthy(conn):
+                conn = None
+            if conn is None:
+                conn = pyodbc.connect(self.connection_string)
+                with self._condition:
+                    self._created += 1
+        except Exception:
+            self._release_slot()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        if not discard:
+            try:
+                # Never hand an open transaction to the next caller
+                conn.rollback()
+            except pyodbc.Error:
+                discard = True
+        with self._condition:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._close_quietly(conn)
+            else:
+                self._idle.append(conn)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        # Same semantics as `with pyodbc.connect(...) as conn`: commit on
+        # success, roll back on error; the connection then goes back to the pool
+        conn = self.acquire()
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+        logging.info("Connection pool closed.")
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "acquired": self._acquired,
+                "created": self._created,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time, 4),
+                "wait_time_avg": round(self._wait_time / self._waits, 4) if self._waits else 0.0,
+                "timeouts": self._timeouts,
+                "health_check_failures": self._health_check_failures,
+            }
+
+    def _is_healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.health_check_query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            logging.warning("Discarding pooled connection that failed its health check.")
+            with self._condition:
+                self._health_check_failures += 1
+            self._close_quietly(conn)
+            return False
+
+    def _release_slot(self):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
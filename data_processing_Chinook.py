@@ -1,164 +1,325 @@
 import pyodbc
-import pandas as pd
+import logging
+from functools import partial
+from etl_scheduler import run_dag
 
 # Database connection parameters
 source_server = 'DPC2023'  # Replace with your server name
 source_database = 'Chinook'
 
-# Establish the connection
-conn = pyodbc.connect(
-    f'DRIVER={{ODBC Driver 17 for SQL Server}};'
-    f'SERVER={source_server};'
-    f'DATABASE={source_database};'
-    'Trusted_Connection=yes;'
-)
-cursor = conn.cursor()
-
-# Fetch tables for cleaning
-tables = ['Album', 'Artist', 'Customer', 'Employee', 'Genre', 'Invoice', 'InvoiceLine', 'MediaType', 'Playlist', 'PlaylistTrack', 'Track']
-
-# Function to remove duplicate rows from a table
-def remove_duplicates(table_name):
-    primary_keys = {
-        'Album': 'AlbumId',
-        'Artist': 'ArtistId',
-        'Customer': 'CustomerId',
-        'Employee': 'EmployeeId',
-        'Genre': 'GenreId',
-        'Invoice': 'InvoiceId',
-        'InvoiceLine': 'InvoiceLineId',
-        'MediaType': 'MediaTypeId',
-        'Playlist': 'PlaylistId',
-        'PlaylistTrack': 'PlaylistId, TrackId',
-        'Track': 'TrackId'
-    }
-    primary_key = primary_keys[table_name]
-    if table_name == 'PlaylistTrack':
-        cursor.execute(f"""
-            WITH CTE AS (
-                SELECT *,
-                       ROW_NUMBER() OVER (PARTITION BY {primary_key} ORDER BY (SELECT NULL)) AS rn
-                FROM {table_name}
-            )
-            DELETE FROM CTE WHERE rn > 1;
-        """)
-    else:
-        cursor.execute(f"""
-            WITH CTE AS (
-                SELECT *,
-                       ROW_NUMBER() OVER (PARTITION BY {primary_key} ORDER BY (SELECT NULL)) AS rn
-                FROM {table_name}
-            )
-            DELETE FROM CTE WHERE rn > 1;
+# Tables cleaned concurrently; a table only starts once the tables it references are done
+CLEANUP_WORKERS = 4
+
+# Rows removed per DELETE, committed one batch at a time. Kept under SQL
+# Server's lock escalation threshold (5000 locks) so a large cleanup never
+# takes a table lock, and the log can be reused between batches.
+DELETE_BATCH_SIZE = 4000
+
+PRIMARY_KEYS = {
+    'Album': ['AlbumId'],
+    'Artist': ['ArtistId'],
+    'Customer': ['CustomerId'],
+    'Employee': ['EmployeeId'],
+    'Genre': ['GenreId'],
+    'Invoice': ['InvoiceId'],
+    'InvoiceLine': ['InvoiceLineId'],
+    'MediaType': ['MediaTypeId'],
+    'Playlist': ['PlaylistId'],
+    'PlaylistTrack': ['PlaylistId', 'TrackId'],
+    'Track': ['TrackId']
+}
+
+# Data-quality rules per table:
+#   'defaults'    column -> value replacing NULL
+#   'trim'        columns stripped of leading and trailing spaces
+#   'standardize' column -> {variant: standard value}
+#   'dedup'       business key columns; of the rows sharing a business key
+#                 only the one with the lowest primary key is kept, and rows
+#                 referencing a removed duplicate are re-pointed to it (rows
+#                 with a NULL or a 'defaults' value in the key are never
+#                 duplicates: two customers without an email are not the same)
+#   'references'  column -> (referenced table, referenced column); rows
+#                 pointing at a missing row are deleted
+#   'checks'      column -> condition every row must satisfy; rows failing
+#                 it are deleted
+# The defaults, trims and standardizations of a table run as one UPDATE,
+# the dedup, references and checks as one batched DELETE.
+QUALITY_RULES = {
+    'Album': {
+        'defaults': {'Title': 'Unknown'},
+        'dedup': ['Title', 'ArtistId'],
+        'references': {'ArtistId': ('Artist', 'ArtistId')},
+    },
+    'Artist': {'dedup': ['Name']},
+    'Customer': {
+        'defaults': {'FirstName': 'Unknown', 'LastName': 'Unknown', 'Email': 'Unknown'},
+        'trim': ['FirstName', 'LastName', 'Company', 'Address', 'City', 'State', 'Country', 'Phone', 'Fax', 'Email'],
+        'standardize': {'Country': {'United States': 'USA', 'US': 'USA', 'United Kingdom': 'UK', 'GB': 'UK'}},
+        'dedup': ['FirstName', 'LastName', 'Email'],
+        'references': {'SupportRepId': ('Employee', 'EmployeeId')},
+    },
+    'Employee': {
+        'defaults': {'LastName': 'Unknown', 'FirstName': 'Unknown'},
+        'trim': ['LastName', 'FirstName', 'Title', 'Address', 'City', 'State', 'Country', 'Phone', 'Fax', 'Email'],
+        'dedup': ['LastName', 'FirstName', 'BirthDate'],
+        'references': {'ReportsTo': ('Employee', 'EmployeeId')},
+    },
+    'Genre': {'dedup': ['Name']},
+    'Invoice': {
+        'references': {'CustomerId': ('Customer', 'CustomerId')},
+        'checks': {'Total': 'Total >= 0'},
+    },
+    'InvoiceLine': {
+        'references': {'InvoiceId': ('Invoice', 'InvoiceId'), 'TrackId': ('Track', 'TrackId')},
+        'checks': {'Quantity': 'Quantity > 0', 'UnitPrice': 'UnitPrice >= 0'},
+    },
+    'MediaType': {'dedup': ['Name']},
+    'Playlist': {},
+    'PlaylistTrack': {
+        'references': {'PlaylistId': ('Playlist', 'PlaylistId'), 'TrackId': ('Track', 'TrackId')},
+    },
+    'Track': {
+        'defaults': {'Name': 'Unknown'},
+        'trim': ['Name', 'Composer'],
+        'dedup': ['Name', 'AlbumId', 'MediaTypeId', 'GenreId', 'Milliseconds'],
+        'references': {'AlbumId': ('Album', 'AlbumId'), 'GenreId': ('Genre', 'GenreId'),
+                       'MediaTypeId': ('MediaType', 'MediaTypeId')},
+        'checks': {'Milliseconds': 'Milliseconds > 0', 'UnitPrice': 'UnitPrice >= 0'},
+    },
+}
+
+def cleanup_dependencies(rules=QUALITY_RULES):
+    # A table's orphan check must see its referenced tables already cleaned
+    return {table: sorted({ref_table for ref_table, _ in table_rules.get('references', {}).values()} - {table})
+            for table, table_rules in rules.items()}
+
+def sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def column_expression(table_rules, column):
+    # New value of a column: NULL replaced by its default, then trimmed,
+    # then mapped to its standard spelling
+    expression = column
+    if column in table_rules.get('defaults', {}):
+        expression = f"COALESCE({expression}, {sql_literal(table_rules['defaults'][column])})"
+    if column in table_rules.get('trim', []):
+        expression = f"LTRIM(RTRIM({expression}))"
+    if column in table_rules.get('standardize', {}):
+        cases = " ".join(f"WHEN {sql_literal(variant)} THEN {sql_literal(standard)}"
+                         for variant, standard in table_rules['standardize'][column].items())
+        expression = f"CASE {expression} {cases} ELSE {expression} END"
+    return expression
+
+def update_rules(table_rules, prefix=''):
+    # (rule name, condition matching the rows the rule changes); prefix
+    # qualifies the columns, e.g. 'deleted.' inside an OUTPUT clause
+    rules = []
+    for column in table_rules.get('defaults', {}):
+        rules.append((f"not_null {column}", f"{prefix}{column} IS NULL"))
+    for column in table_rules.get('trim', []):
+        # DATALENGTH, since '=' ignores trailing spaces
+        rules.append((f"trim {column}", f"DATALENGTH({prefix}{column}) <> DATALENGTH(LTRIM(RTRIM({prefix}{column})))"))
+    for column, variants in table_rules.get('standardize', {}).items():
+        value = f"LTRIM(RTRIM({prefix}{column}))" if column in table_rules.get('trim', []) else f"{prefix}{column}"
+        rules.append((f"standardize {column}", f"{value} IN ({', '.join(sql_literal(variant) for variant in variants)})"))
+    return rules
+
+def referencing_columns(table, rules=QUALITY_RULES):
+    # (table, column, referenced column) of every reference rule pointing at table
+    return [(other, column, ref_column) for other, other_rules in rules.items()
+            for column, (ref_table, ref_column) in other_rules.get('references', {}).items() if ref_table == table]
+
+def ranked_source(table, rules=QUALITY_RULES):
+    # The table with rn, the row's rank among the rows sharing its business
+    # key, and KeepKey, the primary key of the row kept; rn is NULL for rows
+    # whose business key is incomplete
+    table_rules = rules[table]
+    keys = PRIMARY_KEYS[table]
+    business_key = table_rules['dedup']
+    defaults = table_rules.get('defaults', {})
+    complete = " AND ".join(f"{column} IS NOT NULL" + (f" AND {column} <> {sql_literal(defaults[column])}"
+                                                       if column in defaults else "")
+                            for column in business_key)
+    window = f"OVER (PARTITION BY {', '.join(business_key)} ORDER BY {', '.join(keys)})"
+    return (f"(SELECT *, CASE WHEN {complete} THEN ROW_NUMBER() {window} END AS rn, "
+            f"FIRST_VALUE({keys[0]}) {window} AS KeepKey FROM {table})")
+
+def delete_rules(table, rules=QUALITY_RULES):
+    # (rule name, condition matching the rows the rule deletes), over the
+    # table aliased s
+    table_rules = rules[table]
+    conditions = []
+    if table_rules.get('dedup'):
+        # merge_duplicates() has re-pointed the references already; a
+        # duplicate still referenced (say, by a row added since) is kept, so
+        # dedup never turns into orphan deletes further down
+        still_used = " AND ".join(f"NOT EXISTS (SELECT 1 FROM {other} o WHERE o.{column} = s.{ref_column})"
+                                  for other, column, ref_column in referencing_columns(table, rules))
+        conditions.append(("duplicates", f"s.rn > 1 AND {still_used}" if still_used else "s.rn > 1"))
+    for column, (ref_table, ref_column) in table_rules.get('references', {}).items():
+        # Anti-join on the referenced key; a NULL reference is not an orphan
+        conditions.append((f"reference {column}", f"s.{column} IS NOT NULL AND NOT EXISTS "
+                                                  f"(SELECT 1 FROM {ref_table} r WHERE r.{ref_column} = s.{column})"))
+    for column, condition in table_rules.get('checks', {}).items():
+        conditions.append((f"check {column}", f"NOT ({condition})"))
+    return conditions
+
+def update_sql(table, table_rules):
+    # One UPDATE applying every column rule; the OUTPUT flags record which
+    # rules each changed row hit
+    rules = update_rules(table_rules)
+    if not rules:
+        return None, []
+    columns = list(dict.fromkeys(list(table_rules.get('defaults', {})) + table_rules.get('trim', [])
+                                 + list(table_rules.get('standardize', {}))))
+    flags = update_rules(table_rules, 'deleted.')
+    sql = f"""
+        SET NOCOUNT ON;
+        DECLARE @affected TABLE ({', '.join(f'r{i} INT' for i in range(len(rules)))});
+        UPDATE {table}
+        SET {', '.join(f'{column} = {column_expression(table_rules, column)}' for column in columns)}
+        OUTPUT {', '.join(f'CASE WHEN {condition} THEN 1 ELSE 0 END' for _, condition in flags)} INTO @affected
+        WHERE {' OR '.join(f'({condition})' for _, condition in rules)};
+        SELECT COUNT(*), {', '.join(f'SUM(r{i})' for i in range(len(rules)))} FROM @affected;
+    """
+    return sql, [name for name, _ in rules]
+
+def rejected_sql(table, rules=QUALITY_RULES):
+    # Collect the keys of every row breaking a row rule into #rejected in one
+    # scan, with a flag per rule; delete_rejected() then removes them
+    conditions = delete_rules(table, rules)
+    if not conditions:
+        return None, []
+    keys = PRIMARY_KEYS[table]
+    source = ranked_source(table, rules) if rules[table].get('dedup') else table
+    sql = f"""
+        SELECT {', '.join(f's.{key}' for key in keys)}, {', '.join(f'CASE WHEN {condition} THEN 1 ELSE 0 END AS r{i}' for i, (_, condition) in enumerate(conditions))}
+        INTO #rejected
+        FROM {source} s
+        WHERE {' OR '.join(f'({condition})' for _, condition in conditions)};
+    """
+    return sql, [name for name, _ in conditions]
+
+def repoint_statements(other, column):
+    # Move other.column off the duplicates in #merged onto the rows kept.
+    # When column is part of other's primary key, rows that would then
+    # collide with a row already there (a playlist holding two copies of a
+    # track) are deleted first.
+    other_keys = PRIMARY_KEYS[other]
+    statements = []
+    if column in other_keys:
+        moved = ", ".join(f"COALESCE(m.KeepKey, o.{key})" if key == column else f"o.{key}" for key in other_keys)
+        join = " AND ".join(f"o.{key} = x.{key}" for key in other_keys)
+        statements.append(f"""
+        WITH moved AS (
+            SELECT {', '.join(f'o.{key}' for key in other_keys)},
+                   ROW_NUMBER() OVER (PARTITION BY {moved}
+                                      ORDER BY CASE WHEN m.DropKey IS NULL THEN 0 ELSE 1 END, o.{column}) AS rn
+            FROM {other} o LEFT JOIN #merged m ON m.DropKey = o.{column})
+        DELETE o FROM {other} o JOIN moved x ON {join} WHERE x.rn > 1
         """)
+    statements.append(f"UPDATE o SET o.{column} = m.KeepKey FROM {other} o JOIN #merged m ON m.DropKey = o.{column}")
+    return statements
+
+def merge_duplicates(cursor, conn, table, rules=QUALITY_RULES):
+    # Re-point every reference rule's column from a duplicate to the row
+    # the dedup keeps, in one transaction, so the duplicates can be deleted.
+    # Returns {'repointed <table>.<column>': rows}.
+    referencing = referencing_columns(table, rules)
+    if not rules[table].get('dedup') or not referencing:
+        return {}
+    cursor.execute(f"""
+        SELECT s.{PRIMARY_KEYS[table][0]} AS DropKey, s.KeepKey INTO #merged
+        FROM {ranked_source(table, rules)} s WHERE s.rn > 1
+    """)
+    counts = {}
+    for other, column, _ in referencing:
+        for statement in repoint_statements(other, column):
+            cursor.execute(statement)
+        counts[f"repointed {other}.{column}"] = max(cursor.rowcount, 0)
+    cursor.execute("DROP TABLE #merged")
+    conn.commit()
+    return counts
+
+def kept_duplicates(cursor, table, rules=QUALITY_RULES):
+    # Duplicates left after the dedup because something still references them
+    cursor.execute(f"SELECT COUNT(*) FROM {ranked_source(table, rules)} s WHERE s.rn > 1")
+    return cursor.fetchone()[0]
+
+def delete_rejected(cursor, conn, table, names, batch_size=DELETE_BATCH_SIZE):
+    # Delete the rows in #rejected batch_size at a time, committing each
+    # batch; returns {rule name: rows}
+    keys = PRIMARY_KEYS[table]
+    join = " AND ".join(f"t.{key} = x.{key}" for key in keys)
+    while True:
+        cursor.execute(f"DELETE TOP ({batch_size}) t FROM {table} t JOIN #rejected x ON {join}")
+        deleted = cursor.rowcount
+        conn.commit()
+        if deleted < batch_size:
+            break
+    cursor.execute(f"SELECT {', '.join(f'SUM(r{i})' for i in range(len(names)))} FROM #rejected")
+    counts = {name: count or 0 for name, count in zip(names, cursor.fetchone())}
+    cursor.execute("DROP TABLE #rejected")
+    return counts
+
+def run_rule_statement(cursor, sql, names):
+    # Execute an update_sql batch; returns the rows it touched and
+    # {rule name: rows}
+    cursor.execute(sql)
+    row = cursor.fetchone()
+    return row[0], {name: count or 0 for name, count in zip(names, row[1:])}
+
+def clean_table(cursor, conn, table, rules=QUALITY_RULES, batch_size=DELETE_BATCH_SIZE):
+    # All rules of one table: the column UPDATE first, so duplicates are
+    # found on cleaned values, then references moved off the duplicates,
+    # then the batched row DELETE. Returns {rule name: rows affected}.
+    report = {}
+    sql, names = update_sql(table, rules[table])
+    if sql is not None:
+        _, counts = run_rule_statement(cursor, sql, names)
+        report.update(counts)
+        conn.commit()
+    report.update(merge_duplicates(cursor, conn, table, rules))
+    sql, names = rejected_sql(table, rules)
+    if sql is not None:
+        cursor.execute(sql)
+        report.update(delete_rejected(cursor, conn, table, names, batch_size))
     conn.commit()
-    print(f"Duplicates removed from {table_name}")
-
-# Function to enforce NOT NULL constraints where necessary
-def enforce_not_null_constraints():
-    not_null_columns = {
-        'Album': ['Title', 'ArtistId'],
-        'Customer': ['FirstName', 'LastName', 'Email'],
-        'Employee': ['LastName', 'FirstName'],
-        'Track': ['Name', 'MediaTypeId', 'Milliseconds', 'UnitPrice']
-    }
-    for table, columns in not_null_columns.items():
-        for column in columns:
-            cursor.execute(f"""
-                UPDATE {table}
-                SET {column} = 'Unknown'
-                WHERE {column} IS NULL;
-            """)
-            conn.commit()
-            print(f"NULL values in {table}.{column} set to 'Unknown'")
-
-# Function to remove inconsistencies based on Foreign Key relationships
-def enforce_foreign_keys():
-    foreign_keys = {
-        'Album': {'ArtistId': 'Artist'},
-        'Customer': {'SupportRepId': 'Employee'},
-        'Invoice': {'CustomerId': 'Customer'},
-        'InvoiceLine': {'InvoiceId': 'Invoice', 'TrackId': 'Track'},
-        'PlaylistTrack': {'PlaylistId': 'Playlist', 'TrackId': 'Track'},
-        'Track': {'AlbumId': 'Album', 'GenreId': 'Genre', 'MediaTypeId': 'MediaType'}
-    }
-    for table, fk_map in foreign_keys.items():
-        for fk_column, ref_table in fk_map.items():
-            cursor.execute(f"""
-                DELETE FROM {table}
-                WHERE {fk_column} NOT IN (SELECT {fk_column} FROM {ref_table});
-            """)
-            conn.commit()
-            print(f"Inconsistent foreign keys removed from {table}.{fk_column}")
-
-# Function to trim and clean up string columns
-def trim_string_columns():
-    string_columns = {
-        'Customer': ['FirstName', 'LastName', 'Company', 'Address', 'City', 'State', 'Country', 'Phone', 'Fax', 'Email'],
-        'Employee': ['LastName', 'FirstName', 'Title', 'Address', 'City', 'State', 'Country', 'Phone', 'Fax', 'Email'],
-        'Track': ['Name', 'Composer']
-    }
-    for table, columns in string_columns.items():
-        for column in columns:
-            cursor.execute(f"""
-                UPDATE {table}
-                SET {column} = RTRIM(LTRIM({column}));
-            """)
-            conn.commit()
-            print(f"Trimmed whitespace from {table}.{column}")
-
-# Function to validate data types and ranges
-def validate_data_types_and_ranges():
-    validation_rules = {
-        'Track': {'Milliseconds': 'Milliseconds > 0', 'UnitPrice': 'UnitPrice >= 0'},
-        'Invoice': {'Total': 'Total >= 0'},
-        'InvoiceLine': {'Quantity': 'Quantity > 0', 'UnitPrice': 'UnitPrice >= 0'}
-    }
-    for table, rules in validation_rules.items():
-        for column, condition in rules.items():
-            cursor.execute(f"""
-                DELETE FROM {table}
-                WHERE NOT ({condition});
-            """)
-            conn.commit()
-            print(f"Invalid data removed from {table}.{column} based on condition: {condition}")
-
-# Function to standardize country names
-def standardize_country_names():
-    country_standardization = {
-        'USA': ['United States', 'US', 'USA'],
-        'UK': ['United Kingdom', 'GB', 'UK']
-    }
-    for standard, variations in country_standardization.items():
-        for variation in variations:
-            cursor.execute(f"""
-                UPDATE Customer
-                SET Country = '{standard}'
-                WHERE Country = '{variation}';
-            """)
-            conn.commit()
-            print(f"Country name '{variation}' standardized to '{standard}'")
-
-# Remove duplicates from each table
-for table in tables:
-    remove_duplicates(table)
-
-# Enforce NOT NULL constraints
-enforce_not_null_constraints()
-
-# Enforce foreign key consistency
-enforce_foreign_keys()
-
-# Trim whitespace from string columns
-trim_string_columns()
-
-# Validate data types and ranges
-validate_data_types_and_ranges()
-
-# Standardize country names
-standardize_country_names()
-
-# Close the connection
-cursor.close()
-conn.close()
-print("Data cleanup completed successfully.")
+    if rules[table].get('dedup'):
+        report['duplicates kept'] = kept_duplicates(cursor, table, rules)
+        if report['duplicates kept']:
+            logging.warning(f"{table}: {report['duplicates kept']} duplicates kept, still referenced")
+    for rule, count in report.items():
+        print(f"{table}: {rule} affected {count} rows")
+    return report
+
+def clean_table_task(connect, table, rules, reports):
+    conn = connect()
+    try:
+        reports[table] = clean_table(conn.cursor(), conn, table, rules)
+    finally:
+        conn.close()
+
+def run_cleanup(connect, rules=QUALITY_RULES, max_workers=CLEANUP_WORKERS):
+    # Clean every table over its own connection, independent tables in
+    # parallel. Returns {table: {rule name: rows affected}}.
+    reports = {}
+    tasks = {table: partial(clean_table_task, connect, table, rules, reports) for table in rules}
+    run_dag(tasks, cleanup_dependencies(rules), max_workers)
+    total = sum(sum(report.values()) for report in reports.values())
+    logging.info(f"Data cleanup: {total} rows affected, "
+                 + ", ".join(f"{table}.{rule}={count}" for table, report in reports.items()
+                             for rule, count in report.items() if count))
+    return reports
+
+def main(max_workers=CLEANUP_WORKERS):
+    connect = partial(pyodbc.connect,
+                      f'DRIVER={{ODBC Driver 17 for SQL Server}};'
+                      f'SERVER={source_server};'
+                      f'DATABASE={source_database};'
+                      'Trusted_Connection=yes;')
+    run_cleanup(connect, max_workers=max_workers)
+    print("Data cleanup completed successfully.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+# Number of finished jobs kept for /jobs/ polling
+JOB_HISTORY = 20
+
+class JobAlreadyRunningError(Exception):
+    def __init__(self, job):
+        super().__init__(f"Job {job.job_id} is already running")
+        self.job = job
+
+class JobProgress:
+    # Per-stage progress of one job. Loader threads call start(), add_rows()
+    # and finish() concurrently; snapshot() is what /jobs/{id} reports.
+
+    def __init__(self, stages=()):
+        self._lock = threading.Lock()
+        self._stages = OrderedDict((name, self._new_stage()) for name in stages)
+
+    @staticmethod
+    def _new_stage():
+        return {"status": "pending", "rows": 0, "started": None, "elapsed": None}
+
+    def start(self, stage):
+        with self._lock:
+            entry = self._stages.setdefault(stage, self._new_stage())
+            entry["status"] = "running"
+            entry["started"] = time.perf_counter()
+
+    def add_rows(self, stage, count):
+        with self._lock:
+            self._stages.setdefault(stage, self._new_stage())["rows"] += count
+
+    def finish(self, stage, failed=False):
+        with self._lock:
+            entry = self._stages.setdefault(stage, self._new_stage())
+            entry["status"] = "failed" if failed else "succeeded"
+            if entry["started"] is not None:
+                entry["elapsed"] = time.perf_counter() - entry["started"]
+
+    def snapshot(self):
+        now = time.perf_counter()
+        with self._lock:
+            stages = {}
+            for name, entry in self._stages.items():
+                elapsed = entry["elapsed"]
+                if elapsed is None and entry["started"] is not None:
+                    elapsed = now - entry["started"]
+                stages[name] = {
+                    "status": entry["status"],
+                    "rows": entry["rows"],
+                    "elapsed": round(elapsed, 3) if elapsed is not None else None,
+                    "rows_per_sec": round(entry["rows"] / elapsed, 1) if elapsed else None,
+                }
+            return stages
+
+class Job:
+    def __init__(self, kind, params, stages=()):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = "queued"
+        self.progress = JobProgress(stages)
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        if self.started_at is None:
+            elapsed = None
+        else:
+            elapsed = ((self.finished_at or datetime.now()) - self.started_at).total_seconds()
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "elapsed": round(elapsed, 3) if elapsed is not None else None,
+            "stages": self.progress.snapshot(),
+            "result": self.result,
+            "error": self.error,
+        }
+
+class JobManager:
+    # Runs background jobs on an executor and keeps them for status polling.
+    # Single-flight: submit() refuses a new job while another is queued or
+    # running, so two refreshes can never interleave.
+
+    def __init__(self, history=JOB_HISTORY):
+        self.history = history
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._active = None
+
+    def submit(self, executor, kind, func, params, stages=()):
+        # func(progress) runs on executor; its return value becomes the result
+        with self._lock:
+            if self._active is not None:
+                raise JobAlreadyRunningError(self._active)
+            job = Job(kind, params, stages)
+            self._active = job
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+        try:
+            executor.submit(self._run, job, func)
+        except Exception:
+            with self._lock:
+                self._active = None
+            raise
+        logging.info(f"Job {job.job_id} ({kind}) submitted with {params}.")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    @property
+    def active(self):
+        return self._active
+
+    def _run(self, job, func):
+        job.status = "running"
+        job.started_at = datetime.now()
+        try:
+            job.result = func(job.progress)
+            job.status = "succeeded"
+            logging.info(f"Job {job.job_id} ({job.kind}) succeeded.")
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+            logging.error(f"Job {job.job_id} ({job.kind}) failed: {e}")
+        finally:
+            job.finished_at = datetime.now()
+            with self._lock:
+                self._active = None
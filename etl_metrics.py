@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+# Where the time of a table load goes. extract, load and commit are measured
+# around the database calls; transform is the rest of the stage's wall time.
+PHASES = ('extract', 'transform', 'load', 'commit')
+
+# Per-table counts. bytes_fetched is estimated from the first row of each
+# fetch, since pyodbc does not expose what went over the wire.
+COUNTERS = ('rows_read', 'rows_written', 'batches', 'round_trips', 'bytes_fetched')
+
+# One JSON run report per refresh or staging run is written here
+REPORT_DIRECTORY = 'etl_reports'
+
+METRIC_PREFIX = 'chinook_etl'
+
+METRIC_HELP = {
+    'seconds': 'Wall time of the stage',
+    'extract': 'Time spent executing and fetching source queries',
+    'transform': 'Time spent in Python between database calls',
+    'load': 'Time spent executing statements against the target',
+    'commit': 'Time spent committing target transactions',
+    'rows_read': 'Rows fetched from the source',
+    'rows_written': 'Rows sent to the target with executemany',
+    'batches': 'executemany batches sent to the target',
+    'round_trips': 'Database round trips',
+    'bytes_fetched': 'Estimated bytes fetched',
+}
+
+def row_bytes(row):
+    return sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row if value is not None)
+
+class MeteredCursor:
+    # Wraps a pyodbc cursor and charges its calls to one table: execute and
+    # fetch time to phase (extract on the source, load on the target),
+    # executemany time to load. Every execute and fetch is one round trip,
+    # an executemany batch is one with fast_executemany and one per row
+    # without it. Everything else is passed through to the cursor.
+
+    def __init__(self, cursor, metrics, table, phase):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._table = table
+        self._phase = phase
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    @property
+    def fast_executemany(self):
+        return self._cursor.fast_executemany
+
+    @fast_executemany.setter
+    def fast_executemany(self, value):
+        self._cursor.fast_executemany = value
+
+    def execute(self, sql, *params):
+        start = time.perf_counter()
+        self._cursor.execute(sql, *params)
+        self._metrics.add(self._table, self._phase, time.perf_counter() - start, round_trips=1)
+        return self
+
+    def executemany(self, sql, rows):
+        # Materialize first so building the rows counts as transform
+        rows = rows if isinstance(rows, list) else list(rows)
+        start = time.perf_counter()
+        self._cursor.executemany(sql, rows)
+        round_trips = 1 if self._cursor.fast_executemany else len(rows)
+        self._metrics.add(self._table, 'load', time.perf_counter() - start,
+                          rows_written=len(rows), batches=1, round_trips=round_trips)
+
+    def _fetched(self, rows, start):
+        read = len(rows) if self._phase == 'extract' else 0
+        self._metrics.add(self._table, self._phase, time.perf_counter() - start, rows_read=read, round_trips=1,
+                          bytes_fetched=row_bytes(rows[0]) * len(rows) if rows else 0)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched([row] if row is not None else [], start)
+        return row
+
+    def fetchmany(self, size):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size)
+        self._fetched(rows, start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched(rows, start)
+        return rows
+
+class MeteredConnection:
+    # Wraps a pyodbc connection: commits are charged to the table's commit
+    # phase and new cursors are metered as target cursors
+
+    def __init__(self, conn, metrics, table):
+        self._conn = conn
+        self._metrics = metrics
+        self._table = table
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self):
+        return MeteredCursor(self._conn.cursor(), self._metrics, self._table, 'load')
+
+    def commit(self):
+        start = time.perf_counter()
+        self._conn.commit()
+        self._metrics.add(self._table, 'commit', time.perf_counter() - start, round_trips=1)
+
+class EtlMetrics:
+    # Process-wide ETL counters per table (or stage): seconds per phase plus
+    # rows, batches, round trips and bytes. Loader threads record
+    # concurrently. Counters only grow, so /metrics exposes them directly
+    # and a run report is the difference of two snapshots.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = OrderedDict()
+        self._runs = {}
+        self._last_runs = {}
+
+    @staticmethod
+    def _new_table():
+        entry = dict.fromkeys(('seconds',) + PHASES, 0.0)
+        entry.update(dict.fromkeys(COUNTERS, 0))
+        return entry
+
+    def add(self, table, phase=None, seconds=0.0, **counts):
+        with self._lock:
+            entry = self._tables.setdefault(table, self._new_table())
+            if phase is not None:
+                entry[phase] += seconds
+            for name, count in counts.items():
+                entry[name] += count
+
+    def table(self, table):
+        with self._lock:
+            return dict(self._tables.get(table) or self._new_table())
+
+    def snapshot(self):
+        with self._lock:
+            return {table: dict(entry) for table, entry in self._tables.items()}
+
+    def merge(self, tables):
+        # Add counters recorded elsewhere, e.g. returned by a worker process
+        with self._lock:
+            for table, counts in tables.items():
+                entry = self._tables.setdefault(table, self._new_table())
+                for name, value in counts.items():
+                    entry[name] += value
+
+    def metered(self, table, source_cursor, target_cursor, target_conn):
+        # (source cursor, target cursor, target connection) charging to table
+        return (MeteredCursor(source_cursor, self, table, 'extract'),
+                MeteredCursor(target_cursor, self, table, 'load'),
+                MeteredConnection(target_conn, self, table))
+
+    @contextmanager
+    def span(self, table):
+        # Time one stage; whatever its metered calls do not account for is transform
+        before = self.table(table)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            after = self.table(table)
+            measured = sum(after[phase] - before[phase] for phase in ('extract', 'load', 'commit'))
+            self.add(table, 'seconds', elapsed)
+            self.add(table, 'transform', max(elapsed - measured, 0.0))
+
+    def record_run(self, kind, status, elapsed):
+        with self._lock:
+            self._runs[(kind, status)] = self._runs.get((kind, status), 0) + 1
+            self._last_runs[kind] = (elapsed, time.time())
+
+    def prometheus(self):
+        # Prometheus text exposition of every counter
+        with self._lock:
+            tables = {table: dict(entry) for table, entry in self._tables.items()}
+            runs = dict(self._runs)
+            last_runs = dict(self._last_runs)
+        lines = []
+        metric = f"{METRIC_PREFIX}_phase_seconds_total"
+        lines += [f"# HELP {metric} Time spent per table and phase", f"# TYPE {metric} counter"]
+        for table, entry in tables.items():
+            for phase in PHASES:
+                lines.append(f"{metric}{labels(table=table, phase=phase)} {entry[phase]:.6f}")
+        for name in ('seconds',) + COUNTERS:
+            metric = f"{METRIC_PREFIX}_stage_seconds_total" if name == 'seconds' else f"{METRIC_PREFIX}_{name}_total"
+            lines += [f"# HELP {metric} {METRIC_HELP[name]}", f"# TYPE {metric} counter"]
+            lines += [f"{metric}{labels(table=table)} {entry[name]}" for table, entry in tables.items()]
+        metric = f"{METRIC_PREFIX}_runs_total"
+        lines += [f"# HELP {metric} Finished runs", f"# TYPE {metric} counter"]
+        lines += [f"{metric}{labels(kind=kind, status=status)} {count}" for (kind, status), count in runs.items()]
+        metric = f"{METRIC_PREFIX}_last_run_seconds"
+        lines += [f"# HELP {metric} Duration of the last run", f"# TYPE {metric} gauge"]
+        lines += [f"{metric}{labels(kind=kind)} {elapsed:.3f}" for kind, (elapsed, _) in last_runs.items()]
+        metric = f"{METRIC_PREFIX}_last_run_timestamp_seconds"
+        lines += [f"# HELP {metric} Unix time the last run finished", f"# TYPE {metric} gauge"]
+        lines += [f"{metric}{labels(kind=kind)} {finished:.0f}" for kind, (_, finished) in last_runs.items()]
+        return "\n".join(lines) + "\n"
+
+def labels(**values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(values, escaped)) + "}"
+
+def prometheus_gauges(prefix, samples):
+    # Render metrics() dicts as gauges; samples is a list of (labels, dict)
+    # and only numeric entries are exposed
+    series = OrderedDict()
+    for label_values, values in samples:
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                rendered = labels(**label_values) if label_values else ''
+                series.setdefault(f"{prefix}_{name}", []).append(f"{prefix}_{name}{rendered} {value}")
+    lines = []
+    for metric, values in series.items():
+        lines += [f"# TYPE {metric} gauge", *values]
+    return "\n".join(lines) + "\n" if lines else ""
+
+# Shared by every loader in this process
+ETL_METRICS = EtlMetrics()
+
+def run_report(kind, before, after, details):
+    # Per-table counters of one run, from snapshots taken before and after it
+    tables = OrderedDict()
+    for table, entry in after.items():
+        previous = before.get(table, {})
+        delta = {name: value - previous.get(name, 0) for name, value in entry.items()}
+        if not any(delta.values()):
+            continue
+        for name in ('seconds',) + PHASES:
+            delta[name] = round(delta[name], 4)
+        delta['rows_per_sec'] = round(delta['rows_written'] / delta['seconds'], 1) if delta['seconds'] else None
+        tables[table] = delta
+    totals = {name: sum(entry[name] for entry in tables.values()) for name in PHASES + COUNTERS}
+    for phase in PHASES:
+        totals[phase] = round(totals[phase], 4)
+    return {'kind': kind, **details, 'totals': totals, 'tables': tables}
+
+def save_report(report, directory=REPORT_DIRECTORY):
+    os.makedirs(directory, exist_ok=True)
+    started = datetime.fromisoformat(report['started_at'])
+    path = os.path.join(directory, f"{report['kind']}_{started:%Y%m%d_%H%M%S}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+    return path
+
+@contextmanager
+def etl_run(kind, metrics=ETL_METRICS, directory=REPORT_DIRECTORY, **params):
+    # Wrap one refresh or staging run: yields a dict the caller can add
+    # details to, and on the way out saves the run report (also when the
+    # run fails) and puts its path under 'report_path'
+    details = {'params': params, 'started_at': datetime.now().isoformat(timespec='seconds')}
+    before = metrics.snapshot()
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        yield details
+        status = 'succeeded'
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.record_run(kind, status, elapsed)
+        details.update(status=status, elapsed=round(elapsed, 3))
+        report = run_report(kind, before, metrics.snapshot(), details)
+        try:
+            details['report_path'] = save_report(report, directory)
+            logging.info(f"{kind} run {status} in {elapsed:.2f}s, report saved to {details['report_path']}")
+        except OSError as e:
+            details['report_path'] = None
+            logging.error(f"Could not save {kind} run report: {e}")
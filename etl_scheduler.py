@@ -0,0 +1,88 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+def topological_order(dependencies):
+    order = []
+    done = set()
+    visiting = set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle detected at task {name}")
+        visiting.add(name)
+        for dependency in dependencies[name]:
+            if dependency not in dependencies:
+                raise ValueError(f"Task {name} depends on unknown task {dependency}")
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in dependencies:
+        visit(name)
+    return order
+
+def critical_path(dependencies, timings):
+    # Longest chain of dependent tasks by wall time; this bounds the run time
+    # no matter how many workers are available
+    finish = {}
+    previous = {}
+    for name in topological_order(dependencies):
+        slowest = max(dependencies[name], key=lambda dependency: finish[dependency], default=None)
+        finish[name] = timings[name] + (finish[slowest] if slowest else 0.0)
+        previous[name] = slowest
+    if not finish:
+        return [], 0.0
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name:
+        path.append(name)
+        name = previous[name]
+    return list(reversed(path)), total
+
+def run_dag(tasks, dependencies, max_workers=4):
+    # Run each task as soon as all of its dependencies have finished.
+    # tasks maps a name to a zero-argument callable, dependencies maps the
+    # same names to the list of task names that must complete first.
+    topological_order(dependencies)
+    pending = dict(dependencies)
+    finished = set()
+    running = {}
+    timings = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            ready = [name for name, deps in pending.items() if all(dep in finished for dep in deps)]
+            for name in ready:
+                del pending[name]
+                running[executor.submit(timed_call, tasks[name])] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                except Exception:
+                    # Let tasks already running finish, but start nothing new
+                    pending.clear()
+                    wait(running)
+                    raise
+                finished.add(name)
+                print(f"Task {name} finished in {timings[name]:.2f}s.")
+
+    elapsed = time.perf_counter() - start
+    path, path_time = critical_path(dependencies, timings)
+    print(f"All tasks finished in {elapsed:.2f}s. Critical path: {' -> '.join(path)} ({path_time:.2f}s).")
+    logging.info(f"DAG run: {elapsed:.2f}s, critical path {' -> '.join(path)} ({path_time:.2f}s), "
+                 + ", ".join(f"{name}={timings[name]:.2f}s" for name in timings))
+    return {'elapsed': elapsed, 'timings': timings, 'critical_path': path, 'critical_path_time': path_time}
+
+def timed_call(task):
+    start = time.perf_counter()
+    task()
+    return time.perf_counter() - start
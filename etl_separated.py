@@ -1,224 +1,423 @@
 import pyodbc
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
+from itertools import islice
+from etl_scheduler import run_dag
+from etl_metrics import ETL_METRICS, MeteredConnection, etl_run
+from olap_aggregates import AGGREGATE_TABLES, build_aggregates
+from olap_schema import disable_for_load, rebuild_after_load
+from etl_shadow import SHADOW_SCHEMA, STAR_TABLES, TARGET_SCHEMA, prepare_shadow_schema, swap_in_shadow
 
 
 import logging
 
-logging.basicConfig(filename='etl_log.log', level=logging.INFO, 
-                    format='%(asctime)s %(levelname)s:%(message)s')
-
-logging.info('ETL process started.')
-
-def truncate_tables(target_cursor, target_conn):
-    print("Deleting data from Dimension and Fact Tables...")
-    tables = ['FactSales', 'DimCustomer', 'DimEmployee', 'DimDate', 'DimTrack', 'DimMediaType', 'DimGenre', 'DimAlbum', 'DimArtist']
-    for table in tables:
-        target_cursor.execute(f"DELETE FROM {table}")
-        print(f"Data deleted from table {table}.")
+# Number of rows fetched per fetchmany() and sent per executemany() round trip;
+# peak memory of a load is bounded by this rather than by the table size
+BATCH_SIZE = 5000
+
+# Natural key -> surrogate key columns of each dimension, shared by every loader
+DIMENSION_KEYS = {
+    'Artist': ('DimArtist', 'ArtistId', 'ArtistKey'),
+    'Album': ('DimAlbum', 'AlbumId', 'AlbumKey'),
+    'Genre': ('DimGenre', 'GenreId', 'GenreKey'),
+    'MediaType': ('DimMediaType', 'MediaTypeId', 'MediaTypeKey'),
+    'Track': ('DimTrack', 'TrackId', 'TrackKey'),
+    'Date': ('DimDate', 'Date', 'DateKey'),
+    'Customer': ('DimCustomer', 'CustomerId', 'CustomerKey'),
+    'Employee': ('DimEmployee', 'EmployeeId', 'EmployeeKey'),
+}
+
+# Number of loads run concurrently by run_etl_parallel()
+LOAD_WORKERS = 4
+
+# Refresh modes: 'incremental' loads only source rows past the stored
+# watermarks, 'full' resets the warehouse and reloads all history, 'shadow'
+# reloads all history into shadow tables and swaps them in when done, so
+# queries never see a partly loaded warehouse
+REFRESH_MODES = ('incremental', 'full', 'shadow')
+
+# Rows removed per DELETE when truncate_tables cannot TRUNCATE
+DELETE_BATCH_SIZE = 50000
+
+# sp_getapplock resource that serializes refreshes of the warehouse
+REFRESH_LOCK = 'ChinookDW4.Refresh'
+
+class RefreshInProgressError(Exception):
+    pass
+
+def truncate_tables(target_cursor, target_conn, reseed=True, schema=TARGET_SCHEMA):
+    # Empty the star schema. The fast path drops the foreign keys between
+    # FactSales and the Dims, TRUNCATEs every table (minimally logged) and
+    # puts the keys back, all in one transaction. Without the rights for that
+    # it falls back to batched DELETEs. reseed restarts the IDENTITY keys at
+    # their seed; otherwise they carry on from where they were.
+    print("Clearing Dimension and Fact Tables...")
+    start = time.perf_counter()
+    identities = None if reseed else current_identities(target_cursor, schema)
+    try:
+        clear_tables_truncate(target_cursor, schema)
+        method = "TRUNCATE"
+    except pyodbc.Error as e:
+        target_conn.rollback()
+        print(f"TRUNCATE not possible ({e}), deleting in batches instead.")
+        logging.warning(f"truncate_tables: TRUNCATE failed, falling back to batched DELETE: {e}")
+        clear_tables_delete(target_cursor, target_conn, schema, reseed)
+        method = "DELETE"
+    if identities is not None:
+        for table, value in identities.items():
+            reseed_identity(target_cursor, table, schema, after=value)
+    # Watermarks describe what is loaded, so they go with the data
+    target_cursor.execute(f"DELETE FROM {schema}.EtlWatermark")
+    target_conn.commit()
+    elapsed = time.perf_counter() - start
+    print(f"Tables cleared with {method} in {elapsed:.2f}s.")
+    logging.info(f"truncate_tables: {method}, {elapsed:.2f}s total")
+
+def identity_state(target_cursor, table, schema=TARGET_SCHEMA):
+    # (seed, increment, last value handed out) of the table's IDENTITY
+    # column; the last value is None while the table has never held a row
+    # and again after a TRUNCATE. None without an IDENTITY column.
+    target_cursor.execute("""
+        SELECT CAST(seed_value AS BIGINT), CAST(increment_value AS BIGINT), CAST(last_value AS BIGINT)
+        FROM sys.identity_columns WHERE object_id = OBJECT_ID(?)
+    """, f"{schema}.{table}")
+    row = target_cursor.fetchone()
+    return tuple(row) if row is not None else None
+
+def current_identities(target_cursor, schema=TARGET_SCHEMA):
+    identities = {}
+    for table in STAR_TABLES:
+        state = identity_state(target_cursor, table, schema)
+        if state is not None and state[2] is not None:
+            identities[table] = state[2]
+    return identities
+
+def reseed_identity(target_cursor, table, schema=TARGET_SCHEMA, after=None):
+    # Make the next key the one following `after`, or the seed when None.
+    # CHECKIDENT RESEED n hands out n itself on a table that has no last
+    # value and n + increment on one that has, like TRUNCATE does.
+    state = identity_state(target_cursor, table, schema)
+    if state is None:
+        return
+    seed, increment, last = state
+    next_value = seed if after is None else after + increment
+    value = next_value if last is None else next_value - increment
+    target_cursor.execute(f"DBCC CHECKIDENT ('{schema}.{table}', RESEED, {value}) WITH NO_INFOMSGS")
+
+def foreign_keys_on(target_cursor, schema, tables):
+    # Foreign keys referencing any of tables, as (name, table, columns,
+    # referenced table, referenced columns, options); read from the catalog
+    # so keys added outside the creation script are restored as well.
+    # options holds the ON DELETE / ON UPDATE actions and whether the key
+    # is disabled or not trusted.
+    placeholders = ", ".join("?" for _ in tables)
+    target_cursor.execute(f"""
+        SELECT fk.name, OBJECT_NAME(fk.parent_object_id) AS TableName,
+               COL_NAME(fkc.parent_object_id, fkc.parent_column_id) AS ColumnName,
+               OBJECT_NAME(fk.referenced_object_id) AS ReferencedTable,
+               COL_NAME(fkc.referenced_object_id, fkc.referenced_column_id) AS ReferencedColumn,
+               fk.delete_referential_action_desc AS OnDelete, fk.update_referential_action_desc AS OnUpdate,
+               fk.is_disabled AS IsDisabled, fk.is_not_trusted AS IsNotTrusted
+        FROM sys.foreign_keys fk
+        JOIN sys.foreign_key_columns fkc ON fkc.constraint_object_id = fk.object_id
+        WHERE OBJECT_SCHEMA_NAME(fk.referenced_object_id) = ?
+          AND OBJECT_NAME(fk.referenced_object_id) IN ({placeholders})
+        ORDER BY fk.name, fkc.constraint_column_id
+    """, schema, *tables)
+    keys = {}
+    for row in target_cursor.fetchall():
+        options = {'on_delete': row.OnDelete.replace('_', ' '), 'on_update': row.OnUpdate.replace('_', ' '),
+                   'disabled': bool(row.IsDisabled), 'trusted': not row.IsNotTrusted}
+        key = keys.setdefault(row.name, (row.TableName, [], row.ReferencedTable, [], options))
+        key[1].append(row.ColumnName)
+        key[3].append(row.ReferencedColumn)
+    return [(name, *key) for name, key in keys.items()]
+
+def clear_tables_truncate(target_cursor, schema=TARGET_SCHEMA):
+    # TRUNCATE refuses tables referenced by a foreign key, even a disabled
+    # one, so the keys are dropped first and recreated on the empty tables.
+    # Not committed here: a failure rolls back to the keys and data as they were.
+    # The keys come back with their referential actions and as disabled or
+    # untrusted as they were.
+    keys = foreign_keys_on(target_cursor, schema, STAR_TABLES)
+    for name, table, _, _, _, _ in keys:
+        target_cursor.execute(f"ALTER TABLE {schema}.{table} DROP CONSTRAINT [{name}]")
+    for table in reversed(STAR_TABLES):
+        start = time.perf_counter()
+        target_cursor.execute(f"TRUNCATE TABLE {schema}.{table}")
+        log_table_cleared(table, "truncated", time.perf_counter() - start)
+    for name, table, columns, referenced, referenced_columns, options in keys:
+        check = "CHECK" if options['trusted'] else "NOCHECK"
+        target_cursor.execute(f"""
+            ALTER TABLE {schema}.{table} WITH {check} ADD CONSTRAINT [{name}]
+            FOREIGN KEY ({', '.join(columns)}) REFERENCES {schema}.{referenced} ({', '.join(referenced_columns)})
+            ON DELETE {options['on_delete']} ON UPDATE {options['on_update']}
+        """)
+        if options['disabled']:
+            target_cursor.execute(f"ALTER TABLE {schema}.{table} NOCHECK CONSTRAINT [{name}]")
+
+def clear_tables_delete(target_cursor, target_conn, schema=TARGET_SCHEMA, reseed=True, batch_size=DELETE_BATCH_SIZE):
+    # Delete in committed batches, referencing tables first, so the log
+    # never has to hold a whole table at once
+    for table in reversed(STAR_TABLES):
+        start = time.perf_counter()
+        while True:
+            target_cursor.execute(f"DELETE TOP ({batch_size}) FROM {schema}.{table}")
+            deleted = target_cursor.rowcount
+            target_conn.commit()
+            if deleted < batch_size:
+                break
+        if reseed:
+            reseed_identity(target_cursor, table, schema)
+            target_conn.commit()
+        log_table_cleared(table, "deleted", time.perf_counter() - start)
+
+def log_table_cleared(table, how, elapsed):
+    print(f"Data {how} from table {table} in {elapsed:.2f}s.")
+    logging.info(f"truncate_tables: {table} {how} in {elapsed:.2f}s")
+
+def create_watermark_table(target_cursor, target_conn, schema=TARGET_SCHEMA):
+    target_cursor.execute(f"""
+        IF OBJECT_ID('{schema}.EtlWatermark', 'U') IS NULL
+        CREATE TABLE {schema}.EtlWatermark (
+            SourceTable NVARCHAR(128) PRIMARY KEY,
+            WatermarkColumn NVARCHAR(128),
+            WatermarkValue BIGINT,
+            UpdatedAt DATETIME
+        )
+    """)
     target_conn.commit()
 
-def load_dim_artist(source_cursor, target_cursor, target_conn):
+def get_watermark(target_cursor, source_table, schema=TARGET_SCHEMA):
+    target_cursor.execute(f"SELECT WatermarkValue FROM {schema}.EtlWatermark WHERE SourceTable = ?", source_table)
+    row = target_cursor.fetchone()
+    return row.WatermarkValue if row else None
+
+def set_watermark(target_cursor, source_table, watermark_column, value, schema=TARGET_SCHEMA):
+    # Not committed here: callers commit it together with the rows it covers
+    target_cursor.execute(f"""
+        UPDATE {schema}.EtlWatermark SET WatermarkColumn = ?, WatermarkValue = ?, UpdatedAt = ?
+        WHERE SourceTable = ?
+    """, watermark_column, value, datetime.now(), source_table)
+    if target_cursor.rowcount == 0:
+        target_cursor.execute(f"""
+            INSERT INTO {schema}.EtlWatermark (SourceTable, WatermarkColumn, WatermarkValue, UpdatedAt)
+            VALUES (?, ?, ?, ?)
+        """, source_table, watermark_column, value, datetime.now())
+
+def fetch_batches(cursor, batch_size=BATCH_SIZE):
+    # Stream the cursor's result set in fetchmany() chunks instead of fetchall()
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+def iter_rows(cursor, batch_size=BATCH_SIZE):
+    for rows in fetch_batches(cursor, batch_size):
+        yield from rows
+
+def insert_batches(target_cursor, target_conn, table, insert_sql, rows, batch_size=BATCH_SIZE, commit=True, progress=None):
+    # Push rows in chunks of batch_size with one executemany() call per chunk
+    # instead of one execute() round trip per row. progress, when given, is
+    # told about every chunk (see etl_jobs.JobProgress).
+    start = time.perf_counter()
+    target_cursor.fast_executemany = True
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        target_cursor.executemany(insert_sql, batch)
+        inserted += len(batch)
+        if progress is not None:
+            progress.add_rows(table, len(batch))
+    if commit:
+        target_conn.commit()
+    elapsed = time.perf_counter() - start
+    rows_per_sec = inserted / elapsed if elapsed > 0 else 0.0
+    print(f"{table} loaded. {inserted} new records inserted in {elapsed:.2f}s ({rows_per_sec:.0f} rows/sec).")
+    logging.info(f"{table}: {inserted} rows in {elapsed:.2f}s ({rows_per_sec:.0f} rows/sec)")
+    return inserted
+
+def insert_dimension_rows(target_cursor, target_conn, mappings, dimension, insert_sql, rows, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
+    # Insert new dimension members, then re-read the dimension's key map in
+    # one query so dependent loaders resolve the new surrogate keys from memory
+    table = DIMENSION_KEYS[dimension][0]
+    inserted = insert_batches(target_cursor, target_conn, table, insert_sql, rows, batch_size, progress=progress)
+    if inserted:
+        refresh_mapping(target_cursor, mappings, dimension, schema)
+    return inserted
+
+def load_dim_artist(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimArtist...")
-    # Fetch existing ArtistIds
-    target_cursor.execute("SELECT ArtistId FROM DimArtist")
-    existing_artist_ids = set(row.ArtistId for row in target_cursor.fetchall())
+    # Natural keys already in the warehouse
+    existing_artist_ids = mappings['Artist']
 
     source_cursor.execute("SELECT ArtistId, Name FROM Artist")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.ArtistId not in existing_artist_ids]
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = ((row.ArtistId, row.Name) for row in rows if row.ArtistId not in existing_artist_ids)
 
-    for row in new_rows:
-        target_cursor.execute("INSERT INTO DimArtist (ArtistId, Name) VALUES (?, ?)", row.ArtistId, row.Name)
-    target_conn.commit()
-    print(f"DimArtist loaded. {len(new_rows)} new records inserted.")
+    return insert_dimension_rows(target_cursor, target_conn, mappings, 'Artist',
+                                 f"INSERT INTO {schema}.DimArtist (ArtistId, Name) VALUES (?, ?)", new_rows, batch_size, progress, schema)
 
-def load_dim_album(source_cursor, target_cursor, target_conn):
+def load_dim_album(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimAlbum...")
-    # Fetch existing AlbumIds
-    target_cursor.execute("SELECT AlbumId FROM DimAlbum")
-    existing_album_ids = set(row.AlbumId for row in target_cursor.fetchall())
+    # Natural keys already in the warehouse
+    existing_album_ids = mappings['Album']
 
     source_cursor.execute("SELECT AlbumId, Title, ArtistId FROM Album")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.AlbumId not in existing_album_ids]
-
-    for row in new_rows:
-        target_cursor.execute("SELECT ArtistKey FROM DimArtist WHERE ArtistId = ?", row.ArtistId)
-        artist_key_row = target_cursor.fetchone()
-        artist_key = artist_key_row.ArtistKey if artist_key_row else None
-        target_cursor.execute("INSERT INTO DimAlbum (AlbumId, Title, ArtistKey) VALUES (?, ?, ?)", row.AlbumId, row.Title, artist_key)
-    target_conn.commit()
-    print(f"DimAlbum loaded. {len(new_rows)} new records inserted.")
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = ((row.AlbumId, row.Title, mappings['Artist'].get(row.ArtistId, None))
+                for row in rows if row.AlbumId not in existing_album_ids)
+
+    return insert_dimension_rows(target_cursor, target_conn, mappings, 'Album',
+                                 f"INSERT INTO {schema}.DimAlbum (AlbumId, Title, ArtistKey) VALUES (?, ?, ?)", new_rows, batch_size, progress, schema)
 
-def load_dim_genre(source_cursor, target_cursor, target_conn):
+def load_dim_genre(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimGenre...")
-    # Fetch existing GenreIds
-    target_cursor.execute("SELECT GenreId FROM DimGenre")
-    existing_genre_ids = set(row.GenreId for row in target_cursor.fetchall())
+    # Natural keys already in the warehouse
+    existing_genre_ids = mappings['Genre']
 
     source_cursor.execute("SELECT GenreId, Name FROM Genre")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.GenreId not in existing_genre_ids]
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = ((row.GenreId, row.Name) for row in rows if row.GenreId not in existing_genre_ids)
 
-    for row in new_rows:
-        target_cursor.execute("INSERT INTO DimGenre (GenreId, Name) VALUES (?, ?)", row.GenreId, row.Name)
-    target_conn.commit()
-    print(f"DimGenre loaded. {len(new_rows)} new records inserted.")
+    return insert_dimension_rows(target_cursor, target_conn, mappings, 'Genre',
+                                 f"INSERT INTO {schema}.DimGenre (GenreId, Name) VALUES (?, ?)", new_rows, batch_size, progress, schema)
 
-def load_dim_mediatype(source_cursor, target_cursor, target_conn):
+def load_dim_mediatype(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimMediaType...")
-    # Fetch existing MediaTypeIds
-    target_cursor.execute("SELECT MediaTypeId FROM DimMediaType")
-    existing_mediatype_ids = set(row.MediaTypeId for row in target_cursor.fetchall())
+    # Natural keys already in the warehouse
+    existing_mediatype_ids = mappings['MediaType']
 
     source_cursor.execute("SELECT MediaTypeId, Name FROM MediaType")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.MediaTypeId not in existing_mediatype_ids]
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = ((row.MediaTypeId, row.Name) for row in rows if row.MediaTypeId not in existing_mediatype_ids)
 
-    for row in new_rows:
-        target_cursor.execute("INSERT INTO DimMediaType (MediaTypeId, Name) VALUES (?, ?)", row.MediaTypeId, row.Name)
-    target_conn.commit()
-    print(f"DimMediaType loaded. {len(new_rows)} new records inserted.")
+    return insert_dimension_rows(target_cursor, target_conn, mappings, 'MediaType',
+                                 f"INSERT INTO {schema}.DimMediaType (MediaTypeId, Name) VALUES (?, ?)", new_rows, batch_size, progress, schema)
 
-def load_dim_track(source_cursor, target_cursor, target_conn):
+def load_dim_track(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimTrack...")
-    # Fetch existing TrackIds
-    target_cursor.execute("SELECT TrackId FROM DimTrack")
-    existing_track_ids = set(row.TrackId for row in target_cursor.fetchall())
+    # Natural keys already in the warehouse
+    existing_track_ids = mappings['Track']
 
     source_cursor.execute("SELECT TrackId, Name, AlbumId, MediaTypeId, GenreId, Composer, Milliseconds, Bytes FROM Track")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.TrackId not in existing_track_ids]
-
-    for row in new_rows:
-        # Get AlbumKey
-        target_cursor.execute("SELECT AlbumKey FROM DimAlbum WHERE AlbumId = ?", row.AlbumId)
-        album_key_row = target_cursor.fetchone()
-        album_key = album_key_row.AlbumKey if album_key_row else None
-
-        # Get MediaTypeKey
-        target_cursor.execute("SELECT MediaTypeKey FROM DimMediaType WHERE MediaTypeId = ?", row.MediaTypeId)
-        mediatype_key_row = target_cursor.fetchone()
-        mediatype_key = mediatype_key_row.MediaTypeKey if mediatype_key_row else None
-
-        # Get GenreKey
-        target_cursor.execute("SELECT GenreKey FROM DimGenre WHERE GenreId = ?", row.GenreId)
-        genre_key_row = target_cursor.fetchone()
-        genre_key = genre_key_row.GenreKey if genre_key_row else None
-
-        target_cursor.execute("""
-            INSERT INTO DimTrack (TrackId, Name, AlbumKey, MediaTypeKey, GenreKey, Composer, Milliseconds, Bytes)
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = ((row.TrackId, row.Name,
+                 mappings['Album'].get(row.AlbumId, None),
+                 mappings['MediaType'].get(row.MediaTypeId, None),
+                 mappings['Genre'].get(row.GenreId, None),
+                 row.Composer, row.Milliseconds, row.Bytes)
+                for row in rows if row.TrackId not in existing_track_ids)
+
+    return insert_dimension_rows(target_cursor, target_conn, mappings, 'Track', f"""
+            INSERT INTO {schema}.DimTrack (TrackId, Name, AlbumKey, MediaTypeKey, GenreKey, Composer, Milliseconds, Bytes)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, row.TrackId, row.Name, album_key, mediatype_key, genre_key, row.Composer, row.Milliseconds, row.Bytes)
-    target_conn.commit()
-    print(f"DimTrack loaded. {len(new_rows)} new records inserted.")
+            """, new_rows, batch_size, progress, schema)
 
-def load_dim_employee(source_cursor, target_cursor, target_conn):
+def load_dim_employee(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimEmployee...")
-    # Fetch existing EmployeeIds
-    target_cursor.execute("SELECT EmployeeId FROM DimEmployee")
-    existing_employee_ids = set(row.EmployeeId for row in target_cursor.fetchall())
+    # Natural keys already in the warehouse
+    existing_employee_ids = mappings['Employee']
 
     source_cursor.execute("SELECT EmployeeId, FirstName, LastName, Title, ReportsTo, HireDate FROM Employee")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.EmployeeId not in existing_employee_ids]
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = ((row.EmployeeId, row.FirstName, row.LastName, row.Title, row.ReportsTo, row.HireDate)
+                for row in rows if row.EmployeeId not in existing_employee_ids)
 
-    for row in new_rows:
-        target_cursor.execute("""
-            INSERT INTO DimEmployee (EmployeeId, FirstName, LastName, Title, ReportsTo, HireDate)
+    return insert_dimension_rows(target_cursor, target_conn, mappings, 'Employee', f"""
+            INSERT INTO {schema}.DimEmployee (EmployeeId, FirstName, LastName, Title, ReportsTo, HireDate)
             VALUES (?, ?, ?, ?, ?, ?)
-        """, row.EmployeeId, row.FirstName, row.LastName, row.Title, row.ReportsTo, row.HireDate)
-    target_conn.commit()
-    print(f"DimEmployee loaded. {len(new_rows)} new records inserted.")
+        """, new_rows, batch_size, progress, schema)
 
-def load_dim_customer(source_cursor, target_cursor, target_conn):
+def load_dim_customer(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimCustomer...")
-    # Fetch existing CustomerIds
-    target_cursor.execute("SELECT CustomerId FROM DimCustomer")
-    existing_customer_ids = set(row.CustomerId for row in target_cursor.fetchall())
+    # Natural keys already in the warehouse
+    existing_customer_ids = mappings['Customer']
 
     source_cursor.execute("""
         SELECT CustomerId, FirstName, LastName, Company, Address, City, State, Country, PostalCode
         FROM Customer
     """)
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.CustomerId not in existing_customer_ids]
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = ((row.CustomerId, row.FirstName, row.LastName, row.Company, row.Address,
+                 row.City, row.State, row.Country, row.PostalCode)
+                for row in rows if row.CustomerId not in existing_customer_ids)
 
-    for row in new_rows:
-        target_cursor.execute("""
-            INSERT INTO DimCustomer (CustomerId, FirstName, LastName, Company, Address, City, State, Country, PostalCode)
+    return insert_dimension_rows(target_cursor, target_conn, mappings, 'Customer', f"""
+            INSERT INTO {schema}.DimCustomer (CustomerId, FirstName, LastName, Company, Address, City, State, Country, PostalCode)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, row.CustomerId, row.FirstName, row.LastName, row.Company, row.Address, row.City, row.State, row.Country, row.PostalCode)
-    target_conn.commit()
-    print(f"DimCustomer loaded. {len(new_rows)} new records inserted.")
+        """, new_rows, batch_size, progress, schema)
+
+def date_row(date_value):
+    day = date_value.day
+    month = date_value.month
+    year = date_value.year
+    quarter = (month - 1) // 3 + 1
+    return (date_value, day, month, year, quarter)
 
-def load_dim_date(source_cursor, target_cursor, target_conn):
+def load_dim_date(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading DimDate...")
-    # Fetch existing Dates
-    target_cursor.execute("SELECT Date FROM DimDate")
-    existing_dates = set(row.Date for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT DISTINCT CAST(InvoiceDate AS DATE) AS Date FROM Invoice")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.Date not in existing_dates]
-
-    for row in new_rows:
-        date_value = row.Date
-        day = date_value.day
-        month = date_value.month
-        year = date_value.year
-        quarter = (month - 1) // 3 + 1
-        target_cursor.execute("""
-            INSERT INTO DimDate (Date, Day, Month, Year, Quarter)
+    # Natural keys already in the warehouse
+    existing_dates = mappings['Date']
+
+    # Only invoices past the watermark can carry dates we have not seen yet;
+    # the upper bound is captured first so rows arriving mid-load wait for the next run
+    last_invoice_id = get_watermark(target_cursor, 'Invoice', schema) or 0
+    source_cursor.execute("SELECT MAX(InvoiceId) FROM Invoice")
+    max_invoice_id = source_cursor.fetchone()[0] or last_invoice_id
+    source_cursor.execute("""
+        SELECT DISTINCT CAST(InvoiceDate AS DATE) AS Date FROM Invoice
+        WHERE InvoiceId > ? AND InvoiceId <= ?
+    """, last_invoice_id, max_invoice_id)
+    rows = iter_rows(source_cursor, batch_size)
+    new_rows = (date_row(row.Date) for row in rows if row.Date not in existing_dates)
+
+    inserted = insert_dimension_rows(target_cursor, target_conn, mappings, 'Date', f"""
+            INSERT INTO {schema}.DimDate (Date, Day, Month, Year, Quarter)
             VALUES (?, ?, ?, ?, ?)
-        """, date_value, day, month, year, quarter)
+        """, new_rows, batch_size, progress, schema)
+    set_watermark(target_cursor, 'Invoice', 'InvoiceId', max_invoice_id, schema)
     target_conn.commit()
-    print(f"DimDate loaded. {len(new_rows)} new records inserted.")
+    return inserted
 
-def build_mappings(target_cursor):
+def refresh_mapping(target_cursor, mappings, dimension, schema=TARGET_SCHEMA):
+    # Bulk re-read one dimension's natural key -> surrogate key pairs
+    table, natural_key, surrogate_key = DIMENSION_KEYS[dimension]
+    target_cursor.execute(f"SELECT {natural_key}, {surrogate_key} FROM {schema}.{table}")
+    mappings[dimension] = {row[0]: row[1] for row in iter_rows(target_cursor)}
+
+def build_mappings(target_cursor, schema=TARGET_SCHEMA):
     print("Building mappings from natural keys to surrogate keys...")
     mappings = {}
-
-    # ArtistId to ArtistKey
-    target_cursor.execute("SELECT ArtistId, ArtistKey FROM DimArtist")
-    mappings['Artist'] = {row.ArtistId: row.ArtistKey for row in target_cursor.fetchall()}
-
-    # AlbumId to AlbumKey
-    target_cursor.execute("SELECT AlbumId, AlbumKey FROM DimAlbum")
-    mappings['Album'] = {row.AlbumId: row.AlbumKey for row in target_cursor.fetchall()}
-
-    # GenreId to GenreKey
-    target_cursor.execute("SELECT GenreId, GenreKey FROM DimGenre")
-    mappings['Genre'] = {row.GenreId: row.GenreKey for row in target_cursor.fetchall()}
-
-    # MediaTypeId to MediaTypeKey
-    target_cursor.execute("SELECT MediaTypeId, MediaTypeKey FROM DimMediaType")
-    mappings['MediaType'] = {row.MediaTypeId: row.MediaTypeKey for row in target_cursor.fetchall()}
-
-    # TrackId to TrackKey
-    target_cursor.execute("SELECT TrackId, TrackKey FROM DimTrack")
-    mappings['Track'] = {row.TrackId: row.TrackKey for row in target_cursor.fetchall()}
-
-    # Date to DateKey
-    target_cursor.execute("SELECT Date, DateKey FROM DimDate")
-    mappings['Date'] = {row.Date: row.DateKey for row in target_cursor.fetchall()}
-
-    # CustomerId to CustomerKey
-    target_cursor.execute("SELECT CustomerId, CustomerKey FROM DimCustomer")
-    mappings['Customer'] = {row.CustomerId: row.CustomerKey for row in target_cursor.fetchall()}
-
-    # EmployeeId to EmployeeKey
-    target_cursor.execute("SELECT EmployeeId, EmployeeKey FROM DimEmployee")
-    mappings['Employee'] = {row.EmployeeId: row.EmployeeKey for row in target_cursor.fetchall()}
-
+    for dimension in DIMENSION_KEYS:
+        refresh_mapping(target_cursor, mappings, dimension, schema)
     print("Mappings built.")
     return mappings
 
-def load_fact_sales(source_cursor, target_cursor, target_conn, mappings):
+def load_fact_sales(source_cursor, target_cursor, target_conn, mappings, batch_size=BATCH_SIZE, progress=None, schema=TARGET_SCHEMA):
     print("Loading FactSales...")
-    # Fetch existing InvoiceLineIds
-    target_cursor.execute("SELECT InvoiceLineId FROM FactSales")
-    existing_invoice_line_ids = set(row.InvoiceLineId for row in target_cursor.fetchall())
+    # Resume after the last loaded InvoiceLineId. A warehouse loaded before
+    # watermarks existed falls back to the highest InvoiceLineId in FactSales.
+    last_invoice_line_id = get_watermark(target_cursor, 'InvoiceLine', schema)
+    if last_invoice_line_id is None:
+        target_cursor.execute(f"SELECT MAX(InvoiceLineId) FROM {schema}.FactSales")
+        last_invoice_line_id = target_cursor.fetchone()[0] or 0
+    # Upper bound captured first: the last line of the invoices DimDate has
+    # seen (every line without a watermark), so lines arriving mid-load wait
+    # for the next run instead of missing their date
+    last_invoice_id = get_watermark(target_cursor, 'Invoice', schema)
+    if last_invoice_id is None:
+        source_cursor.execute("SELECT MAX(InvoiceLineId) FROM InvoiceLine")
+    else:
+        source_cursor.execute("SELECT MAX(InvoiceLineId) FROM InvoiceLine WHERE InvoiceId <= ?", last_invoice_id)
+    max_invoice_line_id = source_cursor.fetchone()[0] or last_invoice_line_id
+    print(f"Fetching invoice lines after InvoiceLineId {last_invoice_line_id} up to {max_invoice_line_id}...")
 
     source_cursor.execute("""
     SELECT il.InvoiceLineId, il.InvoiceId, il.TrackId, il.Quantity, il.UnitPrice,
@@ -229,73 +428,258 @@ def load_fact_sales(source_cursor, target_cursor, target_conn, mappings):
     JOIN Invoice i ON il.InvoiceId = i.InvoiceId
     JOIN Track t ON il.TrackId = t.TrackId
     JOIN Customer c ON i.CustomerId = c.CustomerId
-    """)
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.InvoiceLineId not in existing_invoice_line_ids]
-
-    for row in new_rows:
-        InvoiceLineId = row.InvoiceLineId
-        InvoiceDate = row.InvoiceDate.date()
-        DateKey = mappings['Date'].get(InvoiceDate, None)
-        CustomerKey = mappings['Customer'].get(row.CustomerId, None)
-        TrackKey = mappings['Track'].get(row.TrackId, None)
-        AlbumKey = mappings['Album'].get(row.AlbumId, None)
-        GenreKey = mappings['Genre'].get(row.GenreId, None)
-        MediaTypeKey = mappings['MediaType'].get(row.MediaTypeId, None)
-        EmployeeKey = mappings['Employee'].get(row.SupportRepId, None)
-        Quantity = row.Quantity
-        UnitPrice = row.UnitPrice
-        TotalAmount = Quantity * UnitPrice
-
-        target_cursor.execute("""
-            INSERT INTO FactSales (InvoiceLineId, DateKey, CustomerKey, TrackKey, AlbumKey, GenreKey, MediaTypeKey, EmployeeKey, Quantity, UnitPrice, TotalAmount)
+    WHERE il.InvoiceLineId > ? AND il.InvoiceLineId <= ?
+    ORDER BY il.InvoiceLineId
+    """, last_invoice_line_id, max_invoice_line_id)
+    rows = iter_rows(source_cursor, batch_size)
+
+    # Transform each fetched batch as it streams through; the highest
+    # InvoiceLineId loaded becomes the new watermark. A line whose natural
+    # key has no surrogate key yet (its dimension row arrived after that
+    # dimension was loaded) stops the load there, so the watermark never
+    # passes it and the next run picks it up with its keys resolved.
+    high_watermark = [last_invoice_line_id]
+    def lookup(dimension, natural_key):
+        if natural_key is None:
+            return None
+        key = mappings[dimension].get(natural_key)
+        if key is None:
+            raise LookupError(f"{dimension} {natural_key!r}")
+        return key
+
+    def fact_rows():
+        for row in rows:
+            InvoiceLineId = row.InvoiceLineId
+            try:
+                DateKey = lookup('Date', row.InvoiceDate.date())
+                CustomerKey = lookup('Customer', row.CustomerId)
+                TrackKey = lookup('Track', row.TrackId)
+                AlbumKey = lookup('Album', row.AlbumId)
+                GenreKey = lookup('Genre', row.GenreId)
+                MediaTypeKey = lookup('MediaType', row.MediaTypeId)
+                EmployeeKey = lookup('Employee', row.SupportRepId)
+            except LookupError as e:
+                print(f"InvoiceLineId {InvoiceLineId} has no surrogate key for {e}, stopping FactSales here.")
+                logging.warning(f"load_fact_sales: stopped before InvoiceLineId {InvoiceLineId}, "
+                                f"no surrogate key for {e}")
+                return
+            Quantity = row.Quantity
+            UnitPrice = row.UnitPrice
+            TotalAmount = Quantity * UnitPrice
+            high_watermark[0] = max(high_watermark[0], InvoiceLineId)
+
+            yield (InvoiceLineId, DateKey, CustomerKey, TrackKey, AlbumKey, GenreKey,
+                   MediaTypeKey, EmployeeKey, Quantity, UnitPrice, TotalAmount)
+
+    inserted = insert_batches(target_cursor, target_conn, "FactSales", f"""
+            INSERT INTO {schema}.FactSales (InvoiceLineId, DateKey, CustomerKey, TrackKey, AlbumKey, GenreKey, MediaTypeKey, EmployeeKey, Quantity, UnitPrice, TotalAmount)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, InvoiceLineId, DateKey, CustomerKey, TrackKey, AlbumKey, GenreKey, MediaTypeKey, EmployeeKey, Quantity, UnitPrice, TotalAmount)
+        """, fact_rows(), batch_size, commit=False, progress=progress)
+    # Advance the watermark in the same transaction as the fact rows
+    if inserted:
+        set_watermark(target_cursor, 'InvoiceLine', 'InvoiceLineId', high_watermark[0], schema)
     target_conn.commit()
-    print(f"FactSales loaded. {len(new_rows)} new records inserted.")
-
-def main():
+    return inserted
+
+def run_etl(source_cursor, target_cursor, target_conn, batch_size=BATCH_SIZE, mode='incremental'):
+    if mode not in REFRESH_MODES:
+        raise ValueError(f"Unknown refresh mode '{mode}', expected one of {REFRESH_MODES}")
+    schema = load_schema(mode)
+    with etl_run('refresh', mode=mode, batch_size=batch_size, max_workers=1):
+        if mode == 'shadow':
+            prepare_shadow_schema(target_cursor, target_conn, shadow_tables())
+        create_watermark_table(target_cursor, target_conn, schema)
+        if mode == 'full':
+            truncate_tables(target_cursor, target_conn)
+            disable_for_load(target_cursor, target_conn)
+
+        # Load the surrogate key mappings once; each loader keeps them current
+        mappings = build_mappings(target_cursor, schema)
+
+        # Load dimension tables, then FactSales, each metered under its table name
+        for name, loader in LOADERS.items():
+            with ETL_METRICS.span(name):
+                loader(*ETL_METRICS.metered(name, source_cursor, target_cursor, target_conn),
+                       mappings, batch_size, schema=schema)
+
+        # Compress the new facts and bring the indexes back before the rollups read them
+        rebuild_after_load(target_cursor, target_conn, schema, full=mode != 'incremental')
+
+        # Rebuild the rollup tables from the new facts
+        build_aggregates(target_cursor, target_conn, schema=schema)
+
+        if mode == 'shadow':
+            swap_in_shadow(target_cursor, target_conn, shadow_tables())
+
+def load_schema(mode):
+    # Schema the loaders write to for a refresh mode
+    return SHADOW_SCHEMA if mode == 'shadow' else TARGET_SCHEMA
+
+def shadow_tables():
+    # Everything a shadow load builds, swapped into dbo together
+    return STAR_TABLES + ['EtlWatermark'] + [aggregate['name'] for aggregate in AGGREGATE_TABLES] + ['AggregateCatalog']
+
+# Loads that must finish before each table can be loaded
+LOAD_DEPENDENCIES = {
+    'DimArtist': [],
+    'DimAlbum': ['DimArtist'],
+    'DimGenre': [],
+    'DimMediaType': [],
+    'DimTrack': ['DimAlbum', 'DimGenre', 'DimMediaType'],
+    'DimEmployee': [],
+    'DimCustomer': [],
+    'DimDate': [],
+    'FactSales': ['DimArtist', 'DimAlbum', 'DimGenre', 'DimMediaType', 'DimTrack', 'DimEmployee', 'DimCustomer', 'DimDate'],
+}
+
+LOADERS = {
+    'DimArtist': load_dim_artist,
+    'DimAlbum': load_dim_album,
+    'DimGenre': load_dim_genre,
+    'DimMediaType': load_dim_mediatype,
+    'DimTrack': load_dim_track,
+    'DimEmployee': load_dim_employee,
+    'DimCustomer': load_dim_customer,
+    'DimDate': load_dim_date,
+    'FactSales': load_fact_sales,
+}
+
+def run_loader(name, connect_source, connect_target, mappings, batch_size, progress=None, schema=TARGET_SCHEMA):
+    # Each task works on its own source and target connections, metered
+    # under the table's name
+    source_conn = connect_source()
+    target_conn = connect_target()
+    try:
+        source_cursor, target_cursor, metered_conn = ETL_METRICS.metered(name, source_conn.cursor(),
+                                                                         target_conn.cursor(), target_conn)
+        return LOADERS[name](source_cursor, target_cursor, metered_conn, mappings, batch_size, progress, schema)
+    finally:
+        source_conn.close()
+        target_conn.close()
+
+@contextmanager
+def refresh_lock(connect_target):
+    # Database-wide single-flight lock held for the whole refresh, so runs
+    # started from other processes (the CLI, other API workers) cannot
+    # interleave a truncate with a load. Closing the session releases it.
+    conn = connect_target()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SET NOCOUNT ON;
+            DECLARE @result INT;
+            EXEC @result = sp_getapplock @Resource = ?, @LockMode = 'Exclusive', @LockOwner = 'Session', @LockTimeout = 0;
+            SELECT @result;
+        """, REFRESH_LOCK)
+        if cursor.fetchone()[0] < 0:
+            raise RefreshInProgressError("Another refresh of the warehouse is already running")
+        yield
+    finally:
+        conn.close()
+
+def run_etl_parallel(connect_source, connect_target, batch_size=BATCH_SIZE, mode='incremental', max_workers=LOAD_WORKERS, progress=None):
+    # Same loads as run_etl(), but independent tables are loaded concurrently.
+    # progress, when given, receives stage start/finish and row counts. The
+    # run report (see etl_metrics) is saved whether or not the run succeeds;
+    # its path is returned under 'run_report'.
+    if mode not in REFRESH_MODES:
+        raise ValueError(f"Unknown refresh mode '{mode}', expected one of {REFRESH_MODES}")
+    schema = load_schema(mode)
+    with refresh_lock(connect_target), \
+            etl_run('refresh', mode=mode, batch_size=batch_size, max_workers=max_workers) as run:
+        mappings = run_stage(progress, 'prepare', prepare_load, connect_target, mode)
+
+        tasks = {name: partial(run_stage, progress, name, run_loader, name, connect_source, connect_target,
+                               mappings, batch_size, progress, schema)
+                 for name in LOADERS}
+        report = run_dag(tasks, LOAD_DEPENDENCIES, max_workers)
+        run.update(task_times=report['timings'], critical_path=report['critical_path'],
+                   critical_path_time=report['critical_path_time'])
+
+        # Compress the new facts and bring the indexes back before the rollups read them
+        run_stage(progress, 'indexes', finish_indexes, connect_target, mode)
+
+        # Rebuild the rollup tables from the new facts
+        run_stage(progress, 'aggregates', rebuild_aggregates, connect_target, schema)
+
+        if mode == 'shadow':
+            run_stage(progress, 'swap', swap_shadow, connect_target)
+    report['run_report'] = run['report_path']
+    return report
+
+def prepare_load(connect_target, mode):
+    schema = load_schema(mode)
+    target_conn = MeteredConnection(connect_target(), ETL_METRICS, 'prepare')
+    try:
+        target_cursor = target_conn.cursor()
+        if mode == 'shadow':
+            prepare_shadow_schema(target_cursor, target_conn, shadow_tables())
+        create_watermark_table(target_cursor, target_conn, schema)
+        if mode == 'full':
+            truncate_tables(target_cursor, target_conn)
+            disable_for_load(target_cursor, target_conn)
+        return build_mappings(target_cursor, schema)
+    finally:
+        target_conn.close()
+
+def finish_indexes(connect_target, mode):
+    target_conn = MeteredConnection(connect_target(), ETL_METRICS, 'indexes')
+    try:
+        return rebuild_after_load(target_conn.cursor(), target_conn, load_schema(mode), full=mode != 'incremental')
+    finally:
+        target_conn.close()
+
+def rebuild_aggregates(connect_target, schema=TARGET_SCHEMA):
+    target_conn = MeteredConnection(connect_target(), ETL_METRICS, 'aggregates')
+    try:
+        build_aggregates(target_conn.cursor(), target_conn, schema=schema)
+    finally:
+        target_conn.close()
+
+def swap_shadow(connect_target):
+    target_conn = MeteredConnection(connect_target(), ETL_METRICS, 'swap')
+    try:
+        swap_in_shadow(target_conn.cursor(), target_conn, shadow_tables())
+    finally:
+        target_conn.close()
+
+def run_stage(progress, name, func, *args):
+    # Run one stage of the refresh as an ETL_METRICS span, reporting it to
+    # progress if there is one
+    with ETL_METRICS.span(name):
+        if progress is None:
+            return func(*args)
+        progress.start(name)
+        try:
+            result = func(*args)
+        except Exception:
+            progress.finish(name, failed=True)
+            raise
+        progress.finish(name)
+        return result
+
+def main(batch_size=BATCH_SIZE, max_workers=LOAD_WORKERS):
     # Database connection parameters
     source_server = 'DPC2023'
     source_database = 'Chinook'
     target_server = 'DPC2023'
     target_database = 'ChinookDW4'
 
-    # Connect to source and target databases
-    source_conn = pyodbc.connect('DRIVER={ODBC Driver 17 for SQL Server};SERVER='+source_server+';DATABASE='+source_database+';Trusted_Connection=yes;')
-    target_conn = pyodbc.connect('DRIVER={ODBC Driver 17 for SQL Server};SERVER='+target_server+';DATABASE='+target_database+';Trusted_Connection=yes;')
-
-    source_cursor = source_conn.cursor()
-    target_cursor = target_conn.cursor()
+    # Connection factories; every load task opens its own connections
+    connect_source = partial(pyodbc.connect, 'DRIVER={ODBC Driver 17 for SQL Server};SERVER='+source_server+';DATABASE='+source_database+';Trusted_Connection=yes;')
+    connect_target = partial(pyodbc.connect, 'DRIVER={ODBC Driver 17 for SQL Server};SERVER='+target_server+';DATABASE='+target_database+';Trusted_Connection=yes;')
 
-    # Prompt user to reset DW
+    # Prompt user to reset DW; otherwise only new source rows are loaded
     reset_dw = input("Do you want to reset the Data Warehouse? (yes/no): ").lower()
-    if reset_dw == 'yes':
-        truncate_tables(target_cursor, target_conn)
-
-    # Load dimension tables
-    load_dim_artist(source_cursor, target_cursor, target_conn)
-    load_dim_album(source_cursor, target_cursor, target_conn)
-    load_dim_genre(source_cursor, target_cursor, target_conn)
-    load_dim_mediatype(source_cursor, target_cursor, target_conn)
-    load_dim_track(source_cursor, target_cursor, target_conn)
-    load_dim_employee(source_cursor, target_cursor, target_conn)
-    load_dim_customer(source_cursor, target_cursor, target_conn)
-    load_dim_date(source_cursor, target_cursor, target_conn)
-
-    # Build mappings
-    mappings = build_mappings(target_cursor)
-
-    # Load FactSales
-    load_fact_sales(source_cursor, target_cursor, target_conn, mappings)
-
-    # Close connections
-    source_cursor.close()
-    target_cursor.close()
-    source_conn.close()
-    target_conn.close()
+    mode = 'full' if reset_dw == 'yes' else 'incremental'
+
+    # Load dimension and fact tables in batches, independent tables concurrently
+    run_etl_parallel(connect_source, connect_target, batch_size, mode, max_workers)
     print("ETL process completed.")
 
 if __name__ == "__main__":
+    logging.basicConfig(filename='etl_log.log', level=logging.INFO, 
+                        format='%(asctime)s %(levelname)s:%(message)s')
+    logging.info('ETL process started.')
     main()
     logging.info('ETL process completed successfully.')
@@ -0,0 +1,90 @@
+import logging
+import time
+
+# Zero-downtime refresh: the load runs into empty copies of the star schema in
+# SHADOW_SCHEMA while queries keep reading dbo, then one transaction moves the
+# live tables to RETIRED_SCHEMA and the shadow tables into dbo.
+TARGET_SCHEMA = 'dbo'
+SHADOW_SCHEMA = 'etl_shadow'
+RETIRED_SCHEMA = 'etl_retired'
+
+# Star schema tables, referenced tables before the tables referencing them
+STAR_TABLES = ['DimArtist', 'DimAlbum', 'DimGenre', 'DimMediaType', 'DimTrack',
+               'DimEmployee', 'DimCustomer', 'DimDate', 'FactSales']
+
+PRIMARY_KEYS = {
+    'DimArtist': 'ArtistKey',
+    'DimAlbum': 'AlbumKey',
+    'DimGenre': 'GenreKey',
+    'DimMediaType': 'MediaTypeKey',
+    'DimTrack': 'TrackKey',
+    'DimEmployee': 'EmployeeKey',
+    'DimCustomer': 'CustomerKey',
+    'DimDate': 'DateKey',
+    'FactSales': 'SalesKey',
+}
+
+# (table, column, referenced table) as declared in script_ChinookDW4_creation.sql
+FOREIGN_KEYS = [
+    ('DimAlbum', 'ArtistKey', 'DimArtist'),
+    ('FactSales', 'DateKey', 'DimDate'),
+    ('FactSales', 'CustomerKey', 'DimCustomer'),
+    ('FactSales', 'TrackKey', 'DimTrack'),
+    ('FactSales', 'AlbumKey', 'DimAlbum'),
+    ('FactSales', 'GenreKey', 'DimGenre'),
+    ('FactSales', 'MediaTypeKey', 'DimMediaType'),
+    ('FactSales', 'EmployeeKey', 'DimEmployee'),
+]
+
+def ensure_schema(target_cursor, schema):
+    target_cursor.execute(f"IF SCHEMA_ID('{schema}') IS NULL EXEC('CREATE SCHEMA {schema}')")
+
+def drop_tables(target_cursor, schema, tables):
+    # Referencing tables first so foreign keys never block a drop
+    for table in reversed(tables):
+        target_cursor.execute(f"IF OBJECT_ID('{schema}.{table}', 'U') IS NOT NULL DROP TABLE {schema}.{table}")
+
+def prepare_shadow_schema(target_cursor, target_conn, tables):
+    # Clear whatever an earlier, unfinished shadow load left in `tables`,
+    # then recreate empty copies of the star tables. SELECT TOP 0 INTO keeps
+    # column types and IDENTITY; keys are added back after.
+    print(f"Preparing shadow tables in schema {SHADOW_SCHEMA}...")
+    ensure_schema(target_cursor, SHADOW_SCHEMA)
+    drop_tables(target_cursor, SHADOW_SCHEMA, tables)
+    for table in STAR_TABLES:
+        target_cursor.execute(f"SELECT TOP 0 * INTO {SHADOW_SCHEMA}.{table} FROM {TARGET_SCHEMA}.{table}")
+        target_cursor.execute(f"ALTER TABLE {SHADOW_SCHEMA}.{table} ADD PRIMARY KEY ({PRIMARY_KEYS[table]})")
+    for table, column, referenced in FOREIGN_KEYS:
+        target_cursor.execute(f"""
+            ALTER TABLE {SHADOW_SCHEMA}.{table}
+            ADD FOREIGN KEY ({column}) REFERENCES {SHADOW_SCHEMA}.{referenced}({PRIMARY_KEYS[referenced]})
+        """)
+    target_conn.commit()
+
+def swap_in_shadow(target_cursor, target_conn, tables):
+    # Move every shadow table into dbo in one transaction. ALTER SCHEMA
+    # TRANSFER only changes metadata, so readers are blocked for the length
+    # of the swap, not the load.
+    ensure_schema(target_cursor, RETIRED_SCHEMA)
+    drop_tables(target_cursor, RETIRED_SCHEMA, tables)
+    target_conn.commit()
+
+    start = time.perf_counter()
+    try:
+        for table in tables:
+            target_cursor.execute(f"""
+                IF OBJECT_ID('{TARGET_SCHEMA}.{table}', 'U') IS NOT NULL
+                ALTER SCHEMA {RETIRED_SCHEMA} TRANSFER {TARGET_SCHEMA}.{table}
+            """)
+            target_cursor.execute(f"ALTER SCHEMA {TARGET_SCHEMA} TRANSFER {SHADOW_SCHEMA}.{table}")
+        target_conn.commit()
+    except Exception:
+        target_conn.rollback()
+        raise
+    elapsed = time.perf_counter() - start
+    print(f"Shadow tables swapped in. {len(tables)} tables in {elapsed:.3f}s.")
+    logging.info(f"Shadow swap: {len(tables)} tables in {elapsed:.3f}s")
+
+    # The previous generation is no longer visible to queries
+    drop_tables(target_cursor, RETIRED_SCHEMA, tables)
+    target_conn.commit()
@@ -1,7 +1,82 @@
+import os
 import pyodbc
+import numpy as np
+import pandas as pd
 from faker import Faker
-import random
-from datetime import datetime, timedelta
+from datetime import date
+from etl_separated import BATCH_SIZE
+
+# Optional Parquet output needs pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Rows generated per table at scale factor 1. Everything but the Genre and
+# MediaType lookups grows linearly with the scale factor, so SF100 writes
+# 25M invoice lines.
+SCALE_FACTOR_ROWS = {
+    'Artist': 1000,
+    'Album': 2000,
+    'Track': 20000,
+    'Employee': 20,
+    'Customer': 5000,
+    'Invoice': 50000,
+    'InvoiceLine': 250000,
+    'Playlist': 100,
+    'PlaylistTrack': 20000,
+}
+SCALE_FACTORS = (1, 10, 100)
+
+GENRES = ['Rock', 'Jazz', 'Metal', 'Alternative & Punk', 'Rock And Roll', 'Blues', 'Latin', 'Reggae', 'Pop',
+          'Soundtrack', 'Bossa Nova', 'Easy Listening', 'Heavy Metal', 'R&B/Soul', 'Electronica/Dance', 'World',
+          'Hip Hop/Rap', 'Science Fiction', 'TV Shows', 'Sci Fi & Fantasy', 'Drama', 'Comedy', 'Alternative',
+          'Classical', 'Opera']
+MEDIA_TYPES = ['MPEG audio file', 'Protected AAC audio file', 'Protected MPEG-4 video file',
+               'Purchased AAC audio file', 'AAC audio file']
+EMPLOYEE_TITLES = ['Sales Manager', 'Sales Support Agent', 'IT Manager', 'IT Staff']
+
+# Columns written per table, in the order tables must be loaded
+TABLE_COLUMNS = {
+    'Artist': ['ArtistId', 'Name'],
+    'Genre': ['GenreId', 'Name'],
+    'MediaType': ['MediaTypeId', 'Name'],
+    'Album': ['AlbumId', 'Title', 'ArtistId'],
+    'Track': ['TrackId', 'Name', 'AlbumId', 'MediaTypeId', 'GenreId', 'Composer', 'Milliseconds', 'Bytes', 'UnitPrice'],
+    'Employee': ['EmployeeId', 'LastName', 'FirstName', 'Title', 'ReportsTo', 'BirthDate', 'HireDate',
+                 'Address', 'City', 'State', 'Country', 'PostalCode', 'Phone', 'Fax', 'Email'],
+    'Customer': ['CustomerId', 'FirstName', 'LastName', 'Company', 'Address', 'City', 'State',
+                 'Country', 'PostalCode', 'Phone', 'Fax', 'Email', 'SupportRepId'],
+    'Invoice': ['InvoiceId', 'CustomerId', 'InvoiceDate', 'BillingAddress', 'BillingCity',
+                'BillingState', 'BillingCountry', 'BillingPostalCode', 'Total'],
+    'InvoiceLine': ['InvoiceLineId', 'InvoiceId', 'TrackId', 'UnitPrice', 'Quantity'],
+    'Playlist': ['PlaylistId', 'Name'],
+    'PlaylistTrack': ['PlaylistId', 'TrackId'],
+}
+ID_COLUMNS = {table: columns[0] for table, columns in TABLE_COLUMNS.items() if table != 'PlaylistTrack'}
+
+OUTPUT_FORMATS = ('database', 'csv', 'parquet')
+
+# Distinct values drawn from Faker per text pool; rows then pick from the
+# pools with the RNG, so Faker is only called a few thousand times per run
+POOL_SIZE = 2000
+
+# Invoices (with their lines) generated and written per batch
+INVOICE_BATCH = 100000
+
+# Track popularity follows Zipf's law: the k-th most popular track sells
+# in proportion to 1 / k ** TRACK_POPULARITY_EXPONENT
+TRACK_POPULARITY_EXPONENT = 1.1
+
+# Invoice dates span this many years up to END_DATE, weighted by month (a
+# holiday peak in November and December, a January slump) and weekday.
+# END_DATE is fixed so the same seed always generates the same data.
+INVOICE_YEARS = 5
+END_DATE = date(2024, 12, 31)
+MONTH_WEIGHTS = [0.8, 0.85, 0.95, 0.95, 1.0, 1.0, 1.0, 1.0, 0.95, 1.05, 1.3, 1.6]
+WEEKDAY_WEIGHTS = [0.9, 0.9, 0.95, 1.0, 1.1, 1.25, 1.2]
 
 def connect_to_db(server, database):
     conn = pyodbc.connect(
@@ -17,248 +92,380 @@ def truncate_string(value, max_length):
         return None
     return value[:max_length]
 
-def insert_artists(cursor, num_records):
-    print(f"Inserting {num_records} artists...")
-    faker = Faker()
-    artist_ids = []
-    for _ in range(num_records):
-        name = truncate_string(faker.name(), 120)  # NVARCHAR(120)
-        cursor.execute("SELECT MAX(ArtistId) FROM Artist")
-        max_id_row = cursor.fetchone()
-        artist_id = (max_id_row[0] or 0) + 1
-        cursor.execute("INSERT INTO Artist (ArtistId, Name) VALUES (?, ?)", artist_id, name)
-        artist_ids.append(artist_id)
-    return artist_ids
-
-def insert_albums(cursor, artist_ids, num_records):
-    print(f"Inserting {num_records} albums...")
-    faker = Faker()
-    album_ids = []
-    for _ in range(num_records):
-        title = truncate_string(faker.sentence(nb_words=3), 160)  # NVARCHAR(160)
-        artist_id = random.choice(artist_ids)
-        cursor.execute("SELECT MAX(AlbumId) FROM Album")
-        max_id_row = cursor.fetchone()
-        album_id = (max_id_row[0] or 0) + 1
-        cursor.execute("INSERT INTO Album (AlbumId, Title, ArtistId) VALUES (?, ?, ?)", album_id, title, artist_id)
-        album_ids.append(album_id)
-    return album_ids
-
-def insert_genres(cursor, num_records):
-    print(f"Inserting {num_records} genres...")
-    faker = Faker()
-    genre_ids = []
-    for _ in range(num_records):
-        name = truncate_string(faker.word().capitalize(), 120)  # NVARCHAR(120)
-        cursor.execute("SELECT MAX(GenreId) FROM Genre")
-        max_id_row = cursor.fetchone()
-        genre_id = (max_id_row[0] or 0) + 1
-        cursor.execute("INSERT INTO Genre (GenreId, Name) VALUES (?, ?)", genre_id, name)
-        genre_ids.append(genre_id)
-    return genre_ids
-
-def insert_mediatypes(cursor, num_records):
-    print(f"Inserting {num_records} media types...")
-    faker = Faker()
-    mediatype_ids = []
-    for _ in range(num_records):
-        name = truncate_string(faker.word().capitalize(), 120)  # NVARCHAR(120)
-        cursor.execute("SELECT MAX(MediaTypeId) FROM MediaType")
-        max_id_row = cursor.fetchone()
-        mediatype_id = (max_id_row[0] or 0) + 1
-        cursor.execute("INSERT INTO MediaType (MediaTypeId, Name) VALUES (?, ?)", mediatype_id, name)
-        mediatype_ids.append(mediatype_id)
-    return mediatype_ids
-
-def insert_tracks(cursor, album_ids, genre_ids, mediatype_ids, num_records):
-    print(f"Inserting {num_records} tracks...")
-    faker = Faker()
-    track_ids = []
-    for _ in range(num_records):
-        name = truncate_string(faker.sentence(nb_words=4), 200)  # NVARCHAR(200)
-        album_id = random.choice(album_ids)
-        mediatype_id = random.choice(mediatype_ids)
-        genre_id = random.choice(genre_ids)
-        composer = truncate_string(faker.name(), 220)  # NVARCHAR(220)
-        milliseconds = random.randint(60000, 300000)
-        bytes_size = milliseconds * random.randint(50, 150)
-        unit_price = round(random.uniform(0.99, 1.99), 2)
-        cursor.execute("SELECT MAX(TrackId) FROM Track")
-        max_id_row = cursor.fetchone()
-        track_id = (max_id_row[0] or 0) + 1
-        cursor.execute("""
-            INSERT INTO Track (TrackId, Name, AlbumId, MediaTypeId, GenreId, Composer, Milliseconds, Bytes, UnitPrice)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, track_id, name, album_id, mediatype_id, genre_id, composer, milliseconds, bytes_size, unit_price)
-        track_ids.append(track_id)
-    return track_ids
-
-def insert_employees(cursor, num_records):
-    print(f"Inserting {num_records} employees...")
-    faker = Faker()
-    employee_ids = []
-    for _ in range(num_records):
-        first_name = truncate_string(faker.first_name(), 20)  # NVARCHAR(20)
-        last_name = truncate_string(faker.last_name(), 20)    # NVARCHAR(20)
-        title = truncate_string(random.choice(['Sales Manager', 'Sales Support Agent', 'IT Manager', 'IT Staff']), 30)  # NVARCHAR(30)
-        reports_to = None  # For simplicity
-        birth_date = faker.date_between(start_date='-60y', end_date='-25y')
-        hire_date = faker.date_between(start_date='-20y', end_date='today')
-        address = truncate_string(faker.street_address(), 70)  # NVARCHAR(70)
-        city = truncate_string(faker.city(), 40)               # NVARCHAR(40)
-        state = truncate_string(faker.state(), 40)             # NVARCHAR(40)
-        country = truncate_string(faker.country(), 40)         # NVARCHAR(40)
-        postal_code = truncate_string(faker.postcode(), 10)    # NVARCHAR(10)
-        phone = truncate_string(faker.phone_number(), 24)      # NVARCHAR(24)
-        fax = truncate_string(faker.phone_number(), 24)        # NVARCHAR(24)
-        email = truncate_string(faker.email(), 60)             # NVARCHAR(60)
-        cursor.execute("SELECT MAX(EmployeeId) FROM Employee")
-        max_id_row = cursor.fetchone()
-        employee_id = (max_id_row[0] or 0) + 1
-        cursor.execute("""
-            INSERT INTO Employee (EmployeeId, LastName, FirstName, Title, ReportsTo, BirthDate, HireDate,
-                                  Address, City, State, Country, PostalCode, Phone, Fax, Email)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, employee_id, last_name, first_name, title, reports_to, birth_date, hire_date,
-             address, city, state, country, postal_code, phone, fax, email)
-        employee_ids.append(employee_id)
-    return employee_ids
-
-def insert_customers(cursor, employee_ids, num_records):
-    print(f"Inserting {num_records} customers...")
-    faker = Faker()
-    customer_ids = []
-    for _ in range(num_records):
-        first_name = truncate_string(faker.first_name(), 40)  # NVARCHAR(40)
-        last_name = truncate_string(faker.last_name(), 20)    # NVARCHAR(20)
-        company = truncate_string(faker.company(), 80)        # NVARCHAR(80)
-        address = truncate_string(faker.street_address(), 70) # NVARCHAR(70)
-        city = truncate_string(faker.city(), 40)              # NVARCHAR(40)
-        state = truncate_string(faker.state(), 40)            # NVARCHAR(40)
-        country = truncate_string(faker.country(), 40)        # NVARCHAR(40)
-        postal_code = truncate_string(faker.postcode(), 10)   # NVARCHAR(10)
-        phone = truncate_string(faker.phone_number(), 24)     # NVARCHAR(24)
-        fax = truncate_string(faker.phone_number(), 24)       # NVARCHAR(24)
-        email = truncate_string(faker.email(), 60)            # NVARCHAR(60)
-        support_rep_id = random.choice(employee_ids) if employee_ids else None
-        cursor.execute("SELECT MAX(CustomerId) FROM Customer")
-        max_id_row = cursor.fetchone()
-        customer_id = (max_id_row[0] or 0) + 1
-        cursor.execute("""
-            INSERT INTO Customer (CustomerId, FirstName, LastName, Company, Address, City, State,
-                                  Country, PostalCode, Phone, Fax, Email, SupportRepId)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, customer_id, first_name, last_name, company, address, city, state,
-             country, postal_code, phone, fax, email, support_rep_id)
-        customer_ids.append(customer_id)
-    return customer_ids
-
-def insert_invoices(cursor, customer_ids, num_records):
-    print(f"Inserting {num_records} invoices...")
-    faker = Faker()
-    invoice_ids = []
-    for _ in range(num_records):
-        customer_id = random.choice(customer_ids)
-        invoice_date = faker.date_between(start_date='-5y', end_date='today')
-        billing_address = truncate_string(faker.street_address(), 70)  # NVARCHAR(70)
-        billing_city = truncate_string(faker.city(), 40)               # NVARCHAR(40)
-        billing_state = truncate_string(faker.state(), 40)             # NVARCHAR(40)
-        billing_country = truncate_string(faker.country(), 40)         # NVARCHAR(40)
-        billing_postal_code = truncate_string(faker.postcode(), 10)    # NVARCHAR(10)
-        total = round(random.uniform(10.00, 500.00), 2)
-        cursor.execute("SELECT MAX(InvoiceId) FROM Invoice")
-        max_id_row = cursor.fetchone()
-        invoice_id = (max_id_row[0] or 0) + 1
-        cursor.execute("""
-            INSERT INTO Invoice (InvoiceId, CustomerId, InvoiceDate, BillingAddress, BillingCity,
-                                 BillingState, BillingCountry, BillingPostalCode, Total)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, invoice_id, customer_id, invoice_date, billing_address, billing_city,
-             billing_state, billing_country, billing_postal_code, total)
-        invoice_ids.append(invoice_id)
-    return invoice_ids
-
-def insert_invoicelines(cursor, invoice_ids, track_ids, num_records):
-    print(f"Inserting {num_records} invoice lines...")
-    invoice_line_ids = []
-    for _ in range(num_records):
-        invoice_id = random.choice(invoice_ids)
-        track_id = random.choice(track_ids)
-        unit_price = round(random.uniform(0.99, 1.99), 2)
-        quantity = random.randint(1, 5)
-        cursor.execute("SELECT MAX(InvoiceLineId) FROM InvoiceLine")
-        max_id_row = cursor.fetchone()
-        invoice_line_id = (max_id_row[0] or 0) + 1
-        cursor.execute("""
-            INSERT INTO InvoiceLine (InvoiceLineId, InvoiceId, TrackId, UnitPrice, Quantity)
-            VALUES (?, ?, ?, ?, ?)
-        """, invoice_line_id, invoice_id, track_id, unit_price, quantity)
-        invoice_line_ids.append(invoice_line_id)
-    return invoice_line_ids
-
-def insert_playlists(cursor, num_records):
-    print(f"Inserting {num_records} playlists...")
+def table_rows(scale_factor):
+    rows = {table: count * scale_factor for table, count in SCALE_FACTOR_ROWS.items()}
+    rows['Genre'] = len(GENRES)
+    rows['MediaType'] = len(MEDIA_TYPES)
+    return rows
+
+def allocate_ids(cursor, rows):
+    # First id of every table's range, read once: ids continue after
+    # whatever the tables already hold (from 1 without a cursor)
+    first_ids = {}
+    for table, column in ID_COLUMNS.items():
+        max_id = None
+        if cursor is not None:
+            cursor.execute(f"SELECT MAX({column}) FROM {table}")
+            max_id = cursor.fetchone()[0]
+        first_ids[table] = (max_id or 0) + 1
+    return {table: np.arange(first_ids[table], first_ids[table] + rows[table], dtype=np.int64)
+            for table in ID_COLUMNS}
+
+def text_pools(seed, size=POOL_SIZE):
+    # One seeded Faker for the whole run
     faker = Faker()
-    playlist_ids = []
-    for _ in range(num_records):
-        name = truncate_string(faker.sentence(nb_words=2), 120)  # NVARCHAR(120)
-        cursor.execute("SELECT MAX(PlaylistId) FROM Playlist")
-        max_id_row = cursor.fetchone()
-        playlist_id = (max_id_row[0] or 0) + 1
-        cursor.execute("INSERT INTO Playlist (PlaylistId, Name) VALUES (?, ?)", playlist_id, name)
-        playlist_ids.append(playlist_id)
-    return playlist_ids
-
-def insert_playlisttracks(cursor, playlist_ids, track_ids, num_records):
-    print(f"Inserting {num_records} playlist tracks...")
-    for _ in range(num_records):
-        playlist_id = random.choice(playlist_ids)
-        track_id = random.choice(track_ids)
-        cursor.execute("""
-            SELECT COUNT(*) FROM PlaylistTrack WHERE PlaylistId = ? AND TrackId = ?
-        """, playlist_id, track_id)
-        exists = cursor.fetchone()[0]
-        if not exists:
-            cursor.execute("""
-                INSERT INTO PlaylistTrack (PlaylistId, TrackId)
-                VALUES (?, ?)
-            """, playlist_id, track_id)
-
-def main():
+    Faker.seed(seed)
+
+    def pool(make, max_length):
+        return np.array([truncate_string(make(), max_length) for _ in range(size)], dtype=object)
+
+    return {
+        'first_name': pool(faker.first_name, 20),
+        'last_name': pool(faker.last_name, 20),
+        'name': pool(faker.name, 120),
+        'words': pool(lambda: faker.sentence(nb_words=3).rstrip('.'), 120),
+        'company': pool(faker.company, 80),
+        'address': pool(faker.street_address, 70),
+        'city': pool(faker.city, 40),
+        'state': pool(faker.state, 40),
+        'country': pool(faker.country, 40),
+        'postcode': pool(faker.postcode, 10),
+        'phone': pool(faker.phone_number, 24),
+        'domain': pool(faker.free_email_domain, 30),
+    }
+
+def pick(rng, values, size):
+    return values[rng.integers(0, len(values), size)]
+
+def numbered(rng, pools, pool, size):
+    # Text from a pool with a number appended, so large tables do not repeat
+    # the same few thousand values
+    return pd.Series(pick(rng, pools[pool], size)) + " " + pd.Series(rng.integers(1, 1000, size)).astype(str)
+
+def emails(rng, pools, first_names, last_names):
+    size = len(first_names)
+    local = (pd.Series(first_names).str.lower() + "." + pd.Series(last_names).str.lower()
+             + pd.Series(rng.integers(1, 100000, size)).astype(str))
+    return (local + "@" + pd.Series(pick(rng, pools['domain'], size))).str.slice(0, 60)
+
+def random_dates(rng, start, end, size):
+    days = rng.integers(0, (end - start).days, size)
+    return pd.to_datetime(start) + pd.to_timedelta(days, unit='D')
+
+def zipf_sampler(rng, ids, exponent=TRACK_POPULARITY_EXPONENT):
+    # Returns sample(size) drawing ids with Zipfian popularity; popularity
+    # ranks are shuffled so the hits are spread over albums and genres
+    ranked = rng.permutation(ids)
+    weights = 1.0 / np.arange(1, len(ranked) + 1) ** exponent
+    cdf = np.cumsum(weights / weights.sum())
+
+    def sample(size):
+        return ranked[np.minimum(np.searchsorted(cdf, rng.random(size)), len(ranked) - 1)]
+    return sample
+
+def seasonal_dates(rng, size, end=END_DATE, years=INVOICE_YEARS):
+    # Sorted invoice dates, so invoice ids increase with time as the
+    # incremental ETL expects
+    end = pd.Timestamp(end)
+    days = pd.date_range(end - pd.DateOffset(years=years), end, freq='D')
+    weights = np.array(MONTH_WEIGHTS)[days.month - 1] * np.array(WEEKDAY_WEIGHTS)[days.weekday]
+    cdf = np.cumsum(weights / weights.sum())
+    picked = np.minimum(np.searchsorted(cdf, rng.random(size)), len(days) - 1)
+    return days[np.sort(picked)]
+
+def generate_artists(rng, pools, ids):
+    return pd.DataFrame({'ArtistId': ids, 'Name': numbered(rng, pools, 'name', len(ids)).str.slice(0, 120)})
+
+def existing_names(cursor, table):
+    # {Name: id} of the rows a lookup table already holds; empty without a cursor
+    if cursor is None:
+        return {}
+    cursor.execute(f"SELECT {ID_COLUMNS[table]}, Name FROM {table}")
+    existing = {}
+    for row in cursor.fetchall():
+        existing.setdefault(row[1], row[0])
+    return existing
+
+def generate_lookup(table, names, ids, existing):
+    # Lookup rows for the names the table does not hold yet, on the newly
+    # allocated ids, and the id of every name in names' order for the
+    # tables that reference them
+    missing = [name for name in names if name not in existing]
+    new_ids = dict(zip(missing, ids.tolist()))
+    all_ids = np.array([existing[name] if name in existing else new_ids[name] for name in names], dtype=np.int64)
+    return pd.DataFrame({ID_COLUMNS[table]: list(new_ids.values()), 'Name': missing}), all_ids
+
+def generate_genres(ids, existing=None):
+    return generate_lookup('Genre', GENRES, ids, existing or {})
+
+def generate_mediatypes(ids, existing=None):
+    return generate_lookup('MediaType', MEDIA_TYPES, ids, existing or {})
+
+def generate_albums(rng, pools, ids, artist_ids):
+    return pd.DataFrame({
+        'AlbumId': ids,
+        'Title': numbered(rng, pools, 'words', len(ids)).str.slice(0, 160),
+        'ArtistId': pick(rng, artist_ids, len(ids)),
+    })
+
+def generate_tracks(rng, pools, ids, album_ids, genre_ids, mediatype_ids):
+    size = len(ids)
+    # Track length is log-normal around four minutes
+    milliseconds = np.clip(rng.lognormal(np.log(240000), 0.35, size), 30000, 1200000).astype(np.int64)
+    media_types = pick(rng, mediatype_ids, size)
+    video = np.isin(media_types, mediatype_ids[[i for i, name in enumerate(MEDIA_TYPES) if 'video' in name]])
+    return pd.DataFrame({
+        'TrackId': ids,
+        'Name': numbered(rng, pools, 'words', size).str.slice(0, 200),
+        'AlbumId': pick(rng, album_ids, size),
+        'MediaTypeId': media_types,
+        'GenreId': pick(rng, genre_ids, size),
+        'Composer': pick(rng, pools['name'], size),
+        'Milliseconds': milliseconds,
+        'Bytes': milliseconds * rng.integers(50, 150, size),
+        'UnitPrice': np.where(video, 1.99, 0.99),
+    })
+
+def generate_employees(rng, pools, ids, end=END_DATE):
+    size = len(ids)
+    first_names = pick(rng, pools['first_name'], size)
+    last_names = pick(rng, pools['last_name'], size)
+    # The first employee is the top of the hierarchy; everyone else reports
+    # to someone hired before them
+    reports_to = pd.array([None] * size, dtype='Int64')
+    if size > 1:
+        reports_to[1:] = ids[rng.integers(0, np.arange(1, size))]
+    today = pd.Timestamp(end)
+    return pd.DataFrame({
+        'EmployeeId': ids,
+        'LastName': last_names,
+        'FirstName': first_names,
+        'Title': pick(rng, np.array(EMPLOYEE_TITLES, dtype=object), size),
+        'ReportsTo': reports_to,
+        'BirthDate': random_dates(rng, today - pd.DateOffset(years=60), today - pd.DateOffset(years=25), size),
+        'HireDate': random_dates(rng, today - pd.DateOffset(years=20), today, size),
+        'Address': pick(rng, pools['address'], size),
+        'City': pick(rng, pools['city'], size),
+        'State': pick(rng, pools['state'], size),
+        'Country': pick(rng, pools['country'], size),
+        'PostalCode': pick(rng, pools['postcode'], size),
+        'Phone': pick(rng, pools['phone'], size),
+        'Fax': pick(rng, pools['phone'], size),
+        'Email': emails(rng, pools, first_names, last_names),
+    })
+
+def generate_customers(rng, pools, ids, employee_ids):
+    size = len(ids)
+    first_names = pick(rng, pools['first_name'], size)
+    last_names = pick(rng, pools['last_name'], size)
+    return pd.DataFrame({
+        'CustomerId': ids,
+        'FirstName': first_names,
+        'LastName': last_names,
+        'Company': np.where(rng.random(size) < 0.2, pick(rng, pools['company'], size), None),
+        'Address': pick(rng, pools['address'], size),
+        'City': pick(rng, pools['city'], size),
+        'State': pick(rng, pools['state'], size),
+        'Country': pick(rng, pools['country'], size),
+        'PostalCode': pick(rng, pools['postcode'], size),
+        'Phone': pick(rng, pools['phone'], size),
+        'Fax': np.where(rng.random(size) < 0.3, pick(rng, pools['phone'], size), None),
+        'Email': emails(rng, pools, first_names, last_names),
+        'SupportRepId': pick(rng, employee_ids, size),
+    })
+
+def generate_invoice_batches(rng, invoice_ids, line_ids, customers, tracks, end=END_DATE, batch_size=INVOICE_BATCH):
+    # Yield (invoices, invoice lines) DataFrames batch_size invoices at a
+    # time. Lines are spread over invoices at random, tracks are drawn with
+    # Zipfian popularity and every invoice total is the sum of its lines.
+    invoice_dates = seasonal_dates(rng, len(invoice_ids), end)
+    # Lines per invoice: at least one, the rest distributed multinomially
+    extra = rng.multinomial(len(line_ids) - len(invoice_ids), np.full(len(invoice_ids), 1 / len(invoice_ids)))
+    lines_per_invoice = extra + 1
+    track_ids = tracks['TrackId'].to_numpy()
+    sample_tracks = zipf_sampler(rng, track_ids)
+    # Track ids are one contiguous range, so a line's price is a direct lookup
+    track_prices = tracks['UnitPrice'].to_numpy()
+    line_offset = 0
+    for start in range(0, len(invoice_ids), batch_size):
+        ids = invoice_ids[start:start + batch_size]
+        counts = lines_per_invoice[start:start + batch_size]
+        size = int(counts.sum())
+        line_invoices = np.repeat(ids, counts)
+        line_tracks = sample_tracks(size)
+        prices = track_prices[line_tracks - track_ids[0]]
+        quantities = np.minimum(rng.geometric(0.7, size), 5)
+        lines = pd.DataFrame({
+            'InvoiceLineId': line_ids[line_offset:line_offset + size],
+            'InvoiceId': line_invoices,
+            'TrackId': line_tracks,
+            'UnitPrice': prices,
+            'Quantity': quantities,
+        })
+        line_offset += size
+        totals = np.bincount(np.repeat(np.arange(len(ids)), counts), weights=prices * quantities, minlength=len(ids))
+        buyers = customers.iloc[rng.integers(0, len(customers), len(ids))]
+        invoices = pd.DataFrame({
+            'InvoiceId': ids,
+            'CustomerId': buyers['CustomerId'].to_numpy(),
+            'InvoiceDate': invoice_dates[start:start + batch_size],
+            'BillingAddress': buyers['Address'].to_numpy(),
+            'BillingCity': buyers['City'].to_numpy(),
+            'BillingState': buyers['State'].to_numpy(),
+            'BillingCountry': buyers['Country'].to_numpy(),
+            'BillingPostalCode': buyers['PostalCode'].to_numpy(),
+            'Total': np.round(totals, 2),
+        })
+        yield invoices, lines
+
+def generate_playlists(rng, pools, ids):
+    return pd.DataFrame({'PlaylistId': ids, 'Name': numbered(rng, pools, 'words', len(ids)).str.slice(0, 120)})
+
+def generate_playlisttracks(rng, playlist_ids, track_ids, size):
+    # Popular tracks turn up on more playlists; repeats within a playlist are dropped
+    sample_tracks = zipf_sampler(rng, track_ids)
+    pairs = pd.DataFrame({'PlaylistId': pick(rng, playlist_ids, size), 'TrackId': sample_tracks(size)})
+    return pairs.drop_duplicates(ignore_index=True)
+
+def frame_rows(df):
+    # Rows of Python values for executemany: numpy scalars become int/float,
+    # missing values None, timestamps datetime
+    columns = []
+    for name in df.columns:
+        column = df[name]
+        if pd.api.types.is_datetime64_any_dtype(column):
+            columns.append(list(column.dt.to_pydatetime()))
+        else:
+            columns.append(column.astype(object).where(column.notna(), None).tolist())
+    return list(zip(*columns))
+
+class DatabaseSink:
+    # Writes generated frames with fast_executemany, batch_size rows per
+    # round trip, committing after every frame
+
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.cursor.fast_executemany = True
+        self.batch_size = batch_size
+
+    def write(self, table, df):
+        columns = TABLE_COLUMNS[table]
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+        rows = frame_rows(df[columns])
+        for start in range(0, len(rows), self.batch_size):
+            self.cursor.executemany(sql, rows[start:start + self.batch_size])
+        self.conn.commit()
+
+    def close(self):
+        self.cursor.close()
+
+class FileSink:
+    # Appends generated frames to one CSV or Parquet file per table in
+    # directory; CSV files load with bulk_insert_sql()
+
+    def __init__(self, directory, file_format='csv'):
+        if file_format == 'parquet' and pa is None:
+            raise ValueError("Parquet output requires pyarrow")
+        self.directory = directory
+        self.file_format = file_format
+        self.writers = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, table):
+        return os.path.join(self.directory, f"{table}.{self.file_format}")
+
+    def write(self, table, df):
+        df = df[TABLE_COLUMNS[table]]
+        if self.file_format == 'csv':
+            first = table not in self.writers
+            df.to_csv(self.path(table), mode='w' if first else 'a', header=first, index=False,
+                      date_format='%Y-%m-%d %H:%M:%S')
+            self.writers[table] = None
+            return
+        data = pa.Table.from_pandas(df, preserve_index=False)
+        writer = self.writers.get(table)
+        if writer is None:
+            writer = self.writers[table] = pq.ParquetWriter(self.path(table), data.schema)
+        writer.write_table(data.cast(writer.schema))
+
+    def close(self):
+        for writer in self.writers.values():
+            if writer is not None:
+                writer.close()
+
+def bulk_insert_sql(table, path):
+    # Load a FileSink CSV on the server; the path is as the server sees it
+    return (f"BULK INSERT {table} FROM '{path}' "
+            f"WITH (FORMAT = 'CSV', FIRSTROW = 2, KEEPNULLS, TABLOCK, BATCHSIZE = 100000)")
+
+def generate(sink, scale_factor=1, seed=42, cursor=None, end=END_DATE):
+    # Generate a Chinook-shaped data set at scale_factor into sink, in FK
+    # order, with dates up to end. cursor, if given, is used once to
+    # continue after the ids the source tables already hold and to reuse
+    # the Genre and MediaType rows already there. Returns {table: rows written}.
+    rng = np.random.default_rng(seed)
+    pools = text_pools(seed)
+    rows = table_rows(scale_factor)
+    ids = allocate_ids(cursor, rows)
+    written = {}
+
+    def write(table, df):
+        sink.write(table, df)
+        written[table] = written.get(table, 0) + len(df)
+        print(f"{table}: {written[table]} rows written")
+
+    write('Artist', generate_artists(rng, pools, ids['Artist']))
+    genres, genre_ids = generate_genres(ids['Genre'], existing_names(cursor, 'Genre'))
+    write('Genre', genres)
+    mediatypes, mediatype_ids = generate_mediatypes(ids['MediaType'], existing_names(cursor, 'MediaType'))
+    write('MediaType', mediatypes)
+    write('Album', generate_albums(rng, pools, ids['Album'], ids['Artist']))
+    tracks = generate_tracks(rng, pools, ids['Track'], ids['Album'], genre_ids, mediatype_ids)
+    write('Track', tracks)
+    write('Employee', generate_employees(rng, pools, ids['Employee'], end))
+    customers = generate_customers(rng, pools, ids['Customer'], ids['Employee'])
+    write('Customer', customers)
+    for invoices, lines in generate_invoice_batches(rng, ids['Invoice'], ids['InvoiceLine'], customers, tracks, end):
+        write('Invoice', invoices)
+        write('InvoiceLine', lines)
+    write('Playlist', generate_playlists(rng, pools, ids['Playlist']))
+    write('PlaylistTrack', generate_playlisttracks(rng, ids['Playlist'], ids['Track'], rows['PlaylistTrack']))
+    return written
+
+def main(scale_factor=1, output='database', directory='generated', seed=42, end=END_DATE):
+    if scale_factor not in SCALE_FACTORS:
+        raise ValueError(f"Unknown scale factor {scale_factor}, expected one of {SCALE_FACTORS}")
+    if output not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output '{output}', expected one of {OUTPUT_FORMATS}")
+
+    if output != 'database':
+        sink = FileSink(directory, output)
+        try:
+            generate(sink, scale_factor, seed, end=end)
+        finally:
+            sink.close()
+        print(f"SF{scale_factor} data written to {directory}.")
+        return
+
     # Database connection parameters
     source_server = 'DPC2023'  # Replace with your server name
     source_database = 'Chinook'
-    
+
     # Connect to source database
     source_conn = connect_to_db(source_server, source_database)
-    source_cursor = source_conn.cursor()
-    
-    # Start transaction
-    source_conn.autocommit = False
+    sink = DatabaseSink(source_conn)
     try:
-        # Insert data
-        artist_ids = insert_artists(source_cursor, num_records=10)
-        genre_ids = insert_genres(source_cursor, num_records=5)
-        mediatype_ids = insert_mediatypes(source_cursor, num_records=3)
-        album_ids = insert_albums(source_cursor, artist_ids, num_records=20)
-        track_ids = insert_tracks(source_cursor, album_ids, genre_ids, mediatype_ids, num_records=50)
-        employee_ids = insert_employees(source_cursor, num_records=5)
-        customer_ids = insert_customers(source_cursor, employee_ids, num_records=15)
-        invoice_ids = insert_invoices(source_cursor, customer_ids, num_records=30)
-        insert_invoicelines(source_cursor, invoice_ids, track_ids, num_records=100)
-        playlist_ids = insert_playlists(source_cursor, num_records=5)
-        insert_playlisttracks(source_cursor, playlist_ids, track_ids, num_records=50)
-        
-        # Commit transaction
-        source_conn.commit()
+        generate(sink, scale_factor, seed, source_conn.cursor(), end)
         print("Data insertion completed successfully.")
     except Exception as e:
-        # Rollback transaction on error
+        # Batches already committed stay; their ids are past the old maximum
         source_conn.rollback()
         print(f"An error occurred: {e}")
+        raise
     finally:
         # Close connections
-        source_cursor.close()
+        sink.close()
         source_conn.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import logging
+import time
+from datetime import datetime
+
+from olap_query_builder import attribute_expression, joins_for, referenced_attributes
+
+# Pre-aggregated rollups of FactSales, rebuilt at the end of every ETL run.
+# Grain columns are query attributes (see olap_query_builder.ATTRIBUTES) and
+# keep the attribute name, so a query can be pointed at an aggregate as is.
+AGGREGATE_TABLES = [
+    {'name': 'AggSales_Genre', 'grain': ['GenreKey', 'Genre']},
+    {'name': 'AggSales_Album', 'grain': ['AlbumKey', 'Album', 'Artist']},
+    {'name': 'AggSales_Genre_Year_Quarter', 'grain': ['GenreKey', 'Genre', 'Year', 'Quarter']},
+    {'name': 'AggSales_Country_Year', 'grain': ['Country', 'Year']},
+    {'name': 'AggSales_Date', 'grain': ['DateKey', 'Date', 'Year', 'Quarter', 'Month']},
+]
+
+# Measures stored in every aggregate, and how query measures are
+# re-aggregated from them: (aggregate, measure) -> expression over alias x
+AGGREGATE_MEASURES = {
+    'SalesCount': 'COUNT(*)',
+    'Quantity': 'SUM(f.Quantity)',
+    'TotalAmount': 'SUM(f.TotalAmount)',
+}
+REAGGREGATED_MEASURES = {
+    ('SUM', 'TotalAmount'): 'SUM(x.TotalAmount)',
+    ('SUM', 'Quantity'): 'SUM(x.Quantity)',
+    ('COUNT', '*'): 'SUM(x.SalesCount)',
+}
+
+def create_aggregate_catalog(target_cursor, target_conn, schema='dbo'):
+    target_cursor.execute(f"""
+        IF OBJECT_ID('{schema}.AggregateCatalog', 'U') IS NULL
+        CREATE TABLE {schema}.AggregateCatalog (
+            AggregateName NVARCHAR(128) PRIMARY KEY,
+            GrainColumns NVARCHAR(400),
+            AggregateRowCount BIGINT,
+            BuiltAt DATETIME
+        )
+    """)
+    target_conn.commit()
+
+def aggregate_sql(aggregate, schema='dbo'):
+    grain = aggregate['grain']
+    joins = "\n        ".join(joins_for(grain, schema))
+    columns = [f"{attribute_expression(name)} AS [{name}]" for name in grain]
+    columns += [f"{expression} AS {column}" for column, expression in AGGREGATE_MEASURES.items()]
+    return f"""
+        SELECT {', '.join(columns)}
+        INTO {schema}.{aggregate['name']}
+        FROM {schema}.FactSales f
+        {joins}
+        GROUP BY {', '.join(attribute_expression(name) for name in grain)}
+    """
+
+def build_aggregates(target_cursor, target_conn, aggregates=AGGREGATE_TABLES, schema='dbo'):
+    print("Building aggregate tables...")
+    create_aggregate_catalog(target_cursor, target_conn, schema)
+    for aggregate in aggregates:
+        start = time.perf_counter()
+        name = aggregate['name']
+        target_cursor.execute(f"IF OBJECT_ID('{schema}.{name}', 'U') IS NOT NULL DROP TABLE {schema}.{name}")
+        target_cursor.execute(aggregate_sql(aggregate, schema))
+        row_count = target_cursor.rowcount
+        target_cursor.execute(f"DELETE FROM {schema}.AggregateCatalog WHERE AggregateName = ?", name)
+        target_cursor.execute(f"""
+            INSERT INTO {schema}.AggregateCatalog (AggregateName, GrainColumns, AggregateRowCount, BuiltAt)
+            VALUES (?, ?, ?, ?)
+        """, name, ", ".join(aggregate['grain']), row_count, datetime.now())
+        target_conn.commit()
+        elapsed = time.perf_counter() - start
+        print(f"{name} built. {row_count} rows in {elapsed:.2f}s.")
+        logging.info(f"{name}: {row_count} rows in {elapsed:.2f}s")
+
+def load_aggregate_row_counts(cursor):
+    # Row counts recorded at build time; an empty dict if nothing was built yet
+    cursor.execute("SELECT OBJECT_ID('AggregateCatalog', 'U')")
+    if cursor.fetchone()[0] is None:
+        return {}
+    cursor.execute("SELECT AggregateName, AggregateRowCount FROM AggregateCatalog")
+    return {row.AggregateName: row.AggregateRowCount for row in cursor.fetchall()}
+
+def reaggregated_measure(measure):
+    return REAGGREGATED_MEASURES[(measure.aggregate, measure.measure)]
+
+def choose_aggregate(query, row_counts, aggregates=AGGREGATE_TABLES):
+    # Pick the smallest built aggregate whose grain covers the query's
+    # dimension and filter attributes and whose measures can re-aggregate
+    # every requested measure; None means the query must run on FactSales
+    needed = set(referenced_attributes(query))
+    if any((measure.aggregate, measure.measure) not in REAGGREGATED_MEASURES for measure in query.measures):
+        return None
+
+    candidates = []
+    for aggregate in aggregates:
+        if aggregate['name'] not in row_counts:
+            continue
+        if not needed <= set(aggregate['grain']):
+            continue
+        candidates.append((row_counts[aggregate['name']], aggregate['name']))
+    if not candidates:
+        return None
+    return min(candidates)[1]
@@ -0,0 +1,298 @@
+import logging
+import operator
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from etl_separated import BATCH_SIZE, fetch_batches
+from olap_query_builder import ATTRIBUTES, DIMENSIONS, coerce_value
+
+# FactSales columns held in memory
+FACT_KEY_COLUMNS = [name for name, (table, _, _) in ATTRIBUTES.items() if table == 'FactSales']
+FACT_MEASURE_COLUMNS = ['Quantity', 'UnitPrice', 'TotalAmount']
+
+# Decimal places of each measure (INT, NUMERIC(10,2), NUMERIC(10,2)). Measures
+# are held as int64 in units of 10**-scale, so sums are exact like SQL's, and
+# come back as int or Decimal as they do from SQL Server.
+MEASURE_SCALES = {'Quantity': 0, 'UnitPrice': 2, 'TotalAmount': 2}
+
+# Largest sum np.bincount's float64 accumulator adds exactly
+EXACT_FLOAT_SUM = 2 ** 53
+
+# Dimension attributes held in memory: name -> (dimension table, key column, attribute column).
+# Only dimensions joined straight to FactSales; snowflaked ones run on SQL.
+DIMENSION_ATTRIBUTES = {
+    name: (table, DIMENSIONS[table]['key'], column)
+    for name, (table, column, _) in ATTRIBUTES.items()
+    if table != 'FactSales' and DIMENSIONS[table]['parent'] == 'FactSales'
+}
+
+COMPARISONS = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+# Operators that depend on the collation's sort order, which the engine does
+# not reproduce; on text attributes they run on SQL Server
+ORDERED_OPERATORS = {'<', '<=', '>', '>=', 'between'}
+
+class UnsupportedQueryError(ValueError):
+    pass
+
+def encode(values, nulls):
+    # Dictionary-encode values as int32 codes; NULL gets the extra code len(dictionary)
+    dictionary, codes = np.unique(values[~nulls], return_inverse=True)
+    encoded = np.full(len(values), len(dictionary), dtype=np.int32)
+    encoded[~nulls] = codes
+    return dictionary, encoded
+
+def collation_key(value):
+    # Text compares as under SQL Server's default case-insensitive collation:
+    # case and trailing spaces are ignored
+    return value.rstrip(' ').lower()
+
+def encode_text(values, nulls):
+    # Dictionary-encode text by collation key. Values equal under the
+    # collation share a code and decode to one of them, as one GROUP BY
+    # group in SQL Server shows one of its spellings. Returns (dictionary of
+    # keys, codes, labels aligned to the dictionary).
+    present = values[~nulls]
+    keys = np.array([collation_key(value) for value in present], dtype=object)
+    dictionary, first, codes = np.unique(keys, return_index=True, return_inverse=True)
+    encoded = np.full(len(values), len(dictionary), dtype=np.int32)
+    encoded[~nulls] = codes
+    return dictionary, encoded, present[first]
+
+def to_scaled(value, scale):
+    # Exact integer in units of 10**-scale; a float goes through its shortest repr
+    if isinstance(value, float):
+        value = Decimal(repr(value))
+    return int(Decimal(value).scaleb(scale).to_integral_value())
+
+def from_scaled(values, present, scale):
+    # Scaled int64 group results back to SQL Server's types: int for INT
+    # measures, Decimal with the column's scale for NUMERIC ones, None where
+    # the group had no value
+    if scale == 0 and present.all():
+        return values
+    if scale == 0:
+        return np.array([int(v) if p else None for v, p in zip(values, present)], dtype=object)
+    return np.array([Decimal(int(v)).scaleb(-scale) if p else None for v, p in zip(values, present)], dtype=object)
+
+def group_sum(inverse, values, group_count):
+    # Exact int64 sum per group: bincount while float64 cannot lose a unit,
+    # np.add.at beyond that
+    if np.abs(values).sum() < EXACT_FLOAT_SUM:
+        return np.rint(np.bincount(inverse, weights=values, minlength=group_count)).astype(np.int64)
+    sums = np.zeros(group_count, dtype=np.int64)
+    np.add.at(sums, inverse, values)
+    return sums
+
+def coerce_literal(value, dictionary):
+    # DimDate.Date may come back from the driver as datetime rather than date
+    if len(dictionary) and isinstance(dictionary[0], datetime) and isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return value
+
+class CubeSnapshot:
+    # Immutable column store: one dictionary-encoded code array per queryable
+    # column and one (scaled int64 values, not-NULL mask) pair per measure,
+    # all aligned to FactSales rows. Text columns are encoded by collation
+    # key; labels holds the value each key decodes to.
+
+    def __init__(self, columns, measures, row_count, loaded_at, load_seconds, labels=None):
+        self.columns = columns
+        self.measures = measures
+        self.labels = labels or {}
+        self.row_count = row_count
+        self.loaded_at = loaded_at
+        self.load_seconds = load_seconds
+
+    def column(self, name):
+        if name not in self.columns:
+            raise UnsupportedQueryError(f"Unknown column: {name}")
+        return self.columns[name]
+
+    def filter_mask(self, condition):
+        dictionary, codes = self.column(condition.attribute)
+        values = [coerce_literal(coerce_value(condition.attribute, value), dictionary) for value in condition.values]
+        if condition.attribute in self.labels:
+            if condition.operator in ORDERED_OPERATORS:
+                raise UnsupportedQueryError(f"Range filter on text attribute {condition.attribute} runs on SQL Server")
+            values = [collation_key(value) for value in values]
+        if condition.operator in ('in', 'not in'):
+            allowed = np.isin(dictionary, values)
+            if condition.operator == 'not in':
+                allowed = ~allowed
+        elif condition.operator == 'between':
+            allowed = (dictionary >= values[0]) & (dictionary <= values[1])
+        elif condition.operator in COMPARISONS:
+            allowed = COMPARISONS[condition.operator](dictionary, values[0])
+        else:
+            raise UnsupportedQueryError(f"Unsupported operator: {condition.operator}")
+        allowed = np.asarray(allowed, dtype=bool).reshape(len(dictionary))
+        # Evaluate the predicate once per distinct value, then gather by code;
+        # NULL never satisfies a comparison
+        allowed = np.append(allowed, False)
+        return allowed[codes]
+
+    def query(self, query):
+        mask = np.ones(self.row_count, dtype=bool)
+        for condition in query.filters:
+            mask &= self.filter_mask(condition)
+        rows = np.flatnonzero(mask)
+
+        # Combine the dimension codes into one group id per row
+        group_columns = [self.column(name) for name in query.dimensions]
+        if group_columns:
+            sizes = [len(dictionary) + 1 for dictionary, _ in group_columns]
+            combined = np.ravel_multi_index([codes[rows] for _, codes in group_columns], sizes)
+            group_ids, inverse = np.unique(combined, return_inverse=True)
+            group_codes = np.unravel_index(group_ids, sizes)
+        else:
+            group_ids = np.zeros(1, dtype=np.int64)
+            inverse = np.zeros(len(rows), dtype=np.int64)
+            group_codes = []
+        group_count = len(group_ids)
+        counts = np.bincount(inverse, minlength=group_count)
+
+        result = {}
+        for position, (dictionary, _) in enumerate(group_columns):
+            name = query.dimensions[position]
+            decoded = np.append(self.labels.get(name, dictionary).astype(object), None)
+            result[name] = decoded[group_codes[position]]
+        for measure in query.measures:
+            name = measure.output_name()
+            function, column = measure.aggregate, measure.measure
+            if function == 'COUNT' and column == '*':
+                result[name] = counts
+                continue
+            if column not in self.measures:
+                raise UnsupportedQueryError(f"Unknown measure: {column}")
+            scale = MEASURE_SCALES[column]
+            if function == 'AVG' and scale:
+                # SQL Server's AVG over NUMERIC has its own precision and
+                # rounding; leave it to SQL Server
+                raise UnsupportedQueryError(f"AVG({column}) runs on SQL Server")
+            # SQL aggregates skip NULL measures
+            values, valid = self.measures[column]
+            valid = valid[rows]
+            group_rows, values = inverse[valid], values[rows][valid]
+            valid_counts = np.bincount(group_rows, minlength=group_count)
+            present = valid_counts > 0
+            if function == 'COUNT':
+                result[name] = valid_counts.astype(np.int64)
+            elif function == 'SUM':
+                result[name] = from_scaled(group_sum(group_rows, values, group_count), present, scale)
+            elif function == 'AVG':
+                # Integer AVG is integer division truncated toward zero, as
+                # in SQL Server
+                sums = group_sum(group_rows, values, group_count)
+                divisors = np.maximum(valid_counts, 1)
+                averages = np.sign(sums) * (np.abs(sums) // divisors)
+                result[name] = from_scaled(averages, present, scale)
+            else:
+                # MIN and MAX over no values are NULL
+                fill = np.iinfo(np.int64).max if function == 'MIN' else np.iinfo(np.int64).min
+                out = np.full(group_count, fill, dtype=np.int64)
+                (np.minimum if function == 'MIN' else np.maximum).at(out, group_rows, values)
+                result[name] = from_scaled(out, present, scale)
+        result['Count'] = counts
+        df = pd.DataFrame(result)
+        # Like SQL GROUP BY, an empty input produces no groups
+        return df if len(rows) or not query.dimensions else df.iloc[0:0]
+
+class CubeEngine:
+    # Holds the current snapshot; reload() builds a new one off to the side and
+    # swaps it in, so queries never see a half-loaded cube
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.snapshot = None
+        self._reload_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.snapshot is not None
+
+    def reload(self, conn):
+        with self._reload_lock:
+            start = time.perf_counter()
+            cursor = conn.cursor()
+            columns, measures, row_count = self._load_facts(cursor)
+            labels = self._load_dimension_attributes(cursor, columns)
+            elapsed = time.perf_counter() - start
+            self.snapshot = CubeSnapshot(columns, measures, row_count, datetime.now(), elapsed, labels)
+            print(f"Cube engine loaded. {row_count} fact rows in {elapsed:.2f}s.")
+            logging.info(f"Cube engine loaded {row_count} fact rows in {elapsed:.2f}s")
+
+    def query(self, query):
+        snapshot = self.snapshot
+        if snapshot is None:
+            raise RuntimeError("Cube engine has not been loaded")
+        return snapshot.query(query)
+
+    def info(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {"loaded": False}
+        return {"loaded": True, "rows": snapshot.row_count, "columns": sorted(snapshot.columns),
+                "measures": sorted(snapshot.measures), "loaded_at": snapshot.loaded_at.isoformat(),
+                "load_seconds": round(snapshot.load_seconds, 3)}
+
+    def _load_facts(self, cursor):
+        cursor.execute(f"SELECT {', '.join(FACT_KEY_COLUMNS + FACT_MEASURE_COLUMNS)} FROM FactSales")
+        key_chunks = {name: [] for name in FACT_KEY_COLUMNS}
+        measure_chunks = {name: [] for measure in FACT_MEASURE_COLUMNS for name in (measure, measure + '_valid')}
+        for rows in fetch_batches(cursor, self.batch_size):
+            values = list(zip(*rows))
+            for position, name in enumerate(FACT_KEY_COLUMNS):
+                key_chunks[name].append(np.array([-1 if v is None else v for v in values[position]], dtype=np.int64))
+            for position, name in enumerate(FACT_MEASURE_COLUMNS, start=len(FACT_KEY_COLUMNS)):
+                scale = MEASURE_SCALES[name]
+                measure_chunks[name].append(np.array([0 if v is None else to_scaled(v, scale) for v in values[position]],
+                                                     dtype=np.int64))
+                measure_chunks[name + '_valid'].append(np.array([v is not None for v in values[position]], dtype=bool))
+
+        keys = {name: np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64) for name, chunks in key_chunks.items()}
+        measures = {name: (np.concatenate(measure_chunks[name]) if measure_chunks[name] else np.empty(0, dtype=np.int64),
+                           np.concatenate(measure_chunks[name + '_valid']) if measure_chunks[name] else np.empty(0, dtype=bool))
+                    for name in FACT_MEASURE_COLUMNS}
+        row_count = len(keys['DateKey'])
+        # Surrogate keys are queryable columns too
+        columns = {name: encode(values, values == -1) for name, values in keys.items()}
+        columns['_keys'] = keys
+        return columns, measures, row_count
+
+    def _load_dimension_attributes(self, cursor, columns):
+        # Adds every dimension attribute to columns; returns the labels of
+        # the text ones
+        keys = columns.pop('_keys')
+        labels = {}
+        by_table = {}
+        for name, (table, key_column, attribute) in DIMENSION_ATTRIBUTES.items():
+            by_table.setdefault((table, key_column), []).append((name, attribute))
+
+        for (table, key_column), attributes in by_table.items():
+            cursor.execute(f"SELECT {key_column}, {', '.join(attribute for _, attribute in attributes)} FROM {table}")
+            rows = cursor.fetchall()
+            dim_keys = np.array([row[0] for row in rows], dtype=np.int64)
+            # Dense surrogate key -> dimension row lookup; unknown and NULL keys map to -1
+            lookup = np.full((dim_keys.max() if len(dim_keys) else 0) + 2, -1, dtype=np.int64)
+            lookup[dim_keys] = np.arange(len(dim_keys))
+            fact_keys = keys[key_column]
+            fact_keys = np.where((fact_keys >= 0) & (fact_keys < len(lookup) - 1), fact_keys, -1)
+            fact_rows = lookup[fact_keys]
+
+            for position, (name, _) in enumerate(attributes, start=1):
+                values = np.array([row[position] for row in rows], dtype=object)
+                nulls = np.array([value is None for value in values], dtype=bool)
+                if ATTRIBUTES[name][2] == 'str':
+                    dictionary, dim_codes, labels[name] = encode_text(values, nulls)
+                else:
+                    dictionary, dim_codes = encode(values, nulls)
+                # Row -1 (no matching dimension member) decodes to NULL
+                dim_codes = np.append(dim_codes, len(dictionary)).astype(np.int32)
+                columns[name] = (dictionary, dim_codes[fact_rows])
+        return labels
@@ -1,12 +1,25 @@
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request
 import pyodbc
 import logging
 from typing import List
 import plotly.express as px
 import pandas as pd
-from fastapi.responses import JSONResponse, FileResponse
-import os
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+import time
+from functools import partial
+from etl_separated import BATCH_SIZE, LOADERS, LOAD_WORKERS, run_etl_parallel, run_stage
+from etl_jobs import JobAlreadyRunningError, JobManager
+from etl_metrics import ETL_METRICS, prometheus_gauges
+from connection_pool import ConnectionPool
+from query_cache import QueryResultCache, query_cache_key, result_columns
+from query_profiler import QueryProfile, SlowQueryLog, execute_profiled, fingerprint
+from olap_schema import ensure_indexes
+from olap_aggregates import choose_aggregate, load_aggregate_row_counts, reaggregated_measure
+from olap_query_builder import SAMPLE_QUERIES, CubeQueryError, OLAPQuery, build_cube_sql, validate_query
+from olap_cube_engine import CubeEngine, UnsupportedQueryError
+from olap_executors import BoundedExecutor, CancelToken, ConcurrencyLimiter, ConcurrencyLimitError, QueryTimeoutError
+from olap_export import ExportError, FACT_SALES_COLUMNS, export_filename, export_media_type, stream_fact_sales, validate_export
 
 # Configure logging
 logging.basicConfig(filename='olap_cube_log.log', level=logging.INFO, 
@@ -18,437 +31,475 @@ app = FastAPI(title="ChinookDW4 OLAP Cube Manager & Operations")
 server = "DPC2023"
 database = "ChinookDW4"
 connection_string = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE={database};Trusted_Connection=yes;"
+source_database = "Chinook"
+source_connection_string = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE={source_database};Trusted_Connection=yes;"
+
+# Connection pool shared by the query endpoints (created at startup)
+pool_size = 12
+pool_timeout = 30
+pool = None
+
+# Result cache for /execute_query/ and /visualize_query/, invalidated by refreshes
+cache_max_entries = 256
+cache_max_bytes = 256 * 1024 * 1024
+cache_ttl = 300
+query_cache = QueryResultCache(max_entries=cache_max_entries, max_bytes=cache_max_bytes, ttl=cache_ttl)
+
+# Cube queries taking longer than slow_query_ms end to end go to a rotating
+# slow-query log, one JSON line each with the query's fingerprint
+slow_query_ms = 1000
+slow_query_log_file = 'olap_slow_queries.log'
+slow_query_log = SlowQueryLog(slow_query_log_file, threshold_ms=slow_query_ms)
+
+# Optional in-memory columnar engine; loaded at startup when preload is set,
+# otherwise on the first engine=memory query, and reloaded after each refresh
+cube_engine_preload = False
+cube_engine = CubeEngine()
+
+# Row counts of the built aggregate tables, used to route queries to the smallest one
+aggregate_row_counts = {}
+
+# Blocking work runs off the event loop: interactive queries, heavy jobs
+# (refresh, engine reloads) and streaming exports get separate executors, so
+# a long download cannot hold up a refresh. They are sized so that together
+# they never wait on the connection pool. Refresh jobs use their own
+# connections, not the pool.
+interactive_workers = 8
+heavy_workers = 2
+export_workers = 2
+query_timeout = 30
+interactive_executor = BoundedExecutor("interactive", interactive_workers)
+heavy_executor = BoundedExecutor("heavy", heavy_workers)
+export_executor = BoundedExecutor("export", export_workers)
+
+# Per-endpoint in-flight limits; requests wait up to limit_wait seconds for a slot
+endpoint_limits = {
+    "execute_query": 8,
+    "visualize_query": 4,
+    "download_olap_cube": 2,
+    "create_olap_cube": 1,
+    "cube_engine_reload": 1,
+}
+limit_wait = 5
+limiter = ConcurrencyLimiter(endpoint_limits, wait=limit_wait)
+
+# Refreshes run as background jobs, one at a time, polled through /jobs/{id}
+jobs = JobManager()
+
+def refresh_stages(mode):
+    swap = ["swap"] if mode == "shadow" else []
+    return ["prepare", *LOADERS, "indexes", "aggregates", *swap, "reload"]
+
+@app.exception_handler(ConcurrencyLimitError)
+async def concurrency_limit_handler(request: Request, e: ConcurrencyLimitError):
+    logging.warning(f"Rejected {request.url.path}: {e}")
+    return JSONResponse(status_code=503, content={"detail": str(e)})
+
+@app.exception_handler(QueryTimeoutError)
+async def query_timeout_handler(request: Request, e: QueryTimeoutError):
+    logging.warning(f"Timed out {request.url.path}: {e}")
+    return JSONResponse(status_code=504, content={"detail": str(e)})
+
+@app.on_event("startup")
+def open_connection_pool():
+    global pool
+    pool = ConnectionPool(connection_string, max_size=pool_size, timeout=pool_timeout)
+    logging.info(f"Connection pool opened (size={pool_size}, timeout={pool_timeout}s).")
+    verify_indexes()
+    reload_aggregate_catalog()
+    if cube_engine_preload:
+        reload_cube_engine()
+
+def reload_cube_engine():
+    with pool.connection() as conn:
+        cube_engine.reload(conn)
+
+def verify_indexes():
+    # Put back any columnstore or natural-key index that is missing or was
+    # left disabled by an interrupted load; the API still starts without them
+    try:
+        with pool.connection() as conn:
+            actions = ensure_indexes(conn.cursor(), conn)
+        changed = {name: action for name, action in actions.items() if action != 'ok'}
+        logging.info(f"Star schema indexes verified, changes: {changed or 'none'}")
+    except Exception as e:
+        logging.error(f"Could not verify star schema indexes: {e}")
 
-# Define a model for query input
-class OLAPQuery(BaseModel):
-    select: List[str]
-    group_by: List[str]
-    filters: List[str] = []
+def reload_aggregate_catalog():
+    global aggregate_row_counts
+    try:
+        with pool.connection() as conn:
+            aggregate_row_counts = load_aggregate_row_counts(conn.cursor())
+        logging.info(f"Aggregate tables available: {sorted(aggregate_row_counts)}")
+    except Exception as e:
+        aggregate_row_counts = {}
+        logging.error(f"Could not load aggregate catalog, queries will use FactSales: {e}")
+
+@app.on_event("shutdown")
+def close_connection_pool():
+    interactive_executor.shutdown()
+    heavy_executor.shutdown()
+    export_executor.shutdown()
+    if pool is not None:
+        pool.close()
+
+def export_stream(columns, export_format, compression, batch_size):
+    # Holds a pooled connection for as long as the client keeps reading
+    try:
+        with pool.connection() as conn:
+            yield from stream_fact_sales(conn, columns, export_format, compression, batch_size)
+        logging.info(f"OLAP Cube data exported as {export_format} (compression={compression}).")
+    except Exception as e:
+        logging.error(f"Error downloading OLAP Cube data: {e}")
+        raise
+
+def release_once(name):
+    # limiter.release(name) that only takes effect the first time; the
+    # stream and the response's background task both call it
+    released = False
+    async def release():
+        nonlocal released
+        if not released:
+            released = True
+            limiter.release(name)
+    return release
+
+async def limited_stream(chunks, release):
+    # Keeps the endpoint's concurrency slot until the stream finishes
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await release()
+
+async def export_response(name, columns, export_format="csv", compression="none", batch_size=BATCH_SIZE):
+    # The slot is taken before the response so a busy endpoint answers 503.
+    # A body that is never iterated (client gone before it starts) does not
+    # run limited_stream's finally, so the background task, which runs once
+    # the response is done either way, releases it too.
+    filename = export_filename(export_format, compression)
+    await limiter.acquire(name)
+    release = release_once(name)
+    try:
+        chunks = export_executor.iterate(export_stream(columns, export_format, compression, batch_size))
+        return StreamingResponse(limited_stream(chunks, release),
+                                 media_type=export_media_type(export_format, compression),
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+                                 background=BackgroundTask(release))
+    except Exception:
+        await release()
+        raise
+
+def create_cube_tables():
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        logging.info("Creating OLAP Cube...")
+        # Create OLAP cube tables if not exist
+        cursor.execute("""
+            IF NOT EXISTS (SELECT * FROM sys.objects WHERE object_id = OBJECT_ID(N'[dbo].[FactSales]') AND type in (N'U'))
+            BEGIN
+                CREATE TABLE FactSales (
+                    SalesKey INT IDENTITY(1,1) PRIMARY KEY,
+                    InvoiceLineId INT,
+                    DateKey INT,
+                    CustomerKey INT,
+                    TrackKey INT,
+                    AlbumKey INT,
+                    GenreKey INT,
+                    MediaTypeKey INT,
+                    EmployeeKey INT,
+                    Quantity INT,
+                    UnitPrice NUMERIC(10,2),
+                    TotalAmount NUMERIC(10,2)
+                );
+            END
+        """)
+        # Commits the table along with its columnstore
+        ensure_indexes(cursor, conn)
+        logging.info("OLAP Cube created successfully.")
 
 # Endpoint to create the OLAP cube
 @app.post("/create_olap_cube/")
-def create_olap_cube():
+async def create_olap_cube():
     try:
-        with pyodbc.connect(connection_string) as conn:
-            cursor = conn.cursor()
-            logging.info("Creating OLAP Cube...")
-            # Create OLAP cube tables if not exist
-            cursor.execute("""
-                IF NOT EXISTS (SELECT * FROM sys.objects WHERE object_id = OBJECT_ID(N'[dbo].[FactSales]') AND type in (N'U'))
-                BEGIN
-                    CREATE TABLE FactSales (
-                        SalesKey INT IDENTITY(1,1) PRIMARY KEY,
-                        InvoiceLineId INT,
-                        DateKey INT,
-                        CustomerKey INT,
-                        TrackKey INT,
-                        AlbumKey INT,
-                        GenreKey INT,
-                        MediaTypeKey INT,
-                        EmployeeKey INT,
-                        Quantity INT,
-                        UnitPrice NUMERIC(10,2),
-                        TotalAmount NUMERIC(10,2)
-                    );
-                END
-            """)
-            logging.info("OLAP Cube created successfully.")
-            # Automatically download the OLAP Cube as a CSV file
-            cursor.execute("SELECT * FROM FactSales")
-            results = cursor.fetchall()
-            df = pd.DataFrame.from_records(results, columns=[desc[0] for desc in cursor.description])
-            csv_file_path = "olap_cube_data.csv"
-            df.to_csv(csv_file_path, index=False)
-            logging.info("OLAP Cube data exported to CSV successfully.")
+        async with limiter.limit("create_olap_cube"):
+            await heavy_executor.run(create_cube_tables)
+    except ConcurrencyLimitError:
+        raise
     except Exception as e:
         logging.error(f"Error creating OLAP Cube: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to create OLAP cube: {e}")
-    return FileResponse(path=csv_file_path, filename="olap_cube_data.csv", media_type="text/csv")
-
-
-# Endpoint to refresh the OLAP cube by running ETL
-@app.post("/refresh_olap_cube/")
-def refresh_olap_cube():
+    # Automatically download the OLAP Cube as a CSV file
+    return await export_response("download_olap_cube", FACT_SALES_COLUMNS)
+
+def reload_after_refresh():
+    reload_aggregate_catalog()
+    query_cache.invalidate()
+    if cube_engine.loaded:
+        try:
+            reload_cube_engine()
+        except Exception as e:
+            logging.error(f"Cube engine kept its previous snapshot, reload failed: {e}")
+
+def run_refresh(mode, batch_size, max_workers, progress):
+    # Body of a refresh job: full resets and reloads, incremental loads new rows only
+    logging.info(f"Refreshing OLAP Cube by running ETL ({mode})...")
     try:
-        with pyodbc.connect(connection_string) as conn:
-            source_cursor = conn.cursor()
-            target_cursor = conn.cursor()
-            # Refresh the OLAP Cube (reset and reload data)
-            logging.info("Refreshing OLAP Cube by running ETL...")
-            truncate_tables(target_cursor, conn)
-            load_dim_artist(source_cursor, target_cursor, conn)
-            load_dim_album(source_cursor, target_cursor, conn)
-            load_dim_genre(source_cursor, target_cursor, conn)
-            load_dim_mediatype(source_cursor, target_cursor, conn)
-            load_dim_track(source_cursor, target_cursor, conn)
-            load_dim_employee(source_cursor, target_cursor, conn)
-            load_dim_customer(source_cursor, target_cursor, conn)
-            load_dim_date(source_cursor, target_cursor, conn)
-            mappings = build_mappings(target_cursor)
-            load_fact_sales(source_cursor, target_cursor, conn, mappings)
-            logging.info("OLAP Cube refreshed successfully.")
-    except Exception as e:
-        logging.error(f"Error refreshing OLAP Cube: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to refresh OLAP cube: {e}")
-    return {"message": "OLAP Cube refreshed successfully."}
-
-def truncate_tables(target_cursor, target_conn):
-    print("Deleting data from Dimension and Fact Tables...")
-    tables = ['FactSales', 'DimCustomer', 'DimEmployee', 'DimDate', 'DimTrack', 'DimMediaType', 'DimGenre', 'DimAlbum', 'DimArtist']
-    for table in tables:
-        target_cursor.execute(f"DELETE FROM {table}")
-        print(f"Data deleted from table {table}.")
-    target_conn.commit()
-
-def load_dim_artist(source_cursor, target_cursor, target_conn):
-    print("Loading DimArtist...")
-    # Fetch existing ArtistIds
-    target_cursor.execute("SELECT ArtistId FROM DimArtist")
-    existing_artist_ids = set(row.ArtistId for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT ArtistId, Name FROM Artist")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.ArtistId not in existing_artist_ids]
-
-    for row in new_rows:
-        target_cursor.execute("INSERT INTO DimArtist (ArtistId, Name) VALUES (?, ?)", row.ArtistId, row.Name)
-    target_conn.commit()
-    print(f"DimArtist loaded. {len(new_rows)} new records inserted.")
-
-def load_dim_album(source_cursor, target_cursor, target_conn):
-    print("Loading DimAlbum...")
-    # Fetch existing AlbumIds
-    target_cursor.execute("SELECT AlbumId FROM DimAlbum")
-    existing_album_ids = set(row.AlbumId for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT AlbumId, Title, ArtistId FROM Album")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.AlbumId not in existing_album_ids]
-
-    for row in new_rows:
-        target_cursor.execute("SELECT ArtistKey FROM DimArtist WHERE ArtistId = ?", row.ArtistId)
-        artist_key_row = target_cursor.fetchone()
-        artist_key = artist_key_row.ArtistKey if artist_key_row else None
-        target_cursor.execute("INSERT INTO DimAlbum (AlbumId, Title, ArtistKey) VALUES (?, ?, ?)", row.AlbumId, row.Title, artist_key)
-    target_conn.commit()
-    print(f"DimAlbum loaded. {len(new_rows)} new records inserted.")
-
-def load_dim_genre(source_cursor, target_cursor, target_conn):
-    print("Loading DimGenre...")
-    # Fetch existing GenreIds
-    target_cursor.execute("SELECT GenreId FROM DimGenre")
-    existing_genre_ids = set(row.GenreId for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT GenreId, Name FROM Genre")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.GenreId not in existing_genre_ids]
-
-    for row in new_rows:
-        target_cursor.execute("INSERT INTO DimGenre (GenreId, Name) VALUES (?, ?)", row.GenreId, row.Name)
-    target_conn.commit()
-    print(f"DimGenre loaded. {len(new_rows)} new records inserted.")
-
-def load_dim_mediatype(source_cursor, target_cursor, target_conn):
-    print("Loading DimMediaType...")
-    # Fetch existing MediaTypeIds
-    target_cursor.execute("SELECT MediaTypeId FROM DimMediaType")
-    existing_mediatype_ids = set(row.MediaTypeId for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT MediaTypeId, Name FROM MediaType")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.MediaTypeId not in existing_mediatype_ids]
-
-    for row in new_rows:
-        target_cursor.execute("INSERT INTO DimMediaType (MediaTypeId, Name) VALUES (?, ?)", row.MediaTypeId, row.Name)
-    target_conn.commit()
-    print(f"DimMediaType loaded. {len(new_rows)} new records inserted.")
-
-def load_dim_track(source_cursor, target_cursor, target_conn):
-    print("Loading DimTrack...")
-    # Fetch existing TrackIds
-    target_cursor.execute("SELECT TrackId FROM DimTrack")
-    existing_track_ids = set(row.TrackId for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT TrackId, Name, AlbumId, MediaTypeId, GenreId, Composer, Milliseconds, Bytes FROM Track")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.TrackId not in existing_track_ids]
-
-    for row in new_rows:
-        # Get AlbumKey
-        target_cursor.execute("SELECT AlbumKey FROM DimAlbum WHERE AlbumId = ?", row.AlbumId)
-        album_key_row = target_cursor.fetchone()
-        album_key = album_key_row.AlbumKey if album_key_row else None
-
-        # Get MediaTypeKey
-        target_cursor.execute("SELECT MediaTypeKey FROM DimMediaType WHERE MediaTypeId = ?", row.MediaTypeId)
-        mediatype_key_row = target_cursor.fetchone()
-        mediatype_key = mediatype_key_row.MediaTypeKey if mediatype_key_row else None
-
-        # Get GenreKey
-        target_cursor.execute("SELECT GenreKey FROM DimGenre WHERE GenreId = ?", row.GenreId)
-        genre_key_row = target_cursor.fetchone()
-        genre_key = genre_key_row.GenreKey if genre_key_row else None
-
-        target_cursor.execute("""
-            INSERT INTO DimTrack (TrackId, Name, AlbumKey, MediaTypeKey, GenreKey, Composer, Milliseconds, Bytes)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, row.TrackId, row.Name, album_key, mediatype_key, genre_key, row.Composer, row.Milliseconds, row.Bytes)
-    target_conn.commit()
-    print(f"DimTrack loaded. {len(new_rows)} new records inserted.")
-
-def load_dim_employee(source_cursor, target_cursor, target_conn):
-    print("Loading DimEmployee...")
-    # Fetch existing EmployeeIds
-    target_cursor.execute("SELECT EmployeeId FROM DimEmployee")
-    existing_employee_ids = set(row.EmployeeId for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT EmployeeId, FirstName, LastName, Title, ReportsTo, HireDate FROM Employee")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.EmployeeId not in existing_employee_ids]
-
-    for row in new_rows:
-        target_cursor.execute("""
-            INSERT INTO DimEmployee (EmployeeId, FirstName, LastName, Title, ReportsTo, HireDate)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, row.EmployeeId, row.FirstName, row.LastName, row.Title, row.ReportsTo, row.HireDate)
-    target_conn.commit()
-    print(f"DimEmployee loaded. {len(new_rows)} new records inserted.")
-
-def load_dim_customer(source_cursor, target_cursor, target_conn):
-    print("Loading DimCustomer...")
-    # Fetch existing CustomerIds
-    target_cursor.execute("SELECT CustomerId FROM DimCustomer")
-    existing_customer_ids = set(row.CustomerId for row in target_cursor.fetchall())
-
-    source_cursor.execute("""
-        SELECT CustomerId, FirstName, LastName, Company, Address, City, State, Country, PostalCode
-        FROM Customer
-    """)
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.CustomerId not in existing_customer_ids]
-
-    for row in new_rows:
-        target_cursor.execute("""
-            INSERT INTO DimCustomer (CustomerId, FirstName, LastName, Company, Address, City, State, Country, PostalCode)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, row.CustomerId, row.FirstName, row.LastName, row.Company, row.Address, row.City, row.State, row.Country, row.PostalCode)
-    target_conn.commit()
-    print(f"DimCustomer loaded. {len(new_rows)} new records inserted.")
-
-def load_dim_date(source_cursor, target_cursor, target_conn):
-    print("Loading DimDate...")
-    # Fetch existing Dates
-    target_cursor.execute("SELECT Date FROM DimDate")
-    existing_dates = set(row.Date for row in target_cursor.fetchall())
-
-    source_cursor.execute("SELECT DISTINCT CAST(InvoiceDate AS DATE) AS Date FROM Invoice")
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.Date not in existing_dates]
-
-    for row in new_rows:
-        date_value = row.Date
-        day = date_value.day
-        month = date_value.month
-        year = date_value.year
-        quarter = (month - 1) // 3 + 1
-        target_cursor.execute("""
-            INSERT INTO DimDate (Date, Day, Month, Year, Quarter)
-            VALUES (?, ?, ?, ?, ?)
-        """, date_value, day, month, year, quarter)
-    target_conn.commit()
-    print(f"DimDate loaded. {len(new_rows)} new records inserted.")
-
-def build_mappings(target_cursor):
-    print("Building mappings from natural keys to surrogate keys...")
-    mappings = {}
-
-    # ArtistId to ArtistKey
-    target_cursor.execute("SELECT ArtistId, ArtistKey FROM DimArtist")
-    mappings['Artist'] = {row.ArtistId: row.ArtistKey for row in target_cursor.fetchall()}
-
-    # AlbumId to AlbumKey
-    target_cursor.execute("SELECT AlbumId, AlbumKey FROM DimAlbum")
-    mappings['Album'] = {row.AlbumId: row.AlbumKey for row in target_cursor.fetchall()}
-
-    # GenreId to GenreKey
-    target_cursor.execute("SELECT GenreId, GenreKey FROM DimGenre")
-    mappings['Genre'] = {row.GenreId: row.GenreKey for row in target_cursor.fetchall()}
-
-    # MediaTypeId to MediaTypeKey
-    target_cursor.execute("SELECT MediaTypeId, MediaTypeKey FROM DimMediaType")
-    mappings['MediaType'] = {row.MediaTypeId: row.MediaTypeKey for row in target_cursor.fetchall()}
-
-    # TrackId to TrackKey
-    target_cursor.execute("SELECT TrackId, TrackKey FROM DimTrack")
-    mappings['Track'] = {row.TrackId: row.TrackKey for row in target_cursor.fetchall()}
-
-    # Date to DateKey
-    target_cursor.execute("SELECT Date, DateKey FROM DimDate")
-    mappings['Date'] = {row.Date: row.DateKey for row in target_cursor.fetchall()}
-
-    # CustomerId to CustomerKey
-    target_cursor.execute("SELECT CustomerId, CustomerKey FROM DimCustomer")
-    mappings['Customer'] = {row.CustomerId: row.CustomerKey for row in target_cursor.fetchall()}
-
-    # EmployeeId to EmployeeKey
-    target_cursor.execute("SELECT EmployeeId, EmployeeKey FROM DimEmployee")
-    mappings['Employee'] = {row.EmployeeId: row.EmployeeKey for row in target_cursor.fetchall()}
-
-    print("Mappings built.")
-    return mappings
-
-def load_fact_sales(source_cursor, target_cursor, target_conn, mappings):
-    print("Loading FactSales...")
-    # Fetch existing InvoiceLineIds
-    target_cursor.execute("SELECT InvoiceLineId FROM FactSales")
-    existing_invoice_line_ids = set(row.InvoiceLineId for row in target_cursor.fetchall())
-
-    source_cursor.execute("""
-    SELECT il.InvoiceLineId, il.InvoiceId, il.TrackId, il.Quantity, il.UnitPrice,
-           i.InvoiceDate, i.CustomerId,
-           t.AlbumId, t.GenreId, t.MediaTypeId,
-           c.SupportRepId
-    FROM InvoiceLine il
-    JOIN Invoice i ON il.InvoiceId = i.InvoiceId
-    JOIN Track t ON il.TrackId = t.TrackId
-    JOIN Customer c ON i.CustomerId = c.CustomerId
-    """)
-    rows = source_cursor.fetchall()
-    new_rows = [row for row in rows if row.InvoiceLineId not in existing_invoice_line_ids]
-
-    for row in new_rows:
-        InvoiceLineId = row.InvoiceLineId
-        InvoiceDate = row.InvoiceDate.date()
-        DateKey = mappings['Date'].get(InvoiceDate, None)
-        CustomerKey = mappings['Customer'].get(row.CustomerId, None)
-        TrackKey = mappings['Track'].get(row.TrackId, None)
-        AlbumKey = mappings['Album'].get(row.AlbumId, None)
-        GenreKey = mappings['Genre'].get(row.GenreId, None)
-        MediaTypeKey = mappings['MediaType'].get(row.MediaTypeId, None)
-        EmployeeKey = mappings['Employee'].get(row.SupportRepId, None)
-        Quantity = row.Quantity
-        UnitPrice = row.UnitPrice
-        TotalAmount = Quantity * UnitPrice
-
-        target_cursor.execute("""
-            INSERT INTO FactSales (InvoiceLineId, DateKey, CustomerKey, TrackKey, AlbumKey, GenreKey, MediaTypeKey, EmployeeKey, Quantity, UnitPrice, TotalAmount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, InvoiceLineId, DateKey, CustomerKey, TrackKey, AlbumKey, GenreKey, MediaTypeKey, EmployeeKey, Quantity, UnitPrice, TotalAmount)
-    target_conn.commit()
-    print(f"FactSales loaded. {len(new_rows)} new records inserted.")
+        report = run_etl_parallel(partial(pyodbc.connect, source_connection_string),
+                                  partial(pyodbc.connect, connection_string),
+                                  batch_size, mode, max_workers, progress)
+    except Exception:
+        # A failed run may already have cleared or partly loaded the star
+        # tables, so results cached from the old data are dropped as well
+        query_cache.invalidate()
+        raise
+    run_stage(progress, "reload", reload_after_refresh)
+    logging.info("OLAP Cube refreshed successfully.")
+    return {"mode": mode, "elapsed": report["elapsed"], "task_times": report["timings"],
+            "critical_path": report["critical_path"], "run_report": report["run_report"]}
+
+def start_refresh_job(mode, batch_size, max_workers):
+    try:
+        job = jobs.submit(heavy_executor, "refresh", partial(run_refresh, mode, batch_size, max_workers),
+                          {"mode": mode, "batch_size": batch_size, "max_workers": max_workers}, refresh_stages(mode))
+    except JobAlreadyRunningError as e:
+        raise HTTPException(status_code=409, detail={"message": "A refresh is already running.", "job_id": e.job.job_id})
+    return {"message": "OLAP Cube refresh started.", "job_id": job.job_id, "status_url": f"/jobs/{job.job_id}"}
+
+# Endpoint to refresh the OLAP cube by running ETL in the background
+@app.post("/refresh_olap_cube/", status_code=202)
+async def refresh_olap_cube(mode: str = Query("incremental", pattern="^(incremental|full|shadow)$", description="incremental loads rows past the stored watermarks, full resets and reloads, shadow reloads into shadow tables and swaps them in"),
+                            batch_size: int = Query(BATCH_SIZE, gt=0, description="Rows sent per executemany batch"),
+                            max_workers: int = Query(LOAD_WORKERS, gt=0, description="Tables loaded concurrently")):
+    return start_refresh_job(mode, batch_size, max_workers)
+
+# Endpoints to poll background jobs
+@app.get("/jobs/")
+async def list_jobs():
+    return {"jobs": [job.to_dict() for job in jobs.list()]}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job.to_dict()
+
+def run_olap_query(query: OLAPQuery, engine: str = "sql", cancel_token=None, profile=None):
+    # Return (DataFrame, SQL, source table, cached) for a validated cube query.
+    # The query is answered from the smallest aggregate table covering it when
+    # there is one, and repeated queries are served from the result cache.
+    # engine=memory answers from the in-process cube, falling back to SQL for
+    # queries it cannot evaluate. cancel_token lets a timed-out request cancel
+    # the running statement. profile, a QueryProfile, receives the timings of
+    # each phase; one capturing server statistics skips the cache lookup so
+    # the statistics describe a real execution.
+    if profile is None:
+        profile = QueryProfile()
+    if profile.queued_at is not None:
+        profile.add("queue", profile.queued_at)
+    if engine == "memory":
+        if not cube_engine.loaded:
+            reload_cube_engine()
+        try:
+            with profile.phase("execute"):
+                df = cube_engine.query(query)
+            profile.source, profile.cached, profile.rows = "memory", False, len(df)
+            return df, None, "memory", False
+        except UnsupportedQueryError as e:
+            logging.info(f"Cube engine cannot answer query, using SQL Server: {e}")
+
+    plan_start = time.perf_counter()
+    source = choose_aggregate(query, aggregate_row_counts)
+    if source is None:
+        sql_query, params = build_cube_sql(query)
+        source = "FactSales"
+    else:
+        sql_query, params = build_cube_sql(query, source, reaggregated_measure)
+    profile.sql, profile.source = sql_query, source
+
+    cache_key = query_cache_key(query)
+    df = None if profile.capture_server_stats else query_cache.get(cache_key)
+    profile.add("plan", plan_start)
+    if df is not None:
+        # Shared by queries listing the same dimensions and measures in another order
+        df = df[result_columns(query)]
+        profile.cached, profile.rows = True, len(df)
+        return df, sql_query, source, True
+
+    generation = query_cache.generation
+    wait_start = time.perf_counter()
+    with pool.connection() as conn:
+        profile.add("connection_wait", wait_start)
+        # Driver-side backstop in case the cancel from the event loop is lost;
+        # reset so exports and reloads on this pooled connection are unaffected
+        conn.timeout = query_timeout
+        try:
+            cursor = conn.cursor()
+            if cancel_token is not None:
+                cancel_token.attach(cursor)
+            results, columns = execute_profiled(cursor, sql_query, params, profile)
+            # Format results into a DataFrame
+            with profile.phase("dataframe"):
+                df = pd.DataFrame.from_records(results, columns=columns)
+        finally:
+            conn.timeout = 0
+    query_cache.put(cache_key, df, generation)
+    profile.cached, profile.rows = False, len(df)
+    return df, sql_query, source, False
 
 # Endpoint to execute OLAP queries
 @app.post("/execute_query/")
-def execute_query(query: OLAPQuery):
+async def execute_query(query: OLAPQuery, engine: str = Query("sql", pattern="^(sql|memory)$", description="sql runs on SQL Server, memory on the in-process cube engine"),
+                        profile: bool = Query(False, description="Also return SQL Server's IO and time statistics and the actual plan; skips the result cache")):
+    query_profile = QueryProfile(capture_server_stats=profile)
     try:
-        with pyodbc.connect(connection_string) as conn:
-            cursor = conn.cursor()
-            select_clause = ", ".join(query.select)
-            group_by_clause = ", ".join(query.group_by)
-            filters_clause = " AND ".join(query.filters) if query.filters else "1=1"
-            
-            sql_query = f"""
-                SELECT {select_clause}, COUNT(*) AS Count
-                FROM FactSales
-                WHERE {filters_clause}
-                GROUP BY {group_by_clause};
-            """
-            cursor.execute(sql_query)
-            results = cursor.fetchall()
-            # Format results into a DataFrame
-            df = pd.DataFrame.from_records(results, columns=[desc[0] for desc in cursor.description])
-            logging.info(f"Query executed successfully: {sql_query}")
+        with query_profile.phase("validate"):
+            validate_query(query)
+    except CubeQueryError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query: {e}")
+    try:
+        async with limiter.limit("execute_query"):
+            start = time.perf_counter()
+            token = CancelToken()
+            query_profile.queued_at = time.perf_counter()
+            df, sql_query, source, cached = await interactive_executor.run(
+                run_olap_query, query, engine, token, query_profile, timeout=query_timeout, cancel_token=token)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+        with query_profile.phase("serialize"):
+            records = df.to_dict(orient="records")
+        query_fingerprint = fingerprint(sql_query)[0] if sql_query else None
+        logging.info(f"Query {query_fingerprint} executed successfully on {source} in {elapsed_ms:.1f}ms "
+                     f"(cached={cached}): {sql_query}")
+    except QueryTimeoutError:
+        slow_query_log.record(query_profile, query, engine, status="timeout")
+        raise
+    except ConcurrencyLimitError:
+        raise
     except Exception as e:
+        slow_query_log.record(query_profile, query, engine, status="error")
         logging.error(f"Error executing query: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to execute query: {e}")
-    return {"query_results": df.to_dict(orient="records")}
+    slow_query_log.record(query_profile, query, engine)
+    profile_report = query_profile.to_dict()
+    response = {"query_results": records, "source": source, "cached": cached,
+                "elapsed_ms": round(elapsed_ms, 3), "timings_ms": profile_report["timings_ms"]}
+    if profile:
+        response["profile"] = profile_report
+    return response
 
 # Endpoint to visualize OLAP query results
+def render_visualization(query, engine, cancel_token, profile=None):
+    profile = profile or QueryProfile()
+    df, sql_query, source, cached = run_olap_query(query, engine, cancel_token, profile)
+    logging.info(f"Query executed for visualization on {source} (cached={cached}): {sql_query}")
+    # Create a bar chart using Plotly
+    with profile.phase("serialize"):
+        fig = px.bar(df, x=query.dimensions[0], y="Count", title="OLAP Query Visualization")
+        return fig.to_html()
+
 @app.post("/visualize_query/")
-def visualize_query(query: OLAPQuery):
+async def visualize_query(query: OLAPQuery, engine: str = Query("sql", pattern="^(sql|memory)$", description="sql runs on SQL Server, memory on the in-process cube engine")):
+    query_profile = QueryProfile()
     try:
-        with pyodbc.connect(connection_string) as conn:
-            cursor = conn.cursor()
-            select_clause = ", ".join(query.select)
-            group_by_clause = ", ".join(query.group_by)
-            filters_clause = " AND ".join(query.filters) if query.filters else "1=1"
-            
-            sql_query = f"""
-                SELECT {select_clause}, COUNT(*) AS Count
-                FROM FactSales
-                WHERE {filters_clause}
-                GROUP BY {group_by_clause};
-            """
-            cursor.execute(sql_query)
-            results = cursor.fetchall()
-            # Format results into a DataFrame
-            df = pd.DataFrame.from_records(results, columns=[desc[0] for desc in cursor.description])
-            logging.info(f"Query executed for visualization: {sql_query}")
-            # Create a bar chart using Plotly
-            fig = px.bar(df, x=query.group_by[0], y="Count", title="OLAP Query Visualization")
-            fig_html = fig.to_html()
+        with query_profile.phase("validate"):
+            validate_query(query)
+        if not query.dimensions:
+            raise CubeQueryError("At least one dimension is required to plot")
+    except CubeQueryError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query: {e}")
+    try:
+        async with limiter.limit("visualize_query"):
+            token = CancelToken()
+            query_profile.queued_at = time.perf_counter()
+            fig_html = await interactive_executor.run(render_visualization, query, engine, token, query_profile,
+                                                      timeout=query_timeout, cancel_token=token)
+    except QueryTimeoutError:
+        slow_query_log.record(query_profile, query, engine, status="timeout")
+        raise
+    except ConcurrencyLimitError:
+        raise
     except Exception as e:
+        slow_query_log.record(query_profile, query, engine, status="error")
         logging.error(f"Error visualizing query: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to visualize query: {e}")
+    slow_query_log.record(query_profile, query, engine)
     return JSONResponse(content={"html": fig_html})
 
 # Endpoint to get sample queries
 @app.get("/sample_queries/")
-def get_sample_queries():
-    sample_queries = [
-        {
-            "description": "Total Sales by Album",
-            "query": {
-                "select": ["AlbumKey", "SUM(TotalAmount) AS TotalSales"],
-                "group_by": ["AlbumKey"],
-                "filters": []
-            }
-        },
-        {
-            "description": "Total Sales by Genre",
-            "query": {
-                "select": ["GenreKey", "SUM(TotalAmount) AS TotalSales"],
-                "group_by": ["GenreKey"],
-                "filters": []
-            }
-        },
-        {
-            "description": "Sales in Q1 2023",
-            "query": {
-                "select": ["DateKey", "SUM(TotalAmount) AS TotalSales"],
-                "group_by": ["DateKey"],
-                "filters": ["DATEPART(YEAR, Date) = 2023", "DATEPART(QUARTER, Date) = 1"]
-            }
-        }
-    ]
-    return {"sample_queries": sample_queries}
+async def get_sample_queries():
+    return {"sample_queries": SAMPLE_QUERIES}
 
 # Endpoint to add a manual refresh decision
 @app.post("/prompt_refresh/")
-def prompt_refresh(decision: str = Query(..., pattern="^(yes|no)$", description="Decision to refresh cube (yes/no)")):
+async def prompt_refresh(decision: str = Query(..., pattern="^(yes|no)$", description="Decision to refresh cube (yes/no)")):
     if decision == "yes":
-        return refresh_olap_cube()
+        # Reload everything without emptying the tables queries are reading
+        return start_refresh_job("shadow", BATCH_SIZE, LOAD_WORKERS)
     return {"message": "Refresh skipped by user decision."}
 
-# Endpoint to download OLAP cube data as CSV
+# Endpoint to download OLAP cube data, streamed as it is read
 @app.get("/download_olap_cube/")
-def download_olap_cube():
+async def download_olap_cube(format: str = Query("csv", pattern="^(csv|parquet|arrow)$", description="Export format"),
+                             compression: str = Query("none", pattern="^(none|gzip|zstd)$", description="gzip/zstd compress the stream; Parquet uses it as the column codec"),
+                             columns: List[str] = Query([], description="FactSales columns to export (default: all)"),
+                             batch_size: int = Query(BATCH_SIZE, gt=0, description="Rows fetched and encoded per chunk")):
     try:
-        with pyodbc.connect(connection_string) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM FactSales")
-            results = cursor.fetchall()
-            # Format results into a DataFrame
-            df = pd.DataFrame.from_records(results, columns=[desc[0] for desc in cursor.description])
-            # Save DataFrame to CSV
-            csv_file_path = "olap_cube_data.csv"
-            df.to_csv(csv_file_path, index=False)
-            logging.info("OLAP Cube data exported to CSV successfully.")
-            # Return the CSV file as a downloadable response
-            return FileResponse(path=csv_file_path, filename="olap_cube_data.csv", media_type="text/csv")
+        selected = validate_export(columns, format, compression)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid export: {e}")
+    return await export_response("download_olap_cube", selected, format, compression, batch_size)
+
+# Endpoint to expose connection pool usage for tuning
+@app.get("/pool_metrics/")
+async def get_pool_metrics():
+    return {"pool": pool.metrics()}
+
+# Endpoint to expose result cache hit/miss counters
+@app.get("/cache_metrics/")
+async def get_cache_metrics():
+    return {"cache": query_cache.metrics()}
+
+# Endpoint to expose executor queues and per-endpoint concurrency
+@app.get("/executor_metrics/")
+async def get_executor_metrics():
+    return {"executors": {"interactive": interactive_executor.metrics(), "heavy": heavy_executor.metrics(),
+                          "export": export_executor.metrics()},
+            "endpoints": limiter.metrics()}
+
+# Endpoint for Prometheus: cumulative ETL counters per table and phase, plus
+# the pool, cache and executor metrics above as gauges
+@app.get("/metrics")
+async def get_prometheus_metrics():
+    text = ETL_METRICS.prometheus()
+    if pool is not None:
+        text += prometheus_gauges("chinook_pool", [({}, pool.metrics())])
+    text += prometheus_gauges("chinook_cache", [({}, query_cache.metrics())])
+    text += prometheus_gauges("chinook_executor", [({"executor": "interactive"}, interactive_executor.metrics()),
+                                                   ({"executor": "heavy"}, heavy_executor.metrics()),
+                                                   ({"executor": "export"}, export_executor.metrics())])
+    text += prometheus_gauges("chinook_endpoint", [({"endpoint": endpoint}, values)
+                                                   for endpoint, values in limiter.metrics().items()])
+    text += prometheus_gauges("chinook_slow_queries", [({}, slow_query_log.metrics())])
+    return Response(content=text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Endpoints to inspect and reload the in-memory cube engine
+@app.get("/cube_engine/")
+async def get_cube_engine_info():
+    return {"cube_engine": cube_engine.info()}
+
+@app.post("/cube_engine/reload/")
+async def reload_cube_engine_endpoint():
+    try:
+        async with limiter.limit("cube_engine_reload"):
+            await heavy_executor.run(reload_cube_engine)
+    except ConcurrencyLimitError:
+        raise
     except Exception as e:
-        logging.error(f"Error downloading OLAP Cube data: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to download OLAP Cube data: {e}")
+        logging.error(f"Error loading cube engine: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to load cube engine: {e}")
+    return {"cube_engine": cube_engine.info()}
 
 # Main function to run the application
 def main():
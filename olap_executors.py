@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+# Default executor sizing and limits; the OLAP API overrides these from its own settings
+INTERACTIVE_WORKERS = 10
+HEAVY_WORKERS = 2
+QUERY_TIMEOUT = 30
+LIMIT_WAIT = 5
+
+class QueryTimeoutError(Exception):
+    pass
+
+class ConcurrencyLimitError(Exception):
+    pass
+
+class CancelToken:
+    # Lets the event loop cancel the statement a worker thread is running.
+    # The worker attaches its cursor; cancel() calls SQLCancel on it.
+
+    def __init__(self):
+        self.cursor = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def attach(self, cursor):
+        with self._lock:
+            if self.cancelled:
+                raise QueryTimeoutError("Query was cancelled before it started")
+            self.cursor = cursor
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            cursor = self.cursor
+        if cursor is not None:
+            try:
+                cursor.cancel()
+            except Exception as e:
+                logging.warning(f"Could not cancel running statement: {e}")
+
+class BoundedExecutor:
+    # Fixed-size thread pool for blocking pyodbc work, awaited from async
+    # handlers. Separate instances keep heavy jobs from starving queries.
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._timeouts = 0
+        self._queue_time = 0.0
+
+    async def run(self, func, *args, timeout=None, cancel_token=None):
+        # Run func(*args) on the pool. On timeout or when the request is
+        # cancelled, a queued call is dropped and a running statement is
+        # cancelled through cancel_token.
+        call = self.submit(func, *args)
+        future = asyncio.wrap_future(call)
+        try:
+            if timeout is None:
+                return await future
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timeouts += 1
+            self._dropped(call, cancel_token)
+            raise QueryTimeoutError(f"Query exceeded {timeout}s and was cancelled")
+        except asyncio.CancelledError:
+            self._dropped(call, cancel_token)
+            raise
+
+    def _dropped(self, call, cancel_token):
+        # A call cancelled before a worker picked it up never reaches
+        # _call(), so it leaves the queue here; one already running is
+        # cancelled through its token
+        if call.cancel():
+            with self._lock:
+                self._queued -= 1
+        elif cancel_token is not None:
+            cancel_token.cancel()
+
+    def submit(self, func, *args):
+        # Background work nobody awaits (e.g. a refresh job); returns a
+        # concurrent.futures.Future
+        with self._lock:
+            self._queued += 1
+        return self._executor.submit(self._call, time.perf_counter(), func, args)
+
+    async def iterate(self, iterator):
+        # Drive a blocking iterator (e.g. a streaming export) from the pool;
+        # every step goes through submit(), so it shows up in metrics()
+        done = object()
+        try:
+            while True:
+                chunk = await self._wait(self.submit(next, iterator, done))
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                await self._wait(self.submit(close))
+
+    async def _wait(self, call):
+        try:
+            return await asyncio.wrap_future(call)
+        except asyncio.CancelledError:
+            self._dropped(call, None)
+            raise
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "timeouts": self._timeouts,
+                "queue_time_avg": round(self._queue_time / self._completed, 4) if self._completed else 0.0,
+            }
+
+    def _call(self, submitted, func, args):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._queue_time += time.perf_counter() - submitted
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+class ConcurrencyLimiter:
+    # Per-endpoint cap on in-flight requests. A request waits up to `wait`
+    # seconds for a slot before it is rejected.
+
+    def __init__(self, limits, wait=LIMIT_WAIT):
+        self.limits = dict(limits)
+        self.wait = wait
+        self._semaphores = {}
+        self._in_flight = {name: 0 for name in self.limits}
+        self._rejected = {name: 0 for name in self.limits}
+
+    async def acquire(self, name):
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            semaphore = self._semaphores[name] = asyncio.Semaphore(self.limits[name])
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.wait)
+        except asyncio.TimeoutError:
+            self._rejected[name] += 1
+            raise ConcurrencyLimitError(f"Too many concurrent {name} requests (limit {self.limits[name]})")
+        self._in_flight[name] += 1
+
+    def release(self, name):
+        self._in_flight[name] -= 1
+        self._semaphores[name].release()
+
+    @asynccontextmanager
+    async def limit(self, name):
+        await self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def metrics(self):
+        return {name: {"limit": limit, "in_flight": self._in_flight[name], "rejected": self._rejected[name]}
+                for name, limit in self.limits.items()}
@@ -0,0 +1,167 @@
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+import pandas as pd
+
+from etl_separated import BATCH_SIZE, fetch_batches
+
+# Optional encoders: Parquet/Arrow need pyarrow, zstd needs zstandard
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FACT_SALES_COLUMNS = ['SalesKey', 'InvoiceLineId', 'DateKey', 'CustomerKey', 'TrackKey', 'AlbumKey', 'GenreKey',
+                      'MediaTypeKey', 'EmployeeKey', 'Quantity', 'UnitPrice', 'TotalAmount']
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+class ExportError(ValueError):
+    pass
+
+def validate_export(columns, export_format, compression):
+    # Check an export request up front, before any bytes are sent
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown format: {export_format}")
+    if compression not in COMPRESSIONS:
+        raise ExportError(f"Unknown compression: {compression}")
+    if export_format in ('parquet', 'arrow') and pa is None:
+        raise ExportError(f"{export_format} export requires pyarrow")
+    if compression == 'zstd' and zstandard is None and export_format != 'parquet':
+        raise ExportError("zstd compression requires zstandard")
+    unknown = [name for name in columns if name not in FACT_SALES_COLUMNS]
+    if unknown:
+        raise ExportError(f"Unknown FactSales columns: {', '.join(unknown)}")
+    return list(columns) or list(FACT_SALES_COLUMNS)
+
+def export_filename(export_format, compression, name="olap_cube_data"):
+    extension = EXPORT_FORMATS[export_format][1]
+    # Parquet compresses inside the file, so it keeps its own extension
+    suffix = '' if export_format == 'parquet' else COMPRESSIONS[compression]
+    return f"{name}.{extension}{suffix}"
+
+def export_media_type(export_format, compression):
+    if export_format == 'parquet' or compression == 'none':
+        return EXPORT_FORMATS[export_format][0]
+    return 'application/gzip' if compression == 'gzip' else 'application/zstd'
+
+class ChunkSink:
+    # File-like object the Arrow writers write into; drain() hands over
+    # whatever has been written since the last call
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def arrow_type(description):
+    # Arrow type for a pyodbc cursor.description entry
+    _, type_code, _, _, precision, scale, _ = description
+    if type_code is bool:
+        return pa.bool_()
+    if type_code is int:
+        return pa.int64()
+    if type_code is float:
+        return pa.float64()
+    if type_code is Decimal:
+        return pa.decimal128(precision, scale)
+    if type_code is datetime:
+        return pa.timestamp('ms')
+    if type_code is date:
+        return pa.date32()
+    return pa.string()
+
+def encode_csv(cursor, columns, batch_size):
+    yield pd.DataFrame(columns=columns).to_csv(index=False).encode()
+    for rows in fetch_batches(cursor, batch_size):
+        df = pd.DataFrame.from_records(rows, columns=columns)
+        yield df.to_csv(index=False, header=False).encode()
+
+def record_batches(cursor, schema, batch_size):
+    for rows in fetch_batches(cursor, batch_size):
+        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def encode_parquet(cursor, schema, batch_size, compression):
+    # One row group per fetched batch; compression is the Parquet column codec
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression=compression if compression != 'none' else None)
+    try:
+        for batch in record_batches(cursor, schema, batch_size):
+            writer.write_batch(batch)
+            yield sink.drain()
+    finally:
+        writer.close()
+    # Parquet footer
+    yield sink.drain()
+
+def encode_arrow(cursor, schema, batch_size):
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for batch in record_batches(cursor, schema, batch_size):
+            writer.write_batch(batch)
+            yield sink.drain()
+    finally:
+        writer.close()
+    # End-of-stream marker
+    yield sink.drain()
+
+def compress(chunks, compression):
+    # Compress a byte stream incrementally
+    if compression == 'gzip':
+        compressor = zlib.compressobj(wbits=31)
+        finish = compressor.flush
+    elif compression == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+        finish = compressor.flush
+    else:
+        yield from chunks
+        return
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+def stream_fact_sales(conn, columns, export_format='csv', compression='none', batch_size=BATCH_SIZE):
+    # Yield FactSales encoded as export_format, one fetchmany() batch at a
+    # time, so memory stays bounded by batch_size however large the table is.
+    # columns must have been checked with validate_export.
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(columns)} FROM FactSales")
+    if export_format == 'csv':
+        chunks = encode_csv(cursor, columns, batch_size)
+    else:
+        schema = pa.schema([(description[0], arrow_type(description)) for description in cursor.description])
+        if export_format == 'parquet':
+            yield from encode_parquet(cursor, schema, batch_size, compression)
+            return
+        chunks = encode_arrow(cursor, schema, batch_size)
+    yield from compress(chunks, compression)
@@ -0,0 +1,236 @@
+import re
+from datetime import datetime
+from typing import List, Literal, Optional, Union
+
+from pydantic import BaseModel
+
+# Star schema: each dimension's alias, the key it joins on and the table it
+# hangs off (FactSales, or another dimension for snowflaked tables)
+DIMENSIONS = {
+    'DimDate': {'alias': 'd', 'key': 'DateKey', 'parent': 'FactSales'},
+    'DimCustomer': {'alias': 'c', 'key': 'CustomerKey', 'parent': 'FactSales'},
+    'DimTrack': {'alias': 't', 'key': 'TrackKey', 'parent': 'FactSales'},
+    'DimAlbum': {'alias': 'a', 'key': 'AlbumKey', 'parent': 'FactSales'},
+    'DimGenre': {'alias': 'g', 'key': 'GenreKey', 'parent': 'FactSales'},
+    'DimMediaType': {'alias': 'm', 'key': 'MediaTypeKey', 'parent': 'FactSales'},
+    'DimEmployee': {'alias': 'e', 'key': 'EmployeeKey', 'parent': 'FactSales'},
+    'DimArtist': {'alias': 'r', 'key': 'ArtistKey', 'parent': 'DimAlbum'},
+}
+FACT_ALIAS = 'f'
+
+# Queryable attributes: name -> (table, column, type)
+ATTRIBUTES = {
+    'DateKey': ('FactSales', 'DateKey', 'int'),
+    'CustomerKey': ('FactSales', 'CustomerKey', 'int'),
+    'TrackKey': ('FactSales', 'TrackKey', 'int'),
+    'AlbumKey': ('FactSales', 'AlbumKey', 'int'),
+    'GenreKey': ('FactSales', 'GenreKey', 'int'),
+    'MediaTypeKey': ('FactSales', 'MediaTypeKey', 'int'),
+    'EmployeeKey': ('FactSales', 'EmployeeKey', 'int'),
+    'Date': ('DimDate', 'Date', 'date'),
+    'Year': ('DimDate', 'Year', 'int'),
+    'Quarter': ('DimDate', 'Quarter', 'int'),
+    'Month': ('DimDate', 'Month', 'int'),
+    'Day': ('DimDate', 'Day', 'int'),
+    'Country': ('DimCustomer', 'Country', 'str'),
+    'State': ('DimCustomer', 'State', 'str'),
+    'City': ('DimCustomer', 'City', 'str'),
+    'Company': ('DimCustomer', 'Company', 'str'),
+    'Track': ('DimTrack', 'Name', 'str'),
+    'Composer': ('DimTrack', 'Composer', 'str'),
+    'Album': ('DimAlbum', 'Title', 'str'),
+    'Artist': ('DimArtist', 'Name', 'str'),
+    'Genre': ('DimGenre', 'Name', 'str'),
+    'MediaType': ('DimMediaType', 'Name', 'str'),
+    'Employee': ('DimEmployee', 'LastName', 'str'),
+    'EmployeeTitle': ('DimEmployee', 'Title', 'str'),
+}
+
+MEASURES = ['Quantity', 'UnitPrice', 'TotalAmount']
+
+# Number of values each filter operator takes (None: one or more)
+OPERATORS = {'=': 1, '<>': 1, '<': 1, '<=': 1, '>': 1, '>=': 1, 'like': 1, 'between': 2, 'in': None, 'not in': None}
+
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+class CubeQueryError(ValueError):
+    pass
+
+class Measure(BaseModel):
+    aggregate: Literal['SUM', 'AVG', 'MIN', 'MAX', 'COUNT']
+    measure: str = '*'
+    alias: Optional[str] = None
+
+    def output_name(self):
+        if self.alias:
+            return self.alias
+        if self.measure == '*':
+            return f"{self.aggregate.capitalize()}All"
+        return f"{self.aggregate.capitalize()}{self.measure}"
+
+class Filter(BaseModel):
+    attribute: str
+    operator: Literal['=', '<>', '<', '<=', '>', '>=', 'like', 'between', 'in', 'not in']
+    values: List[Union[int, float, str]]
+
+# Define a model for query input
+class OLAPQuery(BaseModel):
+    dimensions: List[str]
+    measures: List[Measure]
+    filters: List[Filter] = []
+
+def coerce_value(attribute, value):
+    # Validate a filter value against the attribute's type and convert it to
+    # the Python type bound as the statement parameter
+    attribute_type = ATTRIBUTES[attribute][2]
+    if attribute_type == 'int':
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or int(value) != value:
+            raise CubeQueryError(f"{attribute} expects an integer, got {value!r}")
+        return int(value)
+    if attribute_type == 'date':
+        if not isinstance(value, str):
+            raise CubeQueryError(f"{attribute} expects a date 'YYYY-MM-DD', got {value!r}")
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").date()
+        except ValueError:
+            raise CubeQueryError(f"{attribute} expects a date 'YYYY-MM-DD', got {value!r}")
+    if not isinstance(value, str):
+        raise CubeQueryError(f"{attribute} expects a string, got {value!r}")
+    return value
+
+def validate_query(query):
+    # Check the query against the star schema before anything reaches the server
+    if not query.measures:
+        raise CubeQueryError("At least one measure is required")
+    for name in query.dimensions:
+        if name not in ATTRIBUTES:
+            raise CubeQueryError(f"Unknown dimension attribute: {name}")
+    if len(set(query.dimensions)) != len(query.dimensions):
+        raise CubeQueryError("Dimension attributes must be unique")
+    output_names = set(query.dimensions) | {'Count'}
+    for measure in query.measures:
+        if measure.measure == '*':
+            if measure.aggregate != 'COUNT':
+                raise CubeQueryError(f"{measure.aggregate}(*) is not supported, only COUNT(*)")
+        elif measure.measure not in MEASURES:
+            raise CubeQueryError(f"Unknown measure: {measure.measure}")
+        name = measure.output_name()
+        if not IDENTIFIER_PATTERN.match(name):
+            raise CubeQueryError(f"Invalid alias: {name}")
+        if name in output_names:
+            raise CubeQueryError(f"Duplicate output column: {name}")
+        output_names.add(name)
+    for condition in query.filters:
+        if condition.attribute not in ATTRIBUTES:
+            raise CubeQueryError(f"Unknown filter attribute: {condition.attribute}")
+        expected = OPERATORS[condition.operator]
+        if expected is None and not condition.values:
+            raise CubeQueryError(f"{condition.operator} needs at least one value")
+        if expected is not None and len(condition.values) != expected:
+            raise CubeQueryError(f"{condition.operator} needs exactly {expected} value(s)")
+        if condition.operator == 'like' and ATTRIBUTES[condition.attribute][2] != 'str':
+            raise CubeQueryError(f"like only applies to text attributes, not {condition.attribute}")
+        for value in condition.values:
+            coerce_value(condition.attribute, value)
+
+def referenced_attributes(query):
+    return list(query.dimensions) + [condition.attribute for condition in query.filters]
+
+def attribute_expression(name):
+    table, column, _ = ATTRIBUTES[name]
+    alias = FACT_ALIAS if table == 'FactSales' else DIMENSIONS[table]['alias']
+    return f"{alias}.{column}"
+
+def joins_for(attributes, schema=None):
+    # LEFT JOIN only the dimensions the attributes need, parents first
+    needed = []
+    for name in attributes:
+        table = ATTRIBUTES[name][0]
+        chain = []
+        while table != 'FactSales':
+            chain.append(table)
+            table = DIMENSIONS[table]['parent']
+        for table in reversed(chain):
+            if table not in needed:
+                needed.append(table)
+    joins = []
+    for table in needed:
+        dimension = DIMENSIONS[table]
+        parent = dimension['parent']
+        parent_alias = FACT_ALIAS if parent == 'FactSales' else DIMENSIONS[parent]['alias']
+        name = f"{schema}.{table}" if schema else table
+        joins.append(f"LEFT JOIN {name} {dimension['alias']} ON {parent_alias}.{dimension['key']} = {dimension['alias']}.{dimension['key']}")
+    return joins
+
+def filter_sql(expression, condition):
+    values = [coerce_value(condition.attribute, value) for value in condition.values]
+    if condition.operator in ('in', 'not in'):
+        placeholders = ", ".join("?" for _ in values)
+        return f"{expression} {condition.operator.upper()} ({placeholders})", values
+    if condition.operator == 'between':
+        return f"{expression} BETWEEN ? AND ?", values
+    return f"{expression} {condition.operator.upper()} ?", values
+
+def build_cube_sql(query, aggregate_table=None, measure_sql=None):
+    # Emit (sql, params) for a validated query. With aggregate_table set, the
+    # query reads that rollup instead of FactSales; measure_sql then maps each
+    # Measure to its re-aggregation over the rollup's columns.
+    if aggregate_table is None:
+        expressions = {name: attribute_expression(name) for name in referenced_attributes(query)}
+        from_clause = "\n".join([f"FROM FactSales {FACT_ALIAS}"] + joins_for(referenced_attributes(query)))
+        measures = [f"{m.aggregate}({m.measure if m.measure == '*' else f'{FACT_ALIAS}.{m.measure}'})" for m in query.measures]
+        count = "COUNT(*)"
+    else:
+        expressions = {name: f"x.[{name}]" for name in referenced_attributes(query)}
+        from_clause = f"FROM {aggregate_table} x"
+        measures = [measure_sql(m) for m in query.measures]
+        count = measure_sql(Measure(aggregate='COUNT'))
+
+    select_items = [f"{expressions[name]} AS [{name}]" for name in query.dimensions]
+    select_items += [f"{sql} AS [{m.output_name()}]" for sql, m in zip(measures, query.measures)]
+    select_items.append(f"{count} AS [Count]")
+
+    where_items = []
+    params = []
+    for condition in query.filters:
+        sql, values = filter_sql(expressions[condition.attribute], condition)
+        where_items.append(sql)
+        params.extend(values)
+
+    sql = f"SELECT {', '.join(select_items)}\n{from_clause}"
+    if where_items:
+        sql += "\nWHERE " + " AND ".join(where_items)
+    if query.dimensions:
+        sql += "\nGROUP BY " + ", ".join(expressions[name] for name in query.dimensions)
+    return sql, params
+
+# Example payloads served by /sample_queries/ (and timed by benchmark_suite)
+SAMPLE_QUERIES = [
+    {
+        "description": "Total Sales by Album",
+        "query": {
+            "dimensions": ["Album"],
+            "measures": [{"aggregate": "SUM", "measure": "TotalAmount", "alias": "TotalSales"}],
+            "filters": []
+        }
+    },
+    {
+        "description": "Total Sales by Genre",
+        "query": {
+            "dimensions": ["Genre"],
+            "measures": [{"aggregate": "SUM", "measure": "TotalAmount", "alias": "TotalSales"}],
+            "filters": []
+        }
+    },
+    {
+        "description": "Sales in Q1 2023",
+        "query": {
+            "dimensions": ["Date"],
+            "measures": [{"aggregate": "SUM", "measure": "TotalAmount", "alias": "TotalSales"}],
+            "filters": [
+                {"attribute": "Year", "operator": "=", "values": [2023]},
+                {"attribute": "Quarter", "operator": "=", "values": [1]}
+            ]
+        }
+    }
+]
@@ -0,0 +1,168 @@
+import logging
+import pyodbc
+import time
+from etl_shadow import FOREIGN_KEYS, TARGET_SCHEMA
+
+# How FactSales is stored. 'clustered' makes it a clustered columnstore, with
+# SalesKey kept as a nonclustered primary key. 'nonclustered' keeps the
+# rowstore table and adds a nonclustered columnstore for the cube scans plus
+# one B-tree per foreign key column.
+FACT_STORAGE_MODES = ('clustered', 'nonclustered')
+FACT_STORAGE = 'clustered'
+
+# Natural key of each dimension; the loaders match source rows on these
+NATURAL_KEYS = {
+    'DimArtist': 'ArtistId',
+    'DimAlbum': 'AlbumId',
+    'DimGenre': 'GenreId',
+    'DimMediaType': 'MediaTypeId',
+    'DimTrack': 'TrackId',
+    'DimEmployee': 'EmployeeId',
+    'DimCustomer': 'CustomerId',
+    'DimDate': 'Date',
+}
+
+FACT_FOREIGN_KEYS = [column for table, column, _ in FOREIGN_KEYS if table == 'FactSales']
+FACT_MEASURES = ['Quantity', 'UnitPrice', 'TotalAmount']
+
+def provisioned_indexes(storage=FACT_STORAGE):
+    # Indexes this module manages, each a dict with the table, index name,
+    # whether it is the clustered index, and its CREATE statement (with
+    # {schema} to fill in)
+    if storage not in FACT_STORAGE_MODES:
+        raise ValueError(f"Unknown FactSales storage '{storage}', expected one of {FACT_STORAGE_MODES}")
+    # Unique, but NULL natural keys are left out rather than limited to one
+    indexes = [{'table': table, 'name': f"UX_{table}_{column}", 'clustered': False,
+                'sql': f"CREATE UNIQUE NONCLUSTERED INDEX UX_{table}_{column} ON {{schema}}.{table} ({column}) "
+                       f"WHERE {column} IS NOT NULL"}
+               for table, column in NATURAL_KEYS.items()]
+    if storage == 'clustered':
+        indexes.append({'table': 'FactSales', 'name': 'CCI_FactSales', 'clustered': True,
+                        'sql': "CREATE CLUSTERED COLUMNSTORE INDEX CCI_FactSales ON {schema}.FactSales"})
+    else:
+        columns = ', '.join(['InvoiceLineId'] + FACT_FOREIGN_KEYS + FACT_MEASURES)
+        indexes.append({'table': 'FactSales', 'name': 'NCCI_FactSales', 'clustered': False,
+                        'sql': f"CREATE NONCLUSTERED COLUMNSTORE INDEX NCCI_FactSales ON {{schema}}.FactSales ({columns})"})
+        indexes += [{'table': 'FactSales', 'name': f"IX_FactSales_{column}", 'clustered': False,
+                     'sql': f"CREATE NONCLUSTERED INDEX IX_FactSales_{column} ON {{schema}}.FactSales ({column})"}
+                    for column in FACT_FOREIGN_KEYS]
+    return indexes
+
+def index_state(cursor, schema=TARGET_SCHEMA):
+    # {(table, index): row} for every index on the schema's tables, heaps excluded
+    cursor.execute("""
+        SELECT t.name AS TableName, i.name AS IndexName, i.type_desc AS TypeDesc,
+               i.is_disabled AS IsDisabled, i.is_primary_key AS IsPrimaryKey
+        FROM sys.indexes i
+        JOIN sys.tables t ON i.object_id = t.object_id
+        JOIN sys.schemas s ON t.schema_id = s.schema_id
+        WHERE s.name = ? AND i.type > 0
+    """, schema)
+    return {(row.TableName, row.IndexName): row for row in cursor.fetchall()}
+
+def schema_tables(cursor, schema=TARGET_SCHEMA):
+    cursor.execute("""
+        SELECT t.name FROM sys.tables t JOIN sys.schemas s ON t.schema_id = s.schema_id WHERE s.name = ?
+    """, schema)
+    return {row[0] for row in cursor.fetchall()}
+
+def create_fact_columnstore(cursor, schema=TARGET_SCHEMA):
+    # A table has one clustered index, so a clustered rowstore primary key
+    # is dropped first and comes back as a nonclustered constraint (unnamed,
+    # like the shadow tables', as shadow and dbo tables trade schemas)
+    cursor.execute("""
+        SELECT kc.name, i.type_desc
+        FROM sys.key_constraints kc
+        JOIN sys.indexes i ON i.object_id = kc.parent_object_id AND i.index_id = kc.unique_index_id
+        WHERE kc.type = 'PK' AND kc.parent_object_id = OBJECT_ID(?)
+    """, f"{schema}.FactSales")
+    primary_key = cursor.fetchone()
+    if primary_key is not None and primary_key[1] == 'CLUSTERED':
+        cursor.execute(f"ALTER TABLE {schema}.FactSales DROP CONSTRAINT {primary_key[0]}")
+        primary_key = None
+    cursor.execute(f"CREATE CLUSTERED COLUMNSTORE INDEX CCI_FactSales ON {schema}.FactSales")
+    if primary_key is None:
+        cursor.execute(f"ALTER TABLE {schema}.FactSales ADD PRIMARY KEY NONCLUSTERED (SalesKey)")
+
+def ensure_indexes(target_cursor, target_conn, schema=TARGET_SCHEMA, storage=FACT_STORAGE):
+    # Create the provisioned indexes that are missing and rebuild the ones
+    # that are disabled; indexes already in place are left alone, so this is
+    # safe to run at every startup. Tables that do not exist yet are skipped.
+    # Each index is its own transaction and a failure (say, duplicate natural
+    # keys) is logged and reported rather than raised.
+    # Returns {index: 'ok' | 'created' | 'rebuilt' | 'skipped: ...' | 'failed: ...'}.
+    tables = schema_tables(target_cursor, schema)
+    existing = index_state(target_cursor, schema)
+    fact_columnstore = any(table == 'FactSales' and state.TypeDesc == 'CLUSTERED COLUMNSTORE'
+                           for (table, _), state in existing.items())
+    actions = {}
+    for index in provisioned_indexes(storage):
+        table, name = index['table'], index['name']
+        state = existing.get((table, name))
+        start = time.perf_counter()
+        if table not in tables:
+            actions[name] = f"skipped: no table {schema}.{table}"
+            continue
+        try:
+            if state is None and name == 'CCI_FactSales':
+                create_fact_columnstore(target_cursor, schema)
+                action = 'created'
+            elif state is None and name == 'NCCI_FactSales' and fact_columnstore:
+                action = 'skipped: FactSales is a clustered columnstore'
+            elif state is None:
+                target_cursor.execute(index['sql'].format(schema=schema))
+                action = 'created'
+            elif state.IsDisabled:
+                target_cursor.execute(f"ALTER INDEX {name} ON {schema}.{table} REBUILD")
+                action = 'rebuilt'
+            else:
+                action = 'ok'
+            target_conn.commit()
+        except pyodbc.Error as e:
+            target_conn.rollback()
+            action = f"failed: {e}"
+            logging.error(f"ensure_indexes: {schema}.{table}.{name} failed: {e}")
+        if action in ('created', 'rebuilt'):
+            elapsed = time.perf_counter() - start
+            print(f"Index {name} on {schema}.{table} {action} in {elapsed:.2f}s.")
+            logging.info(f"ensure_indexes: {schema}.{table}.{name} {action} in {elapsed:.2f}s")
+        actions[name] = action
+    return actions
+
+def disable_for_load(target_cursor, target_conn, schema=TARGET_SCHEMA, storage=FACT_STORAGE):
+    # Before a full reload: disable the provisioned nonclustered indexes so
+    # the bulk inserts do not maintain them. Clustered indexes and primary
+    # keys are never disabled, that would take the table offline. Returns
+    # the names of the indexes disabled.
+    existing = index_state(target_cursor, schema)
+    disabled = []
+    for index in provisioned_indexes(storage):
+        state = existing.get((index['table'], index['name']))
+        if state is not None and not index['clustered'] and not state.IsDisabled:
+            target_cursor.execute(f"ALTER INDEX {index['name']} ON {schema}.{index['table']} DISABLE")
+            disabled.append(index['name'])
+    target_conn.commit()
+    if disabled:
+        print(f"Disabled {len(disabled)} indexes for the load: {', '.join(disabled)}.")
+        logging.info(f"disable_for_load: {schema} {', '.join(disabled)}")
+    return disabled
+
+def rebuild_after_load(target_cursor, target_conn, schema=TARGET_SCHEMA, storage=FACT_STORAGE, full=True):
+    # After a load: the clustered columnstore first, since nonclustered
+    # indexes are built from it. A full load rebuilds it into compressed
+    # rowgroups; an incremental one only compresses the new delta rowgroups.
+    # Then ensure_indexes() rebuilds what disable_for_load() disabled and
+    # creates whatever is missing (all of it on freshly made shadow tables).
+    existing = index_state(target_cursor, schema)
+    if storage == 'clustered' and ('FactSales', 'CCI_FactSales') in existing:
+        start = time.perf_counter()
+        if full:
+            target_cursor.execute(f"ALTER INDEX CCI_FactSales ON {schema}.FactSales REBUILD")
+        else:
+            target_cursor.execute(f"ALTER INDEX CCI_FactSales ON {schema}.FactSales "
+                                  f"REORGANIZE WITH (COMPRESS_ALL_ROW_GROUPS = ON)")
+        target_conn.commit()
+        elapsed = time.perf_counter() - start
+        print(f"Columnstore on {schema}.FactSales {'rebuilt' if full else 'reorganized'} in {elapsed:.2f}s.")
+        logging.info(f"rebuild_after_load: {schema}.FactSales columnstore {'rebuilt' if full else 'reorganized'} in {elapsed:.2f}s")
+    return ensure_indexes(target_cursor, target_conn, schema, storage)
@@ -1,6 +1,12 @@
 import pyodbc
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+import numpy as np
+import pandas as pd
+from etl_separated import BATCH_SIZE, fetch_batches
+from etl_metrics import ETL_METRICS, etl_run
 
 def connect_to_db(server, database):
     conn = pyodbc.connect(
@@ -122,6 +128,8 @@ def create_staging_tables(target_cursor, target_conn):
     ]
     for sql in staging_tables_sql:
         target_cursor.execute(sql)
+    # Used by the pushdown mode's 'title' rule
+    target_cursor.execute(TITLE_CASE_FUNCTION)
     target_conn.commit()
     print("Staging tables created or verified.")
 
@@ -133,147 +141,240 @@ def truncate_staging_tables(target_cursor, target_conn):
     target_conn.commit()
     print("Staging tables truncated.")
 
-def preprocess_artist(source_cursor, target_cursor):
-    print("Preprocessing Artist data...")
-    source_cursor.execute("SELECT ArtistId, Name FROM Artist")
-    rows = source_cursor.fetchall()
-    for row in rows:
-        # Data Cleaning: Standardize names
-        name = row.Name.strip().title() if row.Name else None
-        target_cursor.execute("INSERT INTO stg_Artist (ArtistId, Name) VALUES (?, ?)", row.ArtistId, name)
-    print("Artist data preprocessed and loaded into staging.")
-
-def preprocess_album(source_cursor, target_cursor):
-    print("Preprocessing Album data...")
-    source_cursor.execute("SELECT AlbumId, Title, ArtistId FROM Album")
-    rows = source_cursor.fetchall()
-    for row in rows:
-        title = row.Title.strip().title() if row.Title else None
-        target_cursor.execute("INSERT INTO stg_Album (AlbumId, Title, ArtistId) VALUES (?, ?, ?)", row.AlbumId, title, row.ArtistId)
-    print("Album data preprocessed and loaded into staging.")
-
-def preprocess_genre(source_cursor, target_cursor):
-    print("Preprocessing Genre data...")
-    source_cursor.execute("SELECT GenreId, Name FROM Genre")
-    rows = source_cursor.fetchall()
-    for row in rows:
-        name = row.Name.strip().title() if row.Name else None
-        target_cursor.execute("INSERT INTO stg_Genre (GenreId, Name) VALUES (?, ?)", row.GenreId, name)
-    print("Genre data preprocessed and loaded into staging.")
-
-def preprocess_mediatype(source_cursor, target_cursor):
-    print("Preprocessing MediaType data...")
-    source_cursor.execute("SELECT MediaTypeId, Name FROM MediaType")
-    rows = source_cursor.fetchall()
-    for row in rows:
-        name = row.Name.strip().title() if row.Name else None
-        target_cursor.execute("INSERT INTO stg_MediaType (MediaTypeId, Name) VALUES (?, ?)", row.MediaTypeId, name)
-    print("MediaType data preprocessed and loaded into staging.")
-
-def preprocess_track(source_cursor, target_cursor):
-    print("Preprocessing Track data...")
-    source_cursor.execute("SELECT TrackId, Name, AlbumId, MediaTypeId, GenreId, Composer, Milliseconds, Bytes, UnitPrice FROM Track")
-    rows = source_cursor.fetchall()
-    for row in rows:
-        name = row.Name.strip().title() if row.Name else None
-        composer = row.Composer.strip().title() if row.Composer else None
-        target_cursor.execute("""
-            INSERT INTO stg_Track (TrackId, Name, AlbumId, MediaTypeId, GenreId, Composer, Milliseconds, Bytes, UnitPrice)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, row.TrackId, name, row.AlbumId, row.MediaTypeId, row.GenreId, composer, row.Milliseconds, row.Bytes, row.UnitPrice)
-    print("Track data preprocessed and loaded into staging.")
-
-def preprocess_employee(source_cursor, target_cursor):
-    print("Preprocessing Employee data...")
-    source_cursor.execute("""
-        SELECT EmployeeId, LastName, FirstName, Title, ReportsTo, BirthDate, HireDate,
-               Address, City, State, Country, PostalCode, Phone, Fax, Email
-        FROM Employee
-    """)
-    rows = source_cursor.fetchall()
-    for row in rows:
-        # Data Cleaning: Standardize names and addresses
-        last_name = row.LastName.strip().title() if row.LastName else None
-        first_name = row.FirstName.strip().title() if row.FirstName else None
-        title = row.Title.strip().title() if row.Title else None
-        address = row.Address.strip().title() if row.Address else None
-        city = row.City.strip().title() if row.City else None
-        state = row.State.strip().title() if row.State else None
-        country = row.Country.strip().title() if row.Country else None
-        email = row.Email.strip().lower() if row.Email else None
-        # Data Transformation: Validate email format
-        email = email if re.match(r"[^@]+@[^@]+\.[^@]+", email) else None
-        target_cursor.execute("""
-            INSERT INTO stg_Employee (EmployeeId, LastName, FirstName, Title, ReportsTo, BirthDate, HireDate,
-                                      Address, City, State, Country, PostalCode, Phone, Fax, Email)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, row.EmployeeId, last_name, first_name, title, row.ReportsTo, row.BirthDate, row.HireDate,
-             address, city, state, country, row.PostalCode, row.Phone, row.Fax, email)
-    print("Employee data preprocessed and loaded into staging.")
-
-def preprocess_customer(source_cursor, target_cursor):
-    print("Preprocessing Customer data...")
-    source_cursor.execute("""
-        SELECT CustomerId, FirstName, LastName, Company, Address, City, State, Country, PostalCode,
-               Phone, Fax, Email, SupportRepId
-        FROM Customer
-    """)
-    rows = source_cursor.fetchall()
-    for row in rows:
-        first_name = row.FirstName.strip().title() if row.FirstName else None
-        last_name = row.LastName.strip().title() if row.LastName else None
-        company = row.Company.strip().title() if row.Company else None
-        address = row.Address.strip().title() if row.Address else None
-        city = row.City.strip().title() if row.City else None
-        state = row.State.strip().title() if row.State else None
-        country = row.Country.strip().title() if row.Country else None
-        email = row.Email.strip().lower() if row.Email else None
-        # Data Transformation: Validate email format
-        email = email if re.match(r"[^@]+@[^@]+\.[^@]+", email) else None
-        target_cursor.execute("""
-            INSERT INTO stg_Customer (CustomerId, FirstName, LastName, Company, Address, City, State,
-                                      Country, PostalCode, Phone, Fax, Email, SupportRepId)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, row.CustomerId, first_name, last_name, company, address, city, state,
-             country, row.PostalCode, row.Phone, row.Fax, email, row.SupportRepId)
-    print("Customer data preprocessed and loaded into staging.")
-
-def preprocess_invoice(source_cursor, target_cursor):
-    print("Preprocessing Invoice data...")
-    source_cursor.execute("""
-        SELECT InvoiceId, CustomerId, InvoiceDate, BillingAddress, BillingCity, BillingState,
-               BillingCountry, BillingPostalCode, Total
-        FROM Invoice
-    """)
-    rows = source_cursor.fetchall()
-    for row in rows:
-        billing_address = row.BillingAddress.strip().title() if row.BillingAddress else None
-        billing_city = row.BillingCity.strip().title() if row.BillingCity else None
-        billing_state = row.BillingState.strip().title() if row.BillingState else None
-        billing_country = row.BillingCountry.strip().title() if row.BillingCountry else None
-        target_cursor.execute("""
-            INSERT INTO stg_Invoice (InvoiceId, CustomerId, InvoiceDate, BillingAddress, BillingCity,
-                                     BillingState, BillingCountry, BillingPostalCode, Total)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, row.InvoiceId, row.CustomerId, row.InvoiceDate, billing_address, billing_city,
-             billing_state, billing_country, row.BillingPostalCode, row.Total)
-    print("Invoice data preprocessed and loaded into staging.")
-
-def preprocess_invoiceline(source_cursor, target_cursor):
-    print("Preprocessing InvoiceLine data...")
-    source_cursor.execute("""
-        SELECT InvoiceLineId, InvoiceId, TrackId, UnitPrice, Quantity
-        FROM InvoiceLine
-    """)
-    rows = source_cursor.fetchall()
-    for row in rows:
-        target_cursor.execute("""
-            INSERT INTO stg_InvoiceLine (InvoiceLineId, InvoiceId, TrackId, UnitPrice, Quantity)
-            VALUES (?, ?, ?, ?, ?)
-        """, row.InvoiceLineId, row.InvoiceId, row.TrackId, row.UnitPrice, row.Quantity)
-    print("InvoiceLine data preprocessed and loaded into staging.")
-
-def main():
+EMAIL_PATTERN = re.compile(r"[^@]+@[^@]+\.[^@]+")
+
+def clean_title(value):
+    # Standardize names and addresses
+    return value.strip().title() if value else None
+
+def clean_email(value):
+    # Lowercase and keep only addresses that look valid
+    email = value.strip().lower() if value else None
+    return email if email is not None and EMAIL_PATTERN.match(email) else None
+
+def factorized(values, clean):
+    # Apply clean once per distinct value and broadcast the results back by
+    # code. A batch repeats the same names, cities and countries many times,
+    # and calling the per-row function keeps the output identical to it.
+    codes, uniques = pd.factorize(np.array(values, dtype=object))
+    # NULLs get code -1, i.e. the trailing None
+    cleaned = np.array([clean(value) for value in uniques] + [None], dtype=object)
+    return cleaned[codes].tolist()
+
+# Title-casing with str.title() semantics: a letter is upper-cased after a
+# character that is not a letter and lower-cased after one that is
+TITLE_CASE_FUNCTION = """
+CREATE OR ALTER FUNCTION dbo.stg_TitleCase (@value NVARCHAR(4000))
+RETURNS NVARCHAR(4000)
+WITH SCHEMABINDING, RETURNS NULL ON NULL INPUT
+AS
+BEGIN
+    DECLARE @result NVARCHAR(4000) = N'', @i INT = 1, @c NCHAR(1), @previous_cased BIT = 0
+    WHILE @i <= LEN(@value + N'x') - 1
+    BEGIN
+        SET @c = SUBSTRING(@value, @i, 1)
+        SET @result += CASE WHEN @previous_cased = 1 THEN LOWER(@c) ELSE UPPER(@c) END
+        SET @previous_cased = CASE WHEN UPPER(@c) COLLATE Latin1_General_BIN <> LOWER(@c) COLLATE Latin1_General_BIN THEN 1 ELSE 0 END
+        SET @i += 1
+    END
+    RETURN @result
+END
+"""
+
+# Email check in SQL, equivalent to re.match(r"[^@]+@[^@]+\.[^@]+"):
+# something before the first @, and a dot with something either side of it
+# before the next @
+TRIMMED_SQL = "LTRIM(RTRIM({column}))"
+AFTER_AT_SQL = f"SUBSTRING({TRIMMED_SQL}, CHARINDEX('@', {TRIMMED_SQL}) + 1, 4000)"
+DOMAIN_SQL = f"LEFT({AFTER_AT_SQL}, CHARINDEX('@', {AFTER_AT_SQL} + '@') - 1)"
+
+# Cleansing rules: name -> (Python function, SQL template). The template
+# gets the source column as {column}; a rule whose template is None cannot
+# be pushed down and sends its table through the Python path. LTRIM/RTRIM
+# only trim spaces where str.strip() trims all whitespace.
+RULES = {
+    'title': (clean_title,
+              f"CASE WHEN DATALENGTH({{column}}) > 0 THEN dbo.stg_TitleCase({TRIMMED_SQL}) END"),
+    'email': (clean_email,
+              f"CASE WHEN CHARINDEX('@', {TRIMMED_SQL}) > 1 AND {DOMAIN_SQL} LIKE '_%._%'"
+              f" THEN LOWER({TRIMMED_SQL}) END"),
+}
+
+# Staging table -> (source table, [(column, rule)]) in load order; rule None
+# copies the column unchanged
+CLEANSING_RULES = {
+    'stg_Artist': ('Artist', [('ArtistId', None), ('Name', 'title')]),
+    'stg_Album': ('Album', [('AlbumId', None), ('Title', 'title'), ('ArtistId', None)]),
+    'stg_Genre': ('Genre', [('GenreId', None), ('Name', 'title')]),
+    'stg_MediaType': ('MediaType', [('MediaTypeId', None), ('Name', 'title')]),
+    'stg_Track': ('Track', [('TrackId', None), ('Name', 'title'), ('AlbumId', None), ('MediaTypeId', None),
+                            ('GenreId', None), ('Composer', 'title'), ('Milliseconds', None), ('Bytes', None),
+                            ('UnitPrice', None)]),
+    'stg_Employee': ('Employee', [('EmployeeId', None), ('LastName', 'title'), ('FirstName', 'title'),
+                                  ('Title', 'title'), ('ReportsTo', None), ('BirthDate', None), ('HireDate', None),
+                                  ('Address', 'title'), ('City', 'title'), ('State', 'title'), ('Country', 'title'),
+                                  ('PostalCode', None), ('Phone', None), ('Fax', None), ('Email', 'email')]),
+    'stg_Customer': ('Customer', [('CustomerId', None), ('FirstName', 'title'), ('LastName', 'title'),
+                                  ('Company', 'title'), ('Address', 'title'), ('City', 'title'), ('State', 'title'),
+                                  ('Country', 'title'), ('PostalCode', None), ('Phone', None), ('Fax', None),
+                                  ('Email', 'email'), ('SupportRepId', None)]),
+    'stg_Invoice': ('Invoice', [('InvoiceId', None), ('CustomerId', None), ('InvoiceDate', None),
+                                ('BillingAddress', 'title'), ('BillingCity', 'title'), ('BillingState', 'title'),
+                                ('BillingCountry', 'title'), ('BillingPostalCode', None), ('Total', None)]),
+    'stg_InvoiceLine': ('InvoiceLine', [('InvoiceLineId', None), ('InvoiceId', None), ('TrackId', None),
+                                        ('UnitPrice', None), ('Quantity', None)]),
+}
+
+PREPROCESS_MODES = ('python', 'vectorized', 'pushdown')
+
+# Staging tables loaded at once by preprocess_parallel(); each worker is a
+# separate process, so the Python cleansing spreads across cores
+STAGING_WORKERS = 4
+
+# Batches a parallel worker inserts between commits
+COMMIT_BATCHES = 10
+
+def staging_insert_sql(staging_table):
+    columns = [column for column, _ in CLEANSING_RULES[staging_table][1]]
+    placeholders = ", ".join("?" for _ in columns)
+    return f"INSERT INTO {staging_table} ({', '.join(columns)}) VALUES ({placeholders})"
+
+def transform_rows(rows, rules):
+    # Per-row engine: every rule is called once per value
+    cleaners = [RULES[rule][0] if rule else None for _, rule in rules]
+    return [tuple(clean(value) if clean else value for clean, value in zip(cleaners, row)) for row in rows]
+
+def transform_columns(rows, rules):
+    # Vectorized engine: the batch is cleansed a column at a time; columns
+    # without a rule are passed through untouched so their Python types
+    # (None, Decimal, datetime) survive unchanged
+    columns = list(zip(*rows))
+    for index, (_, rule) in enumerate(rules):
+        if rule:
+            columns[index] = factorized(columns[index], RULES[rule][0])
+    return list(zip(*columns))
+
+TRANSFORMS = {'python': transform_rows, 'vectorized': transform_columns}
+
+def preprocess_table(source_cursor, target_cursor, staging_table, batch_size=BATCH_SIZE, engine='python',
+                     target_conn=None, commit_batches=None):
+    # Stream the source table and cleanse it in Python, batch by batch, with
+    # the per-row or the vectorized engine. With target_conn and
+    # commit_batches set, commits every commit_batches batches. Returns the
+    # number of rows staged.
+    source_table, rules = CLEANSING_RULES[staging_table]
+    print(f"Preprocessing {source_table} data...")
+    columns = [column for column, _ in rules]
+    transform = TRANSFORMS[engine]
+    source_cursor.execute(f"SELECT {', '.join(columns)} FROM {source_table}")
+    insert_sql = staging_insert_sql(staging_table)
+    staged = 0
+    for batch_number, rows in enumerate(fetch_batches(source_cursor, batch_size), 1):
+        target_cursor.executemany(insert_sql, transform(rows, rules))
+        staged += len(rows)
+        if commit_batches and batch_number % commit_batches == 0:
+            target_conn.commit()
+    print(f"{source_table} data preprocessed and loaded into staging.")
+    return staged
+
+def pushdown_sql(staging_table, source_database):
+    # INSERT...SELECT applying the rules on the server, or None if one of the
+    # table's rules has no SQL form
+    source_table, rules = CLEANSING_RULES[staging_table]
+    select_items = []
+    for column, rule in rules:
+        if rule is None:
+            select_items.append(column)
+        elif RULES[rule][1] is None:
+            return None
+        else:
+            select_items.append(f"{RULES[rule][1].format(column=column)} AS {column}")
+    columns = ", ".join(column for column, _ in rules)
+    return (f"INSERT INTO {staging_table} ({columns})\n"
+            f"SELECT {', '.join(select_items)}\n"
+            f"FROM {source_database}.dbo.{source_table}")
+
+def preprocess_table_pushdown(source_cursor, target_cursor, staging_table, source_database, batch_size=BATCH_SIZE):
+    # Set-based path for when source and staging share a server: one
+    # statement per table, no rows travel through Python
+    sql = pushdown_sql(staging_table, source_database)
+    if sql is None:
+        return preprocess_table(source_cursor, target_cursor, staging_table, batch_size)
+    source_table = CLEANSING_RULES[staging_table][0]
+    print(f"Preprocessing {source_table} data on the server...")
+    target_cursor.execute(sql)
+    print(f"{source_table} data preprocessed and loaded into staging ({target_cursor.rowcount} rows).")
+    return target_cursor.rowcount
+
+def stage_table(source_cursor, target_cursor, target_conn, staging_table, source_database, mode='python',
+                batch_size=BATCH_SIZE, commit_batches=None):
+    # Stage one table with mode and commit it, as an ETL_METRICS span with
+    # the cursor calls charged to the staging table
+    source_cursor, target_cursor, target_conn = ETL_METRICS.metered(staging_table, source_cursor,
+                                                                    target_cursor, target_conn)
+    with ETL_METRICS.span(staging_table):
+        if mode == 'pushdown':
+            staged = preprocess_table_pushdown(source_cursor, target_cursor, staging_table, source_database, batch_size)
+        else:
+            staged = preprocess_table(source_cursor, target_cursor, staging_table, batch_size, mode,
+                                      target_conn, commit_batches)
+        target_conn.commit()
+    return staged
+
+def preprocess_worker(staging_table, source_server, source_database, target_server, target_database,
+                      mode='python', batch_size=BATCH_SIZE, commit_batches=COMMIT_BATCHES):
+    # Runs in a worker process: stage one table over its own connections and
+    # report (table, rows, seconds, the table's ETL_METRICS counters)
+    start = time.perf_counter()
+    source_conn = connect_to_db(source_server, source_database)
+    target_conn = connect_to_db(target_server, target_database)
+    try:
+        source_cursor = source_conn.cursor()
+        target_cursor = target_conn.cursor()
+        target_cursor.fast_executemany = True
+        staged = stage_table(source_cursor, target_cursor, target_conn, staging_table, source_database, mode,
+                             batch_size, commit_batches)
+    finally:
+        source_conn.close()
+        target_conn.close()
+    return staging_table, staged, time.perf_counter() - start, ETL_METRICS.table(staging_table)
+
+def preprocess_parallel(source_server, source_database, target_server, target_database, mode='python',
+                        batch_size=BATCH_SIZE, max_workers=STAGING_WORKERS, commit_batches=COMMIT_BATCHES):
+    # The stg_* tables do not depend on each other, so every table is staged
+    # by its own worker process. Returns {staging table: rows staged}.
+    # Counters recorded in the workers are merged into this process's
+    # ETL_METRICS.
+    start = time.perf_counter()
+    counts = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(preprocess_worker, staging_table, source_server, source_database,
+                                   target_server, target_database, mode, batch_size, commit_batches)
+                   for staging_table in CLEANSING_RULES]
+        try:
+            for future in as_completed(futures):
+                staging_table, staged, elapsed, table_metrics = future.result()
+                ETL_METRICS.merge({staging_table: table_metrics})
+                counts[staging_table] = staged
+                rate = staged / elapsed if elapsed else 0.0
+                print(f"{staging_table}: {staged} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    elapsed = time.perf_counter() - start
+    print(f"Staged {sum(counts.values())} rows from {len(counts)} tables in {elapsed:.2f}s "
+          f"with {max_workers} workers.")
+    return counts
+
+def main(batch_size=BATCH_SIZE, mode='python', max_workers=1):
+    # mode 'python' cleanses row by row, 'vectorized' a column at a time;
+    # 'pushdown' cleanses with INSERT...SELECT on the target server and
+    # needs the source database on that same server. max_workers > 1 stages
+    # the tables in parallel worker processes.
+    if mode not in PREPROCESS_MODES:
+        raise ValueError(f"Unknown preprocessing mode: {mode}")
+
     # Database connection parameters
     source_server = 'DPC2023'   # Replace with your source server name
     source_database = 'Chinook'
@@ -286,6 +387,7 @@ def main():
 
     source_cursor = source_conn.cursor()
     target_cursor = target_conn.cursor()
+    target_cursor.fast_executemany = True
 
     # Create staging tables if they do not exist
     create_staging_tables(target_cursor, target_conn)
@@ -293,16 +395,17 @@ def main():
     # Truncate staging tables
     truncate_staging_tables(target_cursor, target_conn)
 
-    # Preprocess and load data into staging tables
-    preprocess_artist(source_cursor, target_cursor)
-    preprocess_album(source_cursor, target_cursor)
-    preprocess_genre(source_cursor, target_cursor)
-    preprocess_mediatype(source_cursor, target_cursor)
-    preprocess_track(source_cursor, target_cursor)
-    preprocess_employee(source_cursor, target_cursor)
-    preprocess_customer(source_cursor, target_cursor)
-    preprocess_invoice(source_cursor, target_cursor)
-    preprocess_invoiceline(source_cursor, target_cursor)
+    # Preprocess and load data into staging tables, streaming batch_size rows
+    # at a time; the run report goes to etl_metrics.REPORT_DIRECTORY
+    with etl_run('staging', mode=mode, batch_size=batch_size, max_workers=max_workers) as run:
+        if max_workers > 1:
+            preprocess_parallel(source_server, source_database, target_server, target_database, mode,
+                                batch_size, max_workers)
+        else:
+            for staging_table in CLEANSING_RULES:
+                stage_table(source_cursor, target_cursor, target_conn, staging_table, source_database, mode,
+                            batch_size)
+    print(f"Staging run report saved to {run['report_path']}.")
 
     # Commit changes
     target_conn.commit()
@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Default cache limits; the OLAP API overrides these from its own settings
+CACHE_MAX_ENTRIES = 256
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_TTL = 300
+
+def query_cache_key(query):
+    # Dimension, measure and filter order do not change the result set, and
+    # neither does the order of values in an IN list, so they are sorted.
+    # The columns of a cached frame are in the order of the query that
+    # stored it; result_columns() puts them back in the caller's order.
+    filters = []
+    for condition in query.filters:
+        values = tuple(condition.values)
+        if condition.operator in ('in', 'not in'):
+            values = tuple(sorted(values, key=repr))
+        filters.append((condition.attribute, condition.operator, values))
+    return (
+        tuple(sorted(query.dimensions)),
+        tuple(sorted((m.aggregate, m.measure, m.output_name()) for m in query.measures)),
+        tuple(sorted(filters, key=repr)),
+    )
+
+def result_columns(query):
+    # Column order of a query's result, as build_cube_sql selects them:
+    # dimensions, measures, then Count
+    return list(query.dimensions) + [m.output_name() for m in query.measures] + ['Count']
+
+def dataframe_size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+class QueryResultCache:
+    # In-process LRU cache of query results with a TTL, an entry limit and a
+    # memory limit. invalidate() bumps the generation after a cube refresh;
+    # results computed against an older generation are never stored.
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL, sizeof=dataframe_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, size, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        size = self.sizeof(value)
+        with self._lock:
+            # A refresh finished while this result was being computed
+            if generation != self.generation or size > self.max_bytes:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+            return True
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def metrics(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "generation": self.generation,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import logging
+import pyodbc
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+# Default slow-query settings; the OLAP API overrides these from its own settings
+SLOW_QUERY_MS = 1000
+SLOW_QUERY_LOG = 'olap_slow_queries.log'
+SLOW_QUERY_LOG_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+
+# Session options for profile=true; the plan comes back as an extra result
+# set, the IO and time statistics as informational messages
+STATISTICS_ON = "SET STATISTICS IO ON; SET STATISTICS TIME ON; SET STATISTICS XML ON;"
+STATISTICS_OFF = "SET STATISTICS IO OFF; SET STATISTICS TIME OFF; SET STATISTICS XML OFF;"
+
+IO_PATTERN = re.compile(r"Table '([^']+)'\. Scan count (\d+), logical reads (\d+), physical reads (\d+)"
+                        r"(?:.*?read-ahead reads (\d+))?")
+TIME_PATTERN = re.compile(r"CPU time = (\d+) ms,\s*elapsed time = (\d+) ms")
+
+def fingerprint(sql):
+    # (hash, normalized SQL): literals become ?, IN lists of any length one
+    # (?+), whitespace is collapsed, so every run of the same slice of the
+    # cube shares a fingerprint whatever its filter values
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    normalized = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?+)", normalized)
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16], normalized
+
+def query_slice(query):
+    # The shape of a cube query without its filter values
+    return {
+        "dimensions": list(query.dimensions),
+        "measures": [f"{m.aggregate}({m.measure})" for m in query.measures],
+        "filters": [f"{f.attribute} {f.operator}" for f in query.filters],
+    }
+
+class QueryProfile:
+    # Timings of one cube query in milliseconds, phase by phase, plus what
+    # run_olap_query() fills in: SQL, source table, cache hit, row count and,
+    # when capture_server_stats is set, SQL Server's IO and time statistics
+    # and the actual plan. queued_at, set just before the query is handed to
+    # an executor, turns the wait for a worker into the queue phase.
+
+    def __init__(self, capture_server_stats=False):
+        self.capture_server_stats = capture_server_stats
+        self.started = time.perf_counter()
+        self.queued_at = None
+        self.timings = OrderedDict()
+        self.sql = None
+        self.source = None
+        self.cached = None
+        self.rows = None
+        self.server = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start)
+
+    def add(self, name, start):
+        # Charge the time since start to phase name
+        self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def to_dict(self):
+        profile = {"timings_ms": {name: round(ms, 3) for name, ms in self.timings.items()},
+                   "elapsed_ms": round(self.elapsed_ms(), 3)}
+        if self.sql is not None:
+            profile["fingerprint"] = fingerprint(self.sql)[0]
+        if self.server is not None:
+            profile["server"] = self.server
+        return profile
+
+def server_statistics(messages, plans):
+    # Parse STATISTICS IO / TIME messages and keep the showplan XML
+    tables = OrderedDict()
+    compile_cpu = compile_elapsed = cpu = elapsed = 0
+    for _, message in messages:
+        for table, scans, logical, physical, read_ahead in IO_PATTERN.findall(message):
+            entry = tables.setdefault(table, {"scan_count": 0, "logical_reads": 0, "physical_reads": 0,
+                                              "read_ahead_reads": 0})
+            entry["scan_count"] += int(scans)
+            entry["logical_reads"] += int(logical)
+            entry["physical_reads"] += int(physical)
+            entry["read_ahead_reads"] += int(read_ahead or 0)
+        times = TIME_PATTERN.search(message)
+        if times:
+            if "parse and compile" in message:
+                compile_cpu += int(times.group(1))
+                compile_elapsed += int(times.group(2))
+            else:
+                cpu += int(times.group(1))
+                elapsed += int(times.group(2))
+    return {
+        "logical_reads": sum(entry["logical_reads"] for entry in tables.values()),
+        "physical_reads": sum(entry["physical_reads"] for entry in tables.values()),
+        "tables": tables,
+        "compile_cpu_ms": compile_cpu,
+        "compile_elapsed_ms": compile_elapsed,
+        "cpu_ms": cpu,
+        "elapsed_ms": elapsed,
+        "plan": plans[-1] if plans else None,
+    }
+
+def execute_profiled(cursor, sql, params, profile):
+    # Execute and fetch on cursor, timing each; with server statistics on,
+    # also collect the messages and plan that follow the result set.
+    # Returns (rows, column names). The session options are turned back off
+    # so the pooled connection is left as it was found.
+    if profile.capture_server_stats:
+        cursor.execute(STATISTICS_ON)
+    try:
+        with profile.phase("execute"):
+            cursor.execute(sql, params)
+        with profile.phase("fetch"):
+            rows = cursor.fetchall()
+        columns = [desc[0] for desc in cursor.description]
+        if profile.capture_server_stats:
+            messages = list(cursor.messages or [])
+            plans = []
+            while cursor.nextset():
+                messages += cursor.messages or []
+                if cursor.description:
+                    plans += [row[0] for row in cursor.fetchall()]
+            profile.server = server_statistics(messages, plans)
+    finally:
+        if profile.capture_server_stats:
+            try:
+                cursor.execute(STATISTICS_OFF)
+            except pyodbc.Error as e:
+                logging.warning(f"Could not turn query statistics off: {e}")
+    return rows, columns
+
+class SlowQueryLog:
+    # Queries slower than threshold_ms, one JSON object per line in a
+    # rotating file, keyed by fingerprint so repeated slow slices group
+    # together
+
+    def __init__(self, path=SLOW_QUERY_LOG, threshold_ms=SLOW_QUERY_MS, max_bytes=SLOW_QUERY_LOG_BYTES,
+                 backup_count=SLOW_QUERY_LOG_BACKUPS):
+        self.threshold_ms = threshold_ms
+        self._logger = logging.getLogger(f"olap.slow_queries.{path}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True,
+                                          encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger.addHandler(handler)
+        self._lock = threading.Lock()
+        self._logged = 0
+        self._checked = 0
+
+    def record(self, profile, query, engine, status="ok"):
+        # Log the query if it ran past the threshold; returns whether it did
+        elapsed = profile.elapsed_ms()
+        with self._lock:
+            self._checked += 1
+            if elapsed < self.threshold_ms:
+                return False
+            self._logged += 1
+        hashed, normalized = fingerprint(profile.sql) if profile.sql is not None else (None, None)
+        entry = {
+            "time": datetime.now().isoformat(timespec='milliseconds'),
+            "fingerprint": hashed,
+            "elapsed_ms": round(elapsed, 3),
+            "status": status,
+            "engine": engine,
+            "source": profile.source,
+            "cached": profile.cached,
+            "rows": profile.rows,
+            "slice": query_slice(query),
+            "timings_ms": {name: round(ms, 3) for name, ms in profile.timings.items()},
+            "sql": normalized,
+        }
+        if profile.server is not None:
+            entry["logical_reads"] = profile.server["logical_reads"]
+        self._logger.warning(json.dumps(entry))
+        return True
+
+    def metrics(self):
+        with self._lock:
+            return {"threshold_ms": self.threshold_ms, "checked": self._checked, "logged": self._logged}
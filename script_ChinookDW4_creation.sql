@@ -99,7 +99,7 @@ CREATE TABLE DimCustomer (
 
 -- FactSales
 CREATE TABLE FactSales (
-    SalesKey INT IDENTITY(1,1) PRIMARY KEY,
+    SalesKey INT IDENTITY(1,1) PRIMARY KEY NONCLUSTERED,
     InvoiceLineId INT,
     DateKey INT,
     CustomerKey INT,
@@ -120,6 +120,26 @@ CREATE TABLE FactSales (
     FOREIGN KEY (EmployeeKey) REFERENCES DimEmployee(EmployeeKey)
 );
 
+-- EtlWatermark (high-watermark per source table for incremental refresh)
+CREATE TABLE EtlWatermark (
+    SourceTable NVARCHAR(128) PRIMARY KEY,
+    WatermarkColumn NVARCHAR(128),
+    WatermarkValue BIGINT,
+    UpdatedAt DATETIME
+);
+
+-- Indexes provisioned by olap_schema.py (keep the two in step): FactSales is
+-- stored as a clustered columnstore, and each Dim's natural key is unique
+CREATE CLUSTERED COLUMNSTORE INDEX CCI_FactSales ON FactSales;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimArtist_ArtistId ON DimArtist (ArtistId) WHERE ArtistId IS NOT NULL;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimAlbum_AlbumId ON DimAlbum (AlbumId) WHERE AlbumId IS NOT NULL;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimGenre_GenreId ON DimGenre (GenreId) WHERE GenreId IS NOT NULL;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimMediaType_MediaTypeId ON DimMediaType (MediaTypeId) WHERE MediaTypeId IS NOT NULL;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimTrack_TrackId ON DimTrack (TrackId) WHERE TrackId IS NOT NULL;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimEmployee_EmployeeId ON DimEmployee (EmployeeId) WHERE EmployeeId IS NOT NULL;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimCustomer_CustomerId ON DimCustomer (CustomerId) WHERE CustomerId IS NOT NULL;
+CREATE UNIQUE NONCLUSTERED INDEX UX_DimDate_Date ON DimDate (Date) WHERE Date IS NOT NULL;
+
 GO
 
 /*******************************************************************************
@@ -0,0 +1,90 @@
+import random
+import re
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+BRACKETED = re.compile(r"\[([^\]]+)\]")
+
+# Text columns compare case-insensitively, as under SQL Server's default collation
+TEXT = "VARCHAR COLLATE NOCASE"
+
+DIMENSION_TABLES = {
+    'DimDate': "DateKey INTEGER PRIMARY KEY, Date DATE, Day INTEGER, Month INTEGER, Year INTEGER, Quarter INTEGER",
+    'DimCustomer': f"CustomerKey INTEGER PRIMARY KEY, CustomerId INTEGER, Country {TEXT}, State {TEXT}, "
+                   f"City {TEXT}, Company {TEXT}",
+    'DimArtist': f"ArtistKey INTEGER PRIMARY KEY, ArtistId INTEGER, Name {TEXT}",
+    'DimAlbum': f"AlbumKey INTEGER PRIMARY KEY, AlbumId INTEGER, Title {TEXT}, ArtistKey INTEGER",
+    'DimGenre': f"GenreKey INTEGER PRIMARY KEY, GenreId INTEGER, Name {TEXT}",
+    'DimMediaType': f"MediaTypeKey INTEGER PRIMARY KEY, MediaTypeId INTEGER, Name {TEXT}",
+    'DimTrack': f"TrackKey INTEGER PRIMARY KEY, TrackId INTEGER, Name {TEXT}, Composer {TEXT}",
+    'DimEmployee': f"EmployeeKey INTEGER PRIMARY KEY, EmployeeId INTEGER, LastName {TEXT}, Title {TEXT}",
+}
+
+FACT_SALES = """
+    SalesKey INTEGER PRIMARY KEY, InvoiceLineId INTEGER, DateKey INTEGER, CustomerKey INTEGER, TrackKey INTEGER,
+    AlbumKey INTEGER, GenreKey INTEGER, MediaTypeKey INTEGER, EmployeeKey INTEGER,
+    Quantity INTEGER, UnitPrice DECIMAL(10,2), TotalAmount DECIMAL(10,2)
+"""
+
+# Mixed-case spellings that SQL Server treats as one value
+COUNTRIES = ['USA', 'usa', 'Canada', 'CANADA', 'Brazil', 'France', None]
+GENRES = ['Rock', 'Jazz', 'Metal', 'Blues', 'ROCK']
+PRICES = [Decimal('0.99'), Decimal('1.99')]
+
+def populate(conn, rng, fact_rows=600):
+    # A small star schema with NULL keys, NULL measures and facts pointing
+    # at missing dimension rows, so the engine's NULL handling is exercised
+    start = date(2022, 1, 1)
+    dates = [start + timedelta(days=offset) for offset in range(0, 730, 7)]
+    conn.executemany("INSERT INTO DimDate VALUES (?, ?, ?, ?, ?, ?)",
+                     [(key, d, d.day, d.month, d.year, (d.month - 1) // 3 + 1) for key, d in enumerate(dates, 1)])
+    conn.executemany("INSERT INTO DimCustomer VALUES (?, ?, ?, ?, ?, ?)",
+                     [(key, key, rng.choice(COUNTRIES), None, f"City{key % 7}", None if key % 3 else f"Co{key}")
+                      for key in range(1, 41)])
+    conn.executemany("INSERT INTO DimArtist VALUES (?, ?, ?)", [(key, key, f"Artist{key}") for key in range(1, 6)])
+    conn.executemany("INSERT INTO DimAlbum VALUES (?, ?, ?, ?)",
+                     [(key, key, f"Album{key}", rng.randint(1, 5)) for key in range(1, 13)])
+    conn.executemany("INSERT INTO DimGenre VALUES (?, ?, ?)", [(key, key, name) for key, name in enumerate(GENRES, 1)])
+    conn.executemany("INSERT INTO DimMediaType VALUES (?, ?, ?)", [(1, 1, 'MPEG'), (2, 2, 'AAC')])
+    conn.executemany("INSERT INTO DimTrack VALUES (?, ?, ?, ?)",
+                     [(key, key, f"Track{key}", None if key % 4 else f"Composer{key % 3}") for key in range(1, 61)])
+    conn.executemany("INSERT INTO DimEmployee VALUES (?, ?, ?, ?)",
+                     [(key, key, f"Employee{key}", 'Sales Support Agent') for key in range(1, 4)])
+    facts = []
+    for key in range(1, fact_rows + 1):
+        quantity = None if key % 97 == 0 else rng.randint(1, 3)
+        price = None if key % 89 == 0 else rng.choice(PRICES)
+        total = quantity * price if quantity is not None and price is not None else None
+        facts.append((key, key, rng.randint(1, len(dates)), None if key % 53 == 0 else rng.randint(1, 42),
+                      rng.randint(1, 60), rng.randint(1, 12), rng.randint(1, len(GENRES)), rng.randint(1, 2),
+                      rng.randint(1, 3),
+                      quantity, price, total))
+    conn.executemany("INSERT INTO FactSales VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", facts)
+
+@pytest.fixture(scope="session")
+def warehouse():
+    # In-memory DuckDB star schema standing in for SQL Server; CustomerKey
+    # 41 and 42 have no DimCustomer row. Tests using it skip without duckdb.
+    duckdb = pytest.importorskip("duckdb")
+    conn = duckdb.connect()
+    for table, columns in DIMENSION_TABLES.items():
+        conn.execute(f"CREATE TABLE {table} ({columns})")
+    conn.execute(f"CREATE TABLE FactSales ({FACT_SALES})")
+    populate(conn, random.Random(7))
+    yield conn
+    conn.close()
+
+@pytest.fixture(scope="session")
+def run_sql(warehouse):
+    # Run (sql, params) from build_cube_sql, with its [bracketed] names
+    # quoted for DuckDB; returns (columns, rows), ([], []) for a statement
+    def run(sql, params=()):
+        cursor = warehouse.cursor()
+        cursor.execute(BRACKETED.sub(r'"\1"', sql), list(params))
+        if cursor.description is None:
+            return [], []
+        columns = [description[0] for description in cursor.description]
+        return columns, cursor.fetchall()
+    return run
@@ -0,0 +1,105 @@
+import pytest
+
+from data_processing_Chinook import QUALITY_RULES, column_expression, ranked_source, rejected_sql, repoint_statements, update_sql
+
+SOURCE_TABLES = {
+    'Employee': "EmployeeId INTEGER, LastName VARCHAR, FirstName VARCHAR, BirthDate DATE",
+    'Customer': "CustomerId INTEGER, FirstName VARCHAR, LastName VARCHAR, Email VARCHAR, SupportRepId INTEGER",
+    'Invoice': "InvoiceId INTEGER, CustomerId INTEGER, Total DECIMAL(10,2)",
+}
+
+@pytest.fixture
+def source():
+    # Tiny Chinook source in DuckDB; the statements' #temp tables are
+    # dropped from the SQL, since only the SELECT part is checked here
+    duckdb = pytest.importorskip("duckdb")
+    conn = duckdb.connect()
+    for table, columns in SOURCE_TABLES.items():
+        conn.execute(f"CREATE TABLE {table} ({columns})")
+    conn.executemany("INSERT INTO Employee VALUES (?, ?, ?, ?)", [(1, 'Adams', 'Andrew', None)])
+    conn.executemany("INSERT INTO Customer VALUES (?, ?, ?, ?, ?)", [
+        (1, 'Ann', 'Lee', 'ann@x.com', 1),
+        (2, 'Ann', 'Lee', 'ann@x.com', 1),
+        (3, 'Ann', 'Lee', 'ann@x.com', 1),
+        (4, 'Bob', 'Ray', 'Unknown', 1),
+        (5, 'Bob', 'Ray', 'Unknown', 1),
+        (6, 'Cy', 'Oz', None, 1),
+        (7, 'Cy', 'Oz', None, 99),
+    ])
+    conn.executemany("INSERT INTO Invoice VALUES (?, ?, ?)", [
+        (1, 1, 5), (2, 3, 2), (3, 42, 1), (4, None, 3), (5, 1, -1),
+    ])
+    yield conn
+    conn.close()
+
+def rejected(conn, table):
+    sql, names = rejected_sql(table)
+    rows = conn.execute(sql.replace("INTO #rejected", "").replace(";", "")).fetchall()
+    return {row[0]: {name for name, flag in zip(names, row[1:]) if flag} for row in rows}
+
+def test_update_sql_applies_every_column_rule_once():
+    sql, names = update_sql('Customer', QUALITY_RULES['Customer'])
+    rules = QUALITY_RULES['Customer']
+    assert names == ([f"not_null {column}" for column in rules['defaults']]
+                     + [f"trim {column}" for column in rules['trim']] + ["standardize Country"])
+    assert sql.count("CASE WHEN") == len(names)
+    assert f"DECLARE @affected TABLE ({', '.join(f'r{i} INT' for i in range(len(names)))})" in sql
+    set_clause = sql.split("SET ", 2)[2].split("\n")[0]
+    for column in set(rules['defaults']) | set(rules['trim']):
+        assert set_clause.count(f"{column} = ") == 1
+
+def test_table_without_column_rules_has_no_update():
+    assert update_sql('Genre', QUALITY_RULES['Genre']) == (None, [])
+
+@pytest.mark.parametrize("column, value, expected", [
+    ('Country', ' United States ', 'USA'),
+    ('Country', 'GB', 'UK'),
+    ('Country', 'Brazil ', 'Brazil'),
+    ('Country', None, None),
+    ('FirstName', None, 'Unknown'),
+    ('FirstName', '  Ann', 'Ann'),
+])
+def test_column_expression_cleans_values(column, value, expected):
+    duckdb = pytest.importorskip("duckdb")
+    expression = column_expression(QUALITY_RULES['Customer'], column)
+    assert duckdb.sql(f"SELECT {expression} FROM (SELECT ?::VARCHAR AS {column})", params=[value]).fetchone()[0] == expected
+
+def test_literals_are_quoted():
+    duckdb = pytest.importorskip("duckdb")
+    expression = column_expression({'defaults': {'Name': "O'Neil"}}, 'Name')
+    assert duckdb.sql(f"SELECT {expression} FROM (SELECT NULL::VARCHAR AS Name)").fetchone()[0] == "O'Neil"
+
+def test_rejected_sql_flags_orphans_and_failed_checks(source):
+    assert rejected(source, 'Invoice') == {3: {"reference CustomerId"}, 5: {"check Total"}}
+
+def test_table_without_row_rules_rejects_nothing():
+    assert rejected_sql('Playlist') == (None, [])
+
+def test_ranked_source_ranks_complete_business_keys_only(source):
+    rows = source.execute(f"SELECT CustomerId, rn, KeepKey FROM {ranked_source('Customer')} s ORDER BY CustomerId")
+    ranked = {key: (rn, keep) for key, rn, keep in rows.fetchall()}
+    assert [ranked[key] for key in (1, 2, 3)] == [(1, 1), (2, 1), (3, 1)]
+    # The defaulted 'Unknown' email and a NULL email are not a shared key
+    assert all(ranked[key][0] is None for key in (4, 5, 6, 7))
+
+def test_referenced_duplicates_are_not_deleted(source):
+    # Customer 3 duplicates customer 1 but still has an invoice
+    assert rejected(source, 'Customer') == {2: {"duplicates"}, 7: {"reference SupportRepId"}}
+
+def test_references_are_updated_in_place():
+    statements = repoint_statements('Invoice', 'CustomerId')
+    assert statements == ["UPDATE o SET o.CustomerId = m.KeepKey FROM Invoice o JOIN #merged m ON m.DropKey = o.CustomerId"]
+
+def test_repointing_a_key_column_drops_rows_that_would_collide():
+    duckdb = pytest.importorskip("duckdb")
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE merged (DropKey INTEGER, KeepKey INTEGER)")
+    conn.execute("INSERT INTO merged VALUES (2, 1), (3, 1)")
+    conn.execute("CREATE TABLE PlaylistTrack (PlaylistId INTEGER, TrackId INTEGER)")
+    conn.execute("INSERT INTO PlaylistTrack VALUES (1, 1), (1, 2), (2, 3), (3, 2), (3, 3), (4, 5)")
+    delete, update = repoint_statements('PlaylistTrack', 'TrackId')
+    assert update.startswith("UPDATE o SET o.TrackId = m.KeepKey FROM PlaylistTrack o")
+    # Run the DELETE's row selection as a SELECT
+    assert "DELETE o FROM PlaylistTrack o" in delete
+    select = delete.replace("#merged", "merged").replace("DELETE o FROM", "SELECT o.PlaylistId, o.TrackId FROM")
+    assert sorted(conn.execute(select).fetchall()) == [(1, 2), (3, 3)]
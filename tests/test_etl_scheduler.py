@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+from etl_scheduler import critical_path, run_dag, topological_order
+
+DEPENDENCIES = {
+    'artist': [],
+    'genre': [],
+    'album': ['artist'],
+    'track': ['album', 'genre'],
+    'fact': ['track'],
+}
+
+def test_critical_path_follows_the_slowest_chain():
+    timings = {'artist': 1.0, 'genre': 5.0, 'album': 2.0, 'track': 1.0, 'fact': 3.0}
+    path, total = critical_path(DEPENDENCIES, timings)
+    assert path == ['genre', 'track', 'fact']
+    assert total == pytest.approx(9.0)
+
+def test_critical_path_of_no_tasks():
+    assert critical_path({}, {}) == ([], 0.0)
+
+@pytest.mark.parametrize("dependencies, message", [
+    ({'a': ['b'], 'b': ['a']}, "cycle"),
+    ({'a': ['missing']}, "unknown task"),
+])
+def test_invalid_graphs_are_rejected(dependencies, message):
+    with pytest.raises(ValueError, match=message):
+        topological_order(dependencies)
+
+def test_tasks_start_after_their_dependencies():
+    events = []
+    lock = threading.Lock()
+
+    def task(name):
+        def run():
+            with lock:
+                events.append(name)
+        return run
+
+    report = run_dag({name: task(name) for name in DEPENDENCIES}, DEPENDENCIES)
+    for name, dependencies in DEPENDENCIES.items():
+        assert all(events.index(dependency) < events.index(name) for dependency in dependencies)
+    assert set(report['timings']) == set(DEPENDENCIES)
+    assert report['critical_path'][-1] == 'fact'
+
+def test_independent_tasks_run_concurrently():
+    # Each task waits for the other; run one at a time, the barrier breaks
+    barrier = threading.Barrier(2, timeout=5)
+    run_dag({'a': barrier.wait, 'b': barrier.wait}, {'a': [], 'b': []}, max_workers=2)
+
+def test_failure_stops_dependent_tasks():
+    started = []
+
+    def fail():
+        raise RuntimeError("album failed")
+
+    tasks = {name: (lambda name=name: started.append(name)) for name in DEPENDENCIES}
+    tasks['album'] = fail
+    with pytest.raises(RuntimeError, match="album failed"):
+        run_dag(tasks, DEPENDENCIES, max_workers=1)
+    assert 'track' not in started and 'fact' not in started
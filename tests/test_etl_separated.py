@@ -0,0 +1,47 @@
+import re
+
+import pytest
+
+from etl_separated import reseed_identity
+
+class IdentityCursor:
+    # Answers identity_state()'s catalog query with one (seed, increment,
+    # last value) row and records the RESEED value
+    def __init__(self, state):
+        self.state = state
+        self.reseeded = None
+
+    def execute(self, sql, *params):
+        match = re.search(r"RESEED, (-?\d+)", sql)
+        if match:
+            self.reseeded = int(match.group(1))
+
+    def fetchone(self):
+        return self.state
+
+def next_key(state, reseeded):
+    # The key SQL Server hands out after DBCC CHECKIDENT RESEED: the value
+    # itself on a table with no last value, value + increment otherwise
+    _, increment, last = state
+    return reseeded if last is None else reseeded + increment
+
+@pytest.mark.parametrize("state, after, expected", [
+    ((1, 1, None), None, 1),
+    ((1, 1, 500), None, 1),
+    ((1, 1, None), 500, 501),
+    ((1, 1, 500), 500, 501),
+    ((1, 1, 800), 500, 501),
+    ((10, 5, None), None, 10),
+    ((10, 5, 60), None, 10),
+    ((10, 5, None), 60, 65),
+    ((10, 5, 60), 60, 65),
+])
+def test_reseed_hands_out_the_expected_next_key(state, after, expected):
+    cursor = IdentityCursor(state)
+    reseed_identity(cursor, 'DimArtist', after=after)
+    assert next_key(state, cursor.reseeded) == expected
+
+def test_table_without_identity_is_left_alone():
+    cursor = IdentityCursor(None)
+    reseed_identity(cursor, 'DimArtist')
+    assert cursor.reseeded is None
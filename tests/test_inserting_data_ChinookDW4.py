@@ -0,0 +1,43 @@
+import numpy as np
+
+from inserting_data_ChinookDW4 import GENRES, MEDIA_TYPES, existing_names, generate_genres, generate_mediatypes
+
+class LookupCursor:
+    # Answers the SELECT Id, Name a lookup table is read with
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return self.rows
+
+def test_empty_source_gets_every_genre():
+    genres, ids = generate_genres(np.arange(1, len(GENRES) + 1))
+    assert genres['Name'].tolist() == GENRES
+    assert ids.tolist() == genres['GenreId'].tolist()
+
+def test_existing_genres_keep_their_ids():
+    cursor = LookupCursor([(7, 'Rock'), (3, 'Jazz')])
+    existing = existing_names(cursor, 'Genre')
+    assert cursor.executed == ["SELECT GenreId, Name FROM Genre"]
+    new_ids = np.arange(100, 100 + len(GENRES))
+    genres, ids = generate_genres(new_ids, existing)
+    assert 'Rock' not in genres['Name'].tolist() and 'Jazz' not in genres['Name'].tolist()
+    assert len(genres) == len(GENRES) - 2
+    assert genres['GenreId'].tolist() == list(range(100, 100 + len(genres)))
+    by_name = dict(zip(GENRES, ids.tolist()))
+    assert by_name['Rock'] == 7 and by_name['Jazz'] == 3
+    assert by_name['Metal'] in genres['GenreId'].tolist()
+
+def test_fully_populated_lookup_inserts_nothing():
+    existing = {name: position for position, name in enumerate(MEDIA_TYPES, 1)}
+    mediatypes, ids = generate_mediatypes(np.arange(50, 50 + len(MEDIA_TYPES)), existing)
+    assert mediatypes.empty
+    # Track generation finds the video media type by position in MEDIA_TYPES
+    assert ids.tolist() == list(range(1, len(MEDIA_TYPES) + 1))
+
+def test_without_a_cursor_nothing_exists():
+    assert existing_names(None, 'Genre') == {}
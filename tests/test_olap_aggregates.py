@@ -0,0 +1,97 @@
+import re
+from collections import namedtuple
+
+import pytest
+
+from olap_aggregates import (AGGREGATE_TABLES, aggregate_sql, choose_aggregate, load_aggregate_row_counts,
+                             reaggregated_measure)
+from olap_query_builder import OLAPQuery, build_cube_sql, validate_query
+
+# Every aggregate built, with AggSales_Genre the smallest
+ROW_COUNTS = {'AggSales_Genre': 25, 'AggSales_Album': 300, 'AggSales_Genre_Year_Quarter': 500,
+              'AggSales_Country_Year': 120, 'AggSales_Date': 1800}
+
+def cube_query(dimensions, measures=(("SUM", "TotalAmount"),), filters=()):
+    return OLAPQuery(dimensions=list(dimensions),
+                     measures=[{"aggregate": aggregate, "measure": measure} for aggregate, measure in measures],
+                     filters=list(filters))
+
+@pytest.mark.parametrize("dimensions, filters, expected", [
+    (["Genre"], [], 'AggSales_Genre'),
+    ([], [], 'AggSales_Genre'),
+    (["Year"], [], 'AggSales_Country_Year'),
+    (["Genre"], [{"attribute": "Year", "operator": "=", "values": [2023]}], 'AggSales_Genre_Year_Quarter'),
+    (["Artist"], [], 'AggSales_Album'),
+    (["Month"], [{"attribute": "Date", "operator": ">=", "values": ["2023-01-01"]}], 'AggSales_Date'),
+    (["Country", "Genre"], [], None),
+    (["Track"], [], None),
+])
+def test_smallest_covering_aggregate_is_chosen(dimensions, filters, expected):
+    assert choose_aggregate(cube_query(dimensions, filters=filters), ROW_COUNTS) == expected
+
+@pytest.mark.parametrize("aggregate, measure", [
+    ("AVG", "TotalAmount"), ("MIN", "UnitPrice"), ("MAX", "Quantity"), ("COUNT", "Quantity"), ("SUM", "UnitPrice"),
+])
+def test_measures_that_cannot_be_reaggregated_use_fact_sales(aggregate, measure):
+    query = cube_query(["Genre"], [("SUM", "TotalAmount"), (aggregate, measure)])
+    assert choose_aggregate(query, ROW_COUNTS) is None
+
+def test_aggregates_not_built_are_skipped():
+    row_counts = {name: count for name, count in ROW_COUNTS.items() if name != 'AggSales_Genre'}
+    assert choose_aggregate(cube_query(["Genre"]), row_counts) == 'AggSales_Genre_Year_Quarter'
+    assert choose_aggregate(cube_query(["Genre"]), {}) is None
+
+class CatalogCursor:
+    Row = namedtuple('Row', ['AggregateName', 'AggregateRowCount'])
+
+    def __init__(self, exists, rows=()):
+        self.exists = exists
+        self.rows = [self.Row(*row) for row in rows]
+        self.executed = []
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def fetchone(self):
+        return (1 if self.exists else None,)
+
+    def fetchall(self):
+        return self.rows
+
+def test_row_counts_come_from_the_catalog():
+    cursor = CatalogCursor(True, [('AggSales_Genre', 25), ('AggSales_Album', 300)])
+    assert load_aggregate_row_counts(cursor) == {'AggSales_Genre': 25, 'AggSales_Album': 300}
+    # ROWCOUNT is a reserved word in T-SQL
+    assert not re.search(r"\bRowCount\b", cursor.executed[-1])
+
+def test_missing_catalog_means_no_aggregates():
+    assert load_aggregate_row_counts(CatalogCursor(False)) == {}
+
+def normalized(rows):
+    # A group of case variants may show any one of them
+    rows = [tuple(value.lower() if isinstance(value, str) else value for value in row) for row in rows]
+    return sorted(rows, key=lambda row: [(value is None, value) for value in row])
+
+@pytest.fixture(scope="module")
+def aggregates(run_sql):
+    # Build every rollup in the DuckDB warehouse; SELECT ... INTO becomes CREATE TABLE ... AS
+    for aggregate in AGGREGATE_TABLES:
+        sql = aggregate_sql(aggregate, 'main').replace(f"INTO main.{aggregate['name']}\n", "")
+        run_sql(f"CREATE OR REPLACE TABLE {aggregate['name']} AS {sql}")
+    return {aggregate['name']: 1 for aggregate in AGGREGATE_TABLES}
+
+@pytest.mark.parametrize("dimensions, filters", [
+    (["Genre"], []),
+    (["Artist"], []),
+    (["Country", "Year"], [{"attribute": "Country", "operator": "in", "values": ["usa", "Brazil"]}]),
+    (["Quarter"], [{"attribute": "Genre", "operator": "=", "values": ["Jazz"]}]),
+    (["Month"], [{"attribute": "Date", "operator": "between", "values": ["2022-03-01", "2022-09-30"]}]),
+])
+def test_rollup_gives_the_fact_sales_result(aggregates, run_sql, dimensions, filters):
+    query = cube_query(dimensions, [("SUM", "TotalAmount"), ("SUM", "Quantity"), ("COUNT", "*")], filters)
+    validate_query(query)
+    source = choose_aggregate(query, aggregates)
+    assert source is not None
+    _, expected = run_sql(*build_cube_sql(query))
+    _, actual = run_sql(*build_cube_sql(query, source, reaggregated_measure))
+    assert normalized(actual) == normalized(expected)
@@ -0,0 +1,16 @@
+import pandas as pd
+import pytest
+
+import olap_cube_manager_ChinookDW4 as manager
+
+def test_failed_refresh_invalidates_the_result_cache(monkeypatch):
+    def fail_after_truncating(*args):
+        raise RuntimeError("load failed")
+
+    monkeypatch.setattr(manager, "run_etl_parallel", fail_after_truncating)
+    manager.query_cache.put(("cached",), pd.DataFrame({"Count": [1]}), manager.query_cache.generation)
+    generation = manager.query_cache.generation
+    with pytest.raises(RuntimeError):
+        manager.run_refresh("full", 1000, 1, None)
+    assert manager.query_cache.generation == generation + 1
+    assert manager.query_cache.get(("cached",)) is None
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+
+from olap_executors import BoundedExecutor
+
+async def collect_async(stream):
+    return [chunk async for chunk in stream]
+
+def collect(executor, iterator):
+    return asyncio.run(collect_async(executor.iterate(iterator)))
+
+async def wait_for_metric(executor, name, deadline=2.0):
+    # Poll until the pool reports work under name, failing rather than hanging
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+    while executor.metrics()[name] == 0:
+        assert loop.time() < end, f"executor never reported {name} work"
+        await asyncio.sleep(0.01)
+
+def test_iterate_is_counted_in_metrics():
+    executor = BoundedExecutor("test", 2)
+    try:
+        assert collect(executor, iter(["a", "b", "c"])) == ["a", "b", "c"]
+        metrics = executor.metrics()
+        # Three chunks and the final next() that reports the end
+        assert metrics["completed"] == 4
+        assert metrics["queued"] == 0 and metrics["running"] == 0
+    finally:
+        executor.shutdown()
+
+def test_iterate_closes_the_iterator_on_the_pool():
+    executor = BoundedExecutor("test", 1)
+    closed = []
+
+    def chunks():
+        try:
+            yield "a"
+            yield "b"
+        finally:
+            closed.append(threading.current_thread().name)
+
+    async def first_chunk():
+        stream = executor.iterate(chunks())
+        chunk = await stream.__anext__()
+        await stream.aclose()
+        return chunk
+
+    try:
+        assert asyncio.run(first_chunk()) == "a"
+        assert closed and closed[0].startswith("test")
+        assert executor.metrics()["completed"] == 2
+    finally:
+        executor.shutdown()
+
+def test_busy_pool_shows_running_and_queued_steps():
+    executor = BoundedExecutor("test", 1)
+    release = threading.Event()
+
+    def blocked():
+        release.wait(5)
+        yield "a"
+
+    async def run():
+        first = asyncio.ensure_future(collect_async(executor.iterate(blocked())))
+        second = asyncio.ensure_future(collect_async(executor.iterate(iter(["b"]))))
+        try:
+            await wait_for_metric(executor, "running")
+            busy = executor.metrics()
+        finally:
+            release.set()
+        return busy, await first, await second
+
+    try:
+        busy, first, second = asyncio.run(run())
+        assert busy["running"] == 1 and busy["queued"] == 1
+        assert (first, second) == (["a"], ["b"])
+        assert executor.metrics()["queued"] == 0
+    finally:
+        executor.shutdown()
+
+def test_cancelled_step_leaves_the_queue():
+    executor = BoundedExecutor("test", 1)
+    release = threading.Event()
+
+    async def run():
+        blocker = asyncio.ensure_future(asyncio.wrap_future(executor.submit(release.wait, 5)))
+        stream = asyncio.ensure_future(collect_async(executor.iterate(iter(["a"]))))
+        try:
+            await wait_for_metric(executor, "queued")
+            stream.cancel()
+            await asyncio.gather(stream, return_exceptions=True)
+        finally:
+            stream.cancel()
+            release.set()
+        await blocker
+
+    try:
+        asyncio.run(run())
+        assert executor.metrics()["queued"] == 0
+    finally:
+        executor.shutdown()
@@ -0,0 +1,88 @@
+import pytest
+
+from olap_query_builder import CubeQueryError, OLAPQuery, build_cube_sql, validate_query
+
+def cube_query(dimensions=(), measures=({"aggregate": "SUM", "measure": "TotalAmount"},), filters=()):
+    return OLAPQuery(dimensions=list(dimensions), measures=list(measures), filters=list(filters))
+
+def test_filter_values_are_bound_as_parameters():
+    query = cube_query(["Country"], filters=[
+        {"attribute": "Year", "operator": "between", "values": [2022, 2023]},
+        {"attribute": "Genre", "operator": "in", "values": ["Rock", "Jazz", "Blues"]},
+        {"attribute": "Country", "operator": "like", "values": ["B%"]},
+    ])
+    validate_query(query)
+    sql, params = build_cube_sql(query)
+    assert params == [2022, 2023, "Rock", "Jazz", "Blues", "B%"]
+    assert sql.count("?") == len(params)
+    for literal in ("2022", "Rock", "B%"):
+        assert literal not in sql
+    assert "BETWEEN ? AND ?" in sql
+    assert "IN (?, ?, ?)" in sql
+
+def test_only_needed_dimensions_are_joined():
+    sql, _ = build_cube_sql(cube_query(["Year"], filters=[{"attribute": "Genre", "operator": "=", "values": ["Rock"]}]))
+    assert "JOIN DimDate" in sql and "JOIN DimGenre" in sql
+    assert "DimCustomer" not in sql and "DimAlbum" not in sql
+
+def test_snowflaked_dimension_joins_its_parent_first():
+    sql, _ = build_cube_sql(cube_query(["Artist"]))
+    assert sql.index("JOIN DimAlbum") < sql.index("JOIN DimArtist")
+
+def test_filter_values_are_coerced_to_the_attribute_type():
+    _, params = build_cube_sql(cube_query(filters=[{"attribute": "Year", "operator": "=", "values": [2023.0]},
+                                                   {"attribute": "Date", "operator": ">=", "values": ["2023-01-31"]}]))
+    assert params[0] == 2023 and isinstance(params[0], int)
+    assert params[1].isoformat() == "2023-01-31"
+
+def test_injected_value_is_matched_as_data(run_sql):
+    query = cube_query(["Country"], filters=[
+        {"attribute": "Country", "operator": "=", "values": ["USA'; DROP TABLE FactSales; --"]}])
+    validate_query(query)
+    _, rows = run_sql(*build_cube_sql(query))
+    assert rows == []
+    _, rows = run_sql("SELECT COUNT(*) FROM FactSales", [])
+    assert rows[0][0] > 0
+
+def test_built_sql_runs(run_sql):
+    query = cube_query(["Year", "Quarter"], [{"aggregate": "SUM", "measure": "Quantity"},
+                                             {"aggregate": "COUNT", "measure": "*"}],
+                       [{"attribute": "Year", "operator": "in", "values": [2022]}])
+    columns, rows = run_sql(*build_cube_sql(query))
+    assert columns == ["Year", "Quarter", "SumQuantity", "CountAll", "Count"]
+    assert sorted(row[1] for row in rows) == [1, 2, 3, 4]
+
+@pytest.mark.parametrize("dimensions, measures, filters, message", [
+    (["Country"], [], [], "At least one measure"),
+    (["Nope"], [{"aggregate": "SUM", "measure": "TotalAmount"}], [], "Unknown dimension"),
+    (["Year", "Year"], [{"aggregate": "SUM", "measure": "TotalAmount"}], [], "unique"),
+    ([], [{"aggregate": "SUM", "measure": "Secret"}], [], "Unknown measure"),
+    ([], [{"aggregate": "SUM", "measure": "*"}], [], "only COUNT"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount", "alias": "x]; DROP TABLE FactSales; --"}], [], "Invalid alias"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount", "alias": "Count"}], [], "Duplicate output"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "f.Quantity) OR (1=1", "operator": "=", "values": [1]}], "Unknown filter attribute"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Year", "operator": "between", "values": [2022]}], "exactly 2"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Year", "operator": "=", "values": [2022, 2023]}], "exactly 1"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Genre", "operator": "in", "values": []}], "at least one"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Year", "operator": "like", "values": ["20%"]}], "text attributes"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Year", "operator": "=", "values": ["2023"]}], "expects an integer"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Year", "operator": "=", "values": [2023.5]}], "expects an integer"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Date", "operator": "=", "values": ["31/01/2023"]}], "expects a date"),
+    ([], [{"aggregate": "SUM", "measure": "TotalAmount"}],
+     [{"attribute": "Country", "operator": "=", "values": [1]}], "expects a string"),
+])
+def test_invalid_queries_are_rejected(dimensions, measures, filters, message):
+    with pytest.raises(CubeQueryError, match=message):
+        validate_query(cube_query(dimensions, measures, filters))
+
+def test_unknown_operator_is_rejected_by_the_model():
+    with pytest.raises(ValueError):
+        cube_query(filters=[{"attribute": "Year", "operator": "; DROP", "values": [1]}])
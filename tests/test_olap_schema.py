@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from olap_schema import (FACT_FOREIGN_KEYS, FACT_STORAGE_MODES, NATURAL_KEYS, disable_for_load,
+                         provisioned_indexes)
+
+@pytest.mark.parametrize("storage", FACT_STORAGE_MODES)
+def test_every_index_is_named_once_and_created_by_name(storage):
+    indexes = provisioned_indexes(storage)
+    assert len({index['name'] for index in indexes}) == len(indexes)
+    for index in indexes:
+        sql = index['sql'].format(schema='dbo')
+        assert f" INDEX {index['name']} ON dbo.{index['table']}" in sql
+        assert ('CLUSTERED' in sql.replace('NONCLUSTERED', '')) == index['clustered']
+
+@pytest.mark.parametrize("storage", FACT_STORAGE_MODES)
+def test_natural_keys_are_unique_but_may_be_null(storage):
+    unique = [index for index in provisioned_indexes(storage) if index['name'].startswith('UX_')]
+    assert {index['table'] for index in unique} == set(NATURAL_KEYS)
+    for index in unique:
+        column = NATURAL_KEYS[index['table']]
+        assert index['sql'].startswith("CREATE UNIQUE NONCLUSTERED INDEX")
+        assert index['sql'].endswith(f"({column}) WHERE {column} IS NOT NULL")
+
+def test_clustered_storage_makes_fact_sales_a_columnstore():
+    fact = [index for index in provisioned_indexes('clustered') if index['table'] == 'FactSales']
+    assert [(index['name'], index['clustered']) for index in fact] == [('CCI_FactSales', True)]
+
+def test_nonclustered_storage_indexes_every_foreign_key():
+    fact = {index['name']: index for index in provisioned_indexes('nonclustered') if index['table'] == 'FactSales'}
+    assert set(fact) == {'NCCI_FactSales'} | {f"IX_FactSales_{column}" for column in FACT_FOREIGN_KEYS}
+    assert not any(index['clustered'] for index in fact.values())
+    assert all(column in fact['NCCI_FactSales']['sql'] for column in FACT_FOREIGN_KEYS)
+
+def test_unknown_storage_is_rejected():
+    with pytest.raises(ValueError, match="Unknown FactSales storage"):
+        provisioned_indexes('heap')
+
+class IndexCursor:
+    # Answers index_state()'s catalog query with every provisioned index in
+    # place and enabled, and records the statements run
+    def __init__(self, storage):
+        self.rows = [SimpleNamespace(TableName=index['table'], IndexName=index['name'], IsDisabled=False)
+                     for index in provisioned_indexes(storage)]
+        self.executed = []
+
+    def execute(self, sql, *params):
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return self.rows
+
+@pytest.mark.parametrize("storage", FACT_STORAGE_MODES)
+def test_load_disables_only_nonclustered_indexes(storage):
+    cursor = IndexCursor(storage)
+    disabled = disable_for_load(cursor, SimpleNamespace(commit=lambda: None), 'dbo', storage)
+    assert disabled == [index['name'] for index in provisioned_indexes(storage) if not index['clustered']]
+    assert 'CCI_FactSales' not in disabled
+    assert [sql for sql in cursor.executed if sql.endswith(" DISABLE")] == [
+        f"ALTER INDEX {index['name']} ON dbo.{index['table']} DISABLE"
+        for index in provisioned_indexes(storage) if not index['clustered']]
@@ -0,0 +1,62 @@
+from decimal import Decimal
+
+import pytest
+
+import preprocessing_staging_ChinookDW4 as staging
+from benchmark_cleansing import fixture as batch
+from preprocessing_staging_ChinookDW4 import (CLEANSING_RULES, RULES, clean_email, pushdown_sql, transform_columns,
+                                              transform_rows)
+
+def test_pushdown_inserts_every_staging_column_from_the_source():
+    sql = pushdown_sql('stg_Customer', 'Chinook')
+    columns = [column for column, _ in CLEANSING_RULES['stg_Customer'][1]]
+    lines = sql.split("\n")
+    assert lines[0] == f"INSERT INTO stg_Customer ({', '.join(columns)})"
+    assert lines[-1] == "FROM Chinook.dbo.Customer"
+    assert "dbo.stg_TitleCase(LTRIM(RTRIM(FirstName))) END AS FirstName" in sql
+    assert "THEN LOWER(LTRIM(RTRIM(Email))) END AS Email" in sql
+    # Columns without a rule are copied as they are
+    assert "SELECT CustomerId, " in sql and ", SupportRepId\n" in sql
+
+@pytest.mark.parametrize("staging_table", list(CLEANSING_RULES))
+def test_every_table_can_be_pushed_down(staging_table):
+    sql = pushdown_sql(staging_table, 'Chinook')
+    source_table, rules = CLEANSING_RULES[staging_table]
+    assert sql.endswith(f"FROM Chinook.dbo.{source_table}")
+    assert sql.count(" AS ") == sum(1 for _, rule in rules if rule)
+
+def test_rule_without_sql_keeps_the_table_in_python(monkeypatch):
+    monkeypatch.setitem(staging.RULES, 'email', (clean_email, None))
+    assert pushdown_sql('stg_Customer', 'Chinook') is None
+    assert pushdown_sql('stg_Artist', 'Chinook') is not None
+
+@pytest.mark.parametrize("value", [
+    'luisg@embraer.com.br', ' LEONEKOHLER@surfeu.de ', 'ftremblay@gmail', 'no-at-sign.com', '', None, 'a@b.c',
+    '@example.com', 'x@.com', 'a@b@c.d', 'a@b.c@d', 'x@y.', 'xx@@y.z', 'x@y .z',
+])
+def test_email_sql_agrees_with_clean_email(value):
+    duckdb = pytest.importorskip("duckdb")
+    conn = duckdb.connect()
+    # T-SQL's CHARINDEX and + concatenation in DuckDB terms
+    conn.execute("CREATE MACRO CHARINDEX(needle, haystack) AS instr(haystack, needle)")
+    sql = RULES['email'][1].format(column='Email').replace(" + '@'", " || '@'")
+    cleaned = conn.execute(f"SELECT {sql} FROM (SELECT ?::VARCHAR AS Email)", [value]).fetchone()[0]
+    assert cleaned == clean_email(value)
+
+@pytest.mark.parametrize("staging_table", ['stg_Customer', 'stg_Invoice'])
+def test_vectorized_engine_matches_the_per_row_engine(staging_table):
+    rules = CLEANSING_RULES[staging_table][1]
+    rows = batch(staging_table, 2000)
+    assert transform_columns(rows, rules) == transform_rows(rows, rules)
+
+def test_columns_without_a_rule_keep_their_values():
+    rules = [('Id', None), ('Name', 'title'), ('Total', None), ('Email', 'email')]
+    rows = [(1, '  ann ', Decimal('1.99'), ' A@B.CO '), (2, None, None, None), (3, '  ann ', Decimal('0.99'), '')]
+    cleaned = transform_columns(rows, rules)
+    assert cleaned == [(1, 'Ann', Decimal('1.99'), 'a@b.co'), (2, None, None, None), (3, 'Ann', Decimal('0.99'), None)]
+    assert all(type(row[2]) is type(original[2]) for row, original in zip(cleaned, rows))
+
+def test_all_null_column():
+    rules = [('Id', None), ('Name', 'title')]
+    rows = [(1, None), (2, None)]
+    assert transform_columns(rows, rules) == transform_rows(rows, rules) == rows
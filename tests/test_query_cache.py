@@ -0,0 +1,76 @@
+import pandas as pd
+
+from olap_query_builder import OLAPQuery
+from query_cache import QueryResultCache, query_cache_key, result_columns
+
+def cube_query(dimensions, measures=("TotalAmount",), filters=()):
+    return OLAPQuery(dimensions=list(dimensions),
+                     measures=[{"aggregate": "SUM", "measure": measure} for measure in measures],
+                     filters=list(filters))
+
+def frame(rows=1):
+    return pd.DataFrame({"Year": range(rows), "SumTotalAmount": [1.0] * rows, "Count": [1] * rows})
+
+def test_key_ignores_order_but_not_values():
+    a = cube_query(["Year", "Country"], ["TotalAmount", "Quantity"],
+                   [{"attribute": "Genre", "operator": "in", "values": ["Rock", "Jazz"]}])
+    b = cube_query(["Country", "Year"], ["Quantity", "TotalAmount"],
+                   [{"attribute": "Genre", "operator": "in", "values": ["Jazz", "Rock"]}])
+    c = cube_query(["Country", "Year"], ["Quantity", "TotalAmount"],
+                   [{"attribute": "Genre", "operator": "in", "values": ["Jazz", "Metal"]}])
+    assert query_cache_key(a) == query_cache_key(b)
+    assert query_cache_key(a) != query_cache_key(c)
+
+def test_result_columns_follow_the_query():
+    assert result_columns(cube_query(["Year", "Country"])) == ["Year", "Country", "SumTotalAmount", "Count"]
+    assert result_columns(cube_query(["Country", "Year"])) == ["Country", "Year", "SumTotalAmount", "Count"]
+
+def test_cached_frame_is_reordered_for_the_caller():
+    cache = QueryResultCache()
+    stored = pd.DataFrame({"Year": [2023], "Country": ["USA"], "SumTotalAmount": [1.0], "Count": [1]})
+    cache.put(query_cache_key(cube_query(["Year", "Country"])), stored, cache.generation)
+    query = cube_query(["Country", "Year"])
+    hit = cache.get(query_cache_key(query))
+    assert list(hit[result_columns(query)].columns) == ["Country", "Year", "SumTotalAmount", "Count"]
+
+def test_invalidate_drops_entries_and_bumps_generation():
+    cache = QueryResultCache()
+    key = query_cache_key(cube_query(["Year"]))
+    assert cache.put(key, frame(), cache.generation)
+    generation = cache.generation
+    cache.invalidate()
+    assert cache.generation == generation + 1
+    assert cache.get(key) is None
+    assert cache.metrics()["entries"] == 0 and cache.metrics()["bytes"] == 0
+
+def test_result_from_before_a_refresh_is_not_stored():
+    cache = QueryResultCache()
+    key = query_cache_key(cube_query(["Year"]))
+    generation = cache.generation
+    cache.invalidate()
+    assert not cache.put(key, frame(), generation)
+    assert cache.get(key) is None
+
+def test_expired_entry_is_a_miss():
+    cache = QueryResultCache(ttl=-1)
+    key = query_cache_key(cube_query(["Year"]))
+    cache.put(key, frame(), cache.generation)
+    assert cache.get(key) is None
+    assert cache.metrics()["expirations"] == 1
+
+def test_least_recently_used_entry_is_evicted():
+    cache = QueryResultCache(max_entries=2)
+    keys = [query_cache_key(cube_query([name])) for name in ("Year", "Country", "Genre")]
+    cache.put(keys[0], frame(), cache.generation)
+    cache.put(keys[1], frame(), cache.generation)
+    cache.get(keys[0])
+    cache.put(keys[2], frame(), cache.generation)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache.metrics()["evictions"] == 1
+
+def test_entries_over_the_memory_limit_are_not_stored():
+    cache = QueryResultCache(max_bytes=10)
+    key = query_cache_key(cube_query(["Year"]))
+    assert not cache.put(key, frame(100), cache.generation)
+    assert cache.metrics()["bytes"] == 0
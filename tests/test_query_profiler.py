@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from olap_query_builder import OLAPQuery
+from query_profiler import QueryProfile, SlowQueryLog, fingerprint
+
+SLICE = "SELECT g.Name, SUM(f.TotalAmount) FROM FactSales f JOIN DimGenre g ON g.GenreKey = f.GenreKey WHERE {} GROUP BY g.Name"
+
+@pytest.mark.parametrize("first, second", [
+    ("g.Name = 'Rock'", "g.Name = 'Jazz'"),
+    ("g.Name = 'O''Brien'", "g.Name = 'Metal'"),
+    ("f.TotalAmount > 10", "f.TotalAmount > 0.99"),
+    ("g.Name IN ('Rock')", "g.Name IN ('Rock', 'Jazz',  'Metal')"),
+    ("g.Name = ?", "g.Name   =\n  ?"),
+])
+def test_same_slice_shares_a_fingerprint(first, second):
+    assert fingerprint(SLICE.format(first)) == fingerprint(SLICE.format(second))
+
+@pytest.mark.parametrize("first, second", [
+    ("g.Name = 'Rock'", "g.Name <> 'Rock'"),
+    ("g.Name = 'Rock'", "g.Name IN ('Rock')"),
+    ("g.Name = 'Rock'", "g.Name = 'Rock' AND f.TotalAmount > 1"),
+])
+def test_different_slices_differ(first, second):
+    assert fingerprint(SLICE.format(first))[0] != fingerprint(SLICE.format(second))[0]
+
+def test_normalized_sql_drops_literals_and_keeps_identifiers():
+    hashed, normalized = fingerprint("SELECT TOP 10 Col1 FROM AggSales_Genre WHERE Name IN ('It''s', 'x') AND Id = 7")
+    assert normalized == "SELECT TOP ? Col1 FROM AggSales_Genre WHERE Name IN (?+) AND Id = ?"
+    assert len(hashed) == 16
+
+def test_slow_query_is_logged_under_its_fingerprint(tmp_path):
+    path = tmp_path / "slow.log"
+    log = SlowQueryLog(str(path), threshold_ms=0)
+    profile = QueryProfile()
+    profile.sql = SLICE.format("g.Name = 'Rock'")
+    query = OLAPQuery(dimensions=["Genre"], measures=[{"aggregate": "SUM", "measure": "TotalAmount"}],
+                      filters=[{"attribute": "Genre", "operator": "=", "values": ["Rock"]}])
+    assert log.record(profile, query, "sql")
+    entry = json.loads(path.read_text(encoding='utf-8'))
+    assert (entry["fingerprint"], entry["sql"]) == fingerprint(SLICE.format("g.Name = 'Jazz'"))
+    assert entry["slice"] == {"dimensions": ["Genre"], "measures": ["SUM(TotalAmount)"], "filters": ["Genre ="]}
+    assert profile.to_dict()["fingerprint"] == entry["fingerprint"]